@@ -0,0 +1,131 @@
+# Copyright (C) 2021 Romain Bazile
+#
+# This file is part of the PlanktoScope software.
+#
+# PlanktoScope is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# PlanktoScope is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with PlanktoScope.  If not, see <http://www.gnu.org/licenses/>.
+
+# Compares the columnar measurement of the objects with the measurement of one object at a time
+# on crowded frames. Run from the segmenter folder with:
+#   uv run python -m benchmarks.features [--objects 600] [--debris 4000] [--repeat 3]
+
+import argparse
+import time
+
+import cv2
+import numpy as np
+import skimage.measure
+
+import planktoscope.segmenter.features
+
+
+def crowded_mask(objects, debris, shape=(3040, 4056), seed=0):
+    """Returns a mask with ellipses of various sizes and small debris"""
+    rng = np.random.default_rng(seed)
+    mask = np.zeros(shape, dtype=np.uint8)
+    for _ in range(objects):
+        center = (int(rng.integers(0, shape[1])), int(rng.integers(0, shape[0])))
+        axes = (int(rng.integers(3, 40)), int(rng.integers(3, 25)))
+        cv2.ellipse(mask, center, axes, float(rng.integers(0, 180)), 0, 360, 255, -1)
+    for _ in range(debris):
+        center = (int(rng.integers(0, shape[1])), int(rng.integers(0, shape[0])))
+        cv2.circle(mask, center, int(rng.integers(0, 3)), 255, -1)
+    return mask
+
+
+def measure_per_object(mask, min_esd):
+    """The measurement one object at a time, as it was done before the columnar measurement"""
+    labels = skimage.measure.label(mask)
+    regions = [
+        region
+        for region in skimage.measure.regionprops(labels)
+        if region.equivalent_diameter_area >= min_esd
+    ]
+    objects = []
+    for i, prop in enumerate(regions):
+        objects.append(
+            {
+                "label": i,
+                "width": prop.bbox[3] - prop.bbox[1],
+                "height": prop.bbox[2] - prop.bbox[0],
+                "bx": prop.bbox[1],
+                "by": prop.bbox[0],
+                "circ.": (4 * np.pi * prop.filled_area) / prop.perimeter**2,
+                "area_exc": prop.area,
+                "area": prop.filled_area,
+                "%area": 1 - (prop.area / prop.filled_area),
+                "major": prop.major_axis_length,
+                "minor": prop.minor_axis_length,
+                "y": prop.centroid[0],
+                "x": prop.centroid[1],
+                "convex_area": prop.convex_area,
+                "perim.": prop.perimeter,
+                "elongation": np.divide(prop.major_axis_length, prop.minor_axis_length),
+                "perimareaexc": prop.perimeter / prop.area,
+                "perimmajor": prop.perimeter / prop.major_axis_length,
+                "circex": np.divide(4 * np.pi * prop.area, prop.perimeter**2),
+                "angle": prop.orientation / np.pi * 180 + 90,
+                "bounding_box_area": prop.bbox_area,
+                "eccentricity": prop.eccentricity,
+                "equivalent_diameter": prop.equivalent_diameter,
+                "euler_number": prop.euler_number,
+                "extent": prop.extent,
+                "local_centroid_col": prop.local_centroid[1],
+                "local_centroid_row": prop.local_centroid[0],
+                "solidity": prop.solidity,
+            }
+        )
+    return objects
+
+
+def measure_columns(mask, min_esd):
+    features = planktoscope.segmenter.features
+    labels, _ = features.label_objects(mask, min_esd)
+    return features.records(features.features_table(features.regions_table(labels)))
+
+
+def best_time(function, repeat, *args):
+    durations = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = function(*args)
+        durations.append(time.perf_counter() - start)
+    return min(durations), result
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Compares the measurement of the objects with the previous one"
+    )
+    parser.add_argument("--objects", type=int, default=600, help="number of particles")
+    parser.add_argument("--debris", type=int, default=4000, help="number of small debris")
+    parser.add_argument("--min-esd", type=float, default=20, help="minimum ESD, in pixels")
+    parser.add_argument("--repeat", type=int, default=3, help="number of runs, the best is kept")
+    args = parser.parse_args()
+
+    mask = crowded_mask(args.objects, args.debris)
+    per_object, expected = best_time(measure_per_object, args.repeat, mask, args.min_esd)
+    columns, measured = best_time(measure_columns, args.repeat, mask, args.min_esd)
+
+    identical = len(expected) == len(measured) and all(
+        list(a) == list(b) and np.array_equal(list(a.values()), list(b.values()), equal_nan=True)
+        for a, b in zip(expected, measured)
+    )
+    print(f"{len(expected)} objects in a {mask.shape[1]}x{mask.shape[0]} frame")
+    print(f"one object at a time: {per_object:.3f}s")
+    print(f"columns:              {columns:.3f}s ({per_object / columns:.2f}x)")
+    print(f"identical features:   {identical}")
+
+
+if __name__ == "__main__":
+    main()
@@ -19,9 +19,12 @@
 # Practical Libraries
 ################################################################################
 
+import contextlib
+
 # Logger library compatible with multiprocessing
 # Library to get date and time for folder name and filename
 import datetime
+import itertools
 
 # Libraries manipulate json format, execute bash commands
 import json
@@ -32,24 +35,29 @@ import os
 
 # Library to be able to sleep for a given duration
 import time
+import zipfile
 from uuid import uuid4
 
-import cv2
-import numpy as np
-import PIL.Image
-import skimage.exposure
-
-################################################################################
-# Other image processing Libraries
-################################################################################
-import skimage.measure
 from loguru import logger
 
 # Basic planktoscope libraries
 import planktoscope.mqtt
+import planktoscope.segmenter.cache
+import planktoscope.segmenter.catalog
+import planktoscope.segmenter.debug
 import planktoscope.segmenter.ecotaxa
-import planktoscope.segmenter.encoder
+import planktoscope.segmenter.flat
+import planktoscope.segmenter.follow
+import planktoscope.segmenter.frame
+import planktoscope.segmenter.journal
+import planktoscope.segmenter.objects
 import planktoscope.segmenter.operations
+import planktoscope.segmenter.pipeline
+import planktoscope.segmenter.publisher
+import planktoscope.segmenter.sweep
+import planktoscope.segmenter.worker
+import planktoscope.segmenter.workqueue
+import planktoscope.segmenter.writer
 
 logger.info("planktoscope.segmenter is loaded")
 
@@ -74,6 +82,14 @@ class SegmenterProcess(multiprocessing.Process):
         self.stop_event = event
         self.__pipe = None
         self.segmenter_client = None
+        # runs the segmentations, so that the MQTT messages are read while they run
+        self.__worker = None
+        # job of the segmentation running, see _checkpoint
+        self.__job = None
+        # client subscribed to status/imager while an acquisition is followed
+        self.__imager_client = None
+        # acquisitions of the data path and whether they are segmented, see segment_all
+        self.__catalog = None
         # Where captured images are saved
         self.__img_path = os.path.join(data_path, "img/")
         # To save export folders
@@ -82,6 +98,14 @@ class SegmenterProcess(multiprocessing.Process):
         self.__objects_root = os.path.join(data_path, "objects/")
         # To save debug masks
         self.__debug_objects_root = os.path.join(data_path, "clean/")
+        # To save flats, so that they are not calculated again
+        self.__flat_root = os.path.join(data_path, "flat/")
+        # To save the results of the segmentation stages, so that they are not run again
+        self.__cache_root = os.path.join(data_path, "cache/")
+        # To save the segmentations queued, so that they are run after a restart
+        self.__queue_fn = os.path.join(data_path, planktoscope.segmenter.worker.QUEUE_FILENAME)
+        # To find the acquisitions without listing the data path each time
+        self.__catalog_fn = os.path.join(data_path, planktoscope.segmenter.catalog.CATALOG_FILENAME)
         self.__ecotaxa_path = os.path.join(self.__export_path, "ecotaxa")
         self.__global_metadata = None
         # path for current folder being segmented
@@ -94,19 +118,52 @@ class SegmenterProcess(multiprocessing.Process):
         self.__working_debug_path = ""
         self.__archive_fn = ""
         self.__process_id = ""
+        self.__process_uuid = ""
         self.__flat = None
         self.__mask_array = None
         self.__mask_to_remove = None
-        self.__save_debug_img = True
+        # debug images saved, all of them for every image by default
+        self.__debug = planktoscope.segmenter.debug.DebugImages()
         self.__process_min_ESD = 20  # microns
         # https://planktoscope.slack.com/archives/C01V5ENKG0M/p1714146253356569
         self.__remove_previous_mask = False
+        # RGB statistics, quantiles, skewness and kurtosis of the colours of the objects
+        self.__extended_color_statistics = False
+        # number of images segmented at the same time
+        self.__workers = 1
+        # number of images in flight in the pipeline
+        self.__frames_in_flight = 3
+        # number of images written at the same time
+        self.__writers = 2
+        # memory the segmentation of an image may use, in MB, 0 for no limit
+        self.__memory_budget = 0
+        # size of the blocks of an image looked for objects before the mask is made, 0 to make
+        # the mask on the whole image
+        self.__coarse_scale = 0
+        # minimum time between two progress updates, in seconds
+        self.__progress_interval = 1.0
+        # time during which the objects metrics are batched, in seconds
+        self.__metrics_interval = 1.0
+        # publish every object on its own, for debugging
+        self.__publish_objects = False
+        # also keep the objects images on disk when they are in the EcoTaxa archive, the
+        # visualization of Node-RED reads them
+        self.__keep_objects = True
+        # save the results of the stages, to segment the images again with other parameters
+        self.__cache = False
+        # segment the images of an acquisition in progress as they are saved
+        self.__follow = False
+        # time without a new image after which a followed acquisition is over, in seconds
+        self.__follow_timeout = 600
+        # images and objects of each acquisition segmented, with the time spent, see segment_path
+        self.summaries = []
 
         # create all base path
         for path in [
             self.__ecotaxa_path,
             self.__objects_root,
             self.__debug_objects_root,
+            self.__flat_root,
         ]:
             if not os.path.exists(path):
                 # create the path!
@@ -120,424 +177,66 @@ class SegmenterProcess(multiprocessing.Process):
                 filenames = sorted(filenames)
             return [fn for fn in filenames if fn.endswith(extension)]
 
-    def _manual_median(self, images_array):
-        images_array.sort(axis=0)
-        return images_array[int(len(images_array) / 2)]
-
     def _save_image(self, image, path):
-        PIL.Image.fromarray(cv2.cvtColor(image, cv2.COLOR_BGR2RGB)).save(path)
+        planktoscope.segmenter.writer.write_jpeg(path, image)
 
-    def _save_mask(self, mask, path):
-        PIL.Image.fromarray(mask).save(path)
-
-    def _calculate_flat(self, images_list, images_number, images_root_path):
-        """Calculate a flat image from given list and images number
-
-        Args:
-            images_list (string): list of filenames to calculate a flat for
-            images_number (int): image number to use, must be odd!
-            images_root_path (string): path where to find the images
-
-        Returns:
-            image: median of previously sent images
-        """
-        # TODO make this calculation optional if a flat already exists
-
-        # check to make sure images_number is odd
-        if not images_number % 2:
-            images_number -= 1
-
-        # make sure image number is smaller than image list
-        if images_number > len(images_list):
-            logger.error("The image number can't be bigger than the length of the provided list!")
-            images_number = len(images_list)
-
-        logger.debug(f"Opening {images_number} images: {images_list[:images_number]}")
-        # start = time.monotonic()
-        # Read images and build array
-        images_array = np.array(
-            [
-                cv2.imread(
-                    os.path.join(images_root_path, images_list[i]),
-                )
-                for i in range(images_number)
-            ]
+    def _get_debug_path(self, name):
+        """Returns the debug path of the given image, it is made once the image has debug images"""
+        return os.path.join(
+            self.__debug_objects_root,
+            self.__working_path.split(self.__img_path)[1].strip(),
+            name,
         )
 
-        # logger.debug(time.monotonic() - start)
-        logger.success("Opening images")
-
-        logger.info("Manual median calc")
-        # start = time.monotonic()
-
-        self.__flat = self._manual_median(images_array)
-        # self.__flat = _numpy_median(images_array)
-
-        # logger.debug(time.monotonic() - start)
-
-        logger.success("Manual median calc")
-
-        # cv2.imshow("flat_color", self.__flat.astype("uint8"))
-        # cv2.waitKey(0)
-
-        return self.__flat
-
-    def _open_and_apply_flat(self, filepath, flat_ref):
-        logger.info("Opening images")
-        start = time.monotonic()
-        # logger.debug(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
-        # Read images
-        image = cv2.imread(filepath)
-        # print(image)
-
-        # logger.debug(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
-        # logger.debug(time.monotonic() - start)
-        logger.success("Opening images")
-
-        logger.info("Flat calc")
-        # start = time.monotonic()
-        # logger.debug(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
-
-        # Correct image
-        image = image / self.__flat
-
-        # adding one black pixel top left
-        image[0][0] = [0, 0, 0]
-
-        # logger.debug(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
-        # logger.debug(time.monotonic() - start)
-
-        image = skimage.exposure.rescale_intensity(image, in_range=(0, 1.04), out_range="uint8")
-        # logger.debug(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
-        logger.debug(time.monotonic() - start)
-        logger.success("Flat calc")
-
-        # cv2.imshow("img", img.astype("uint8"))
-        # cv2.waitKey(0)
-        if self.__save_debug_img:
-            self._save_image(
-                image,
-                os.path.join(self.__working_debug_path, "cleaned_image.jpg"),
-            )
-        return image
-
-    def _create_mask(self, img, debug_saving_path):
-        logger.info("Starting the mask creation")
-
-        pipeline = [
-            # "adaptative_threshold",
-            "simple_threshold",
-            "remove_previous_mask" if self.__remove_previous_mask else "no_op",
-            "erode",
-            "dilate",
-            "close",
-            "erode2",
-        ]
-
-        mask = img
-
-        for i, transformation in enumerate(pipeline):
-            function = getattr(
-                planktoscope.segmenter.operations, transformation
-            )  # Retrieves the actual operation
-            mask = function(mask)
-
-            # cv2.imshow(f"mask {transformation}", mask)
-            # cv2.waitKey(0)
-            if self.__save_debug_img:
-                PIL.Image.fromarray(mask).save(
-                    os.path.join(debug_saving_path, f"mask_{i}_{transformation}.jpg")
-                )
-
-        logger.success("Mask created")
-        return mask
-
-    def _get_color_info(self, bgr_img, mask):
-        # bgr_mean, bgr_stddev = cv2.meanStdDev(bgr_img, mask=mask)
-        # (b_channel, g_channel, r_channel) = cv2.split(bgr_img)
-        # quartiles = [0, 0.05, 0.25, 0.50, 0.75, 0.95, 1]
-        # b_quartiles = np.quantile(b_channel, quartiles)
-        # g_quartiles = np.quantile(g_channel, quartiles)
-        # r_quartiles = np.quantile(r_channel, quartiles)
-        hsv_img = cv2.cvtColor(bgr_img, cv2.COLOR_BGR2HSV)
-        (h_channel, s_channel, v_channel) = cv2.split(hsv_img)
-        # hsv_mean, hsv_stddev = cv2.meanStdDev(hsv_img, mask=mask)
-        h_mean = np.mean(h_channel, where=mask)
-        s_mean = np.mean(s_channel, where=mask)
-        v_mean = np.mean(v_channel, where=mask)
-        h_stddev = np.std(h_channel, where=mask)
-        s_stddev = np.std(s_channel, where=mask)
-        v_stddev = np.std(v_channel, where=mask)
-        # TODO #103 Add skewness and kurtosis calculation (with scipy) here
-        # using https://docs.scipy.org/doc/scipy/reference/generated/scipy.stats.skew.html#scipy.stats.skew
-        # and https://docs.scipy.org/doc/scipy/reference/generated/scipy.stats.kurtosis.html#scipy.stats.kurtosis
-        # h_quartiles = np.quantile(h_channel, quartiles)
-        # s_quartiles = np.quantile(s_channel, quartiles)
-        # v_quartiles = np.quantile(v_channel, quartiles)
-        return {
-            # "object_MeanRedLevel": bgr_mean[2][0],
-            # "object_MeanGreenLevel": bgr_mean[1][0],
-            # "object_MeanBlueLevel": bgr_mean[0][0],
-            # "object_StdRedLevel": bgr_stddev[2][0],
-            # "object_StdGreenLevel": bgr_stddev[1][0],
-            # "object_StdBlueLevel": bgr_stddev[0][0],
-            # "object_minRedLevel": r_quartiles[0],
-            # "object_Q05RedLevel": r_quartiles[1],
-            # "object_Q25RedLevel": r_quartiles[2],
-            # "object_Q50RedLevel": r_quartiles[3],
-            # "object_Q75RedLevel": r_quartiles[4],
-            # "object_Q95RedLevel": r_quartiles[5],
-            # "object_maxRedLevel": r_quartiles[6],
-            # "object_minGreenLevel": g_quartiles[0],
-            # "object_Q05GreenLevel": g_quartiles[1],
-            # "object_Q25GreenLevel": g_quartiles[2],
-            # "object_Q50GreenLevel": g_quartiles[3],
-            # "object_Q75GreenLevel": g_quartiles[4],
-            # "object_Q95GreenLevel": g_quartiles[5],
-            # "object_maxGreenLevel": g_quartiles[6],
-            # "object_minBlueLevel": b_quartiles[0],
-            # "object_Q05BlueLevel": b_quartiles[1],
-            # "object_Q25BlueLevel": b_quartiles[2],
-            # "object_Q50BlueLevel": b_quartiles[3],
-            # "object_Q75BlueLevel": b_quartiles[4],
-            # "object_Q95BlueLevel": b_quartiles[5],
-            # "object_maxBlueLevel": b_quartiles[6],
-            "MeanHue": h_mean,
-            "MeanSaturation": s_mean,
-            "MeanValue": v_mean,
-            "StdHue": h_stddev,
-            "StdSaturation": s_stddev,
-            "StdValue": v_stddev,
-            # "object_minHue": h_quartiles[0],
-            # "object_Q05Hue": h_quartiles[1],
-            # "object_Q25Hue": h_quartiles[2],
-            # "object_Q50Hue": h_quartiles[3],
-            # "object_Q75Hue": h_quartiles[4],
-            # "object_Q95Hue": h_quartiles[5],
-            # "object_maxHue": h_quartiles[6],
-            # "object_minSaturation": s_quartiles[0],
-            # "object_Q05Saturation": s_quartiles[1],
-            # "object_Q25Saturation": s_quartiles[2],
-            # "object_Q50Saturation": s_quartiles[3],
-            # "object_Q75Saturation": s_quartiles[4],
-            # "object_Q95Saturation": s_quartiles[5],
-            # "object_maxSaturation": s_quartiles[6],
-            # "object_minValue": v_quartiles[0],
-            # "object_Q05Value": v_quartiles[1],
-            # "object_Q25Value": v_quartiles[2],
-            # "object_Q50Value": v_quartiles[3],
-            # "object_Q75Value": v_quartiles[4],
-            # "object_Q95Value": v_quartiles[5],
-            # "object_maxValue": v_quartiles[6],
-        }
-
-    def _extract_metadata_from_regionprop(self, prop):
-        return {
-            "label": prop.label,
-            # width of the smallest rectangle enclosing the object
-            "width": prop.bbox[3] - prop.bbox[1],
-            # height of the smallest rectangle enclosing the object
-            "height": prop.bbox[2] - prop.bbox[0],
-            # X coordinates of the top left point of the smallest rectangle enclosing the object
-            "bx": prop.bbox[1],
-            # Y coordinates of the top left point of the smallest rectangle enclosing the object
-            "by": prop.bbox[0],
-            # circularity : (4∗π ∗Area)/Perim^2 a value of 1 indicates a perfect circle, a value approaching 0 indicates an increasingly elongated polygon
-            "circ.": (4 * np.pi * prop.filled_area) / prop.perimeter**2,
-            # Surface area of the object excluding holes, in square pixels (=Area*(1-(%area/100))
-            "area_exc": prop.area,
-            # Surface area of the object in square pixels
-            "area": prop.filled_area,
-            # Percentage of object’s surface area that is comprised of holes, defined as the background grey level
-            "%area": 1 - (prop.area / prop.filled_area),
-            # Primary axis of the best fitting ellipse for the object
-            "major": prop.major_axis_length,
-            # Secondary axis of the best fitting ellipse for the object
-            "minor": prop.minor_axis_length,
-            # Y position of the center of gravity of the object
-            "y": prop.centroid[0],
-            # X position of the center of gravity of the object
-            "x": prop.centroid[1],
-            # The area of the smallest polygon within which all points in the object fit
-            "convex_area": prop.convex_area,
-            # # Minimum grey value within the object (0 = black)
-            # "min": prop.min_intensity,
-            # # Maximum grey value within the object (255 = white)
-            # "max": prop.max_intensity,
-            # # Average grey value within the object ; sum of the grey values of all pixels in the object divided by the number of pixels
-            # "mean": prop.mean_intensity,
-            # # Integrated density. The sum of the grey values of the pixels in the object (i.e. = Area*Mean)
-            # "intden": prop.filled_area * prop.mean_intensity,
-            # The length of the outside boundary of the object
-            "perim.": prop.perimeter,
-            # major/minor
-            "elongation": np.divide(prop.major_axis_length, prop.minor_axis_length),
-            # max-min
-            # "range": prop.max_intensity - prop.min_intensity,
-            # perim/area_exc
-            "perimareaexc": prop.perimeter / prop.area,
-            # perim/major
-            "perimmajor": prop.perimeter / prop.major_axis_length,
-            # (4 ∗ π ∗ Area_exc)/perim 2
-            "circex": np.divide(4 * np.pi * prop.area, prop.perimeter**2),
-            # Angle between the primary axis and a line parallel to the x-axis of the image
-            "angle": prop.orientation / np.pi * 180 + 90,
-            # # X coordinate of the top left point of the image
-            # 'xstart': data_object['raw_img']['meta']['xstart'],
-            # # Y coordinate of the top left point of the image
-            # 'ystart': data_object['raw_img']['meta']['ystart'],
-            # Maximum feret diameter, i.e. the longest distance between any two points along the object boundary
-            # 'feret': data_object['raw_img']['meta']['feret'],
-            # feret/area_exc
-            # 'feretareaexc': data_object['raw_img']['meta']['feret'] / property.area,
-            # perim/feret
-            # 'perimferet': property.perimeter / data_object['raw_img']['meta']['feret'],
-            "bounding_box_area": prop.bbox_area,
-            "eccentricity": prop.eccentricity,
-            "equivalent_diameter": prop.equivalent_diameter,
-            "euler_number": prop.euler_number,
-            "extent": prop.extent,
-            "local_centroid_col": prop.local_centroid[1],
-            "local_centroid_row": prop.local_centroid[0],
-            "solidity": prop.solidity,
-        }
-
-    def _slice_image(self, img, name, mask, start_count=0):
-        """Slice a given image using give mask
+    def _checkpoint(self):
+        """Pauses or stops the segmentation between two images, when asked to
 
-        Args:
-            img (img array): Image to slice
-            name (string): name of the original image
-            mask (mask binary array): mask to use slice with
-            start_count (int, optional): count start to number the objects, so each one is unique. Defaults to 0.
-
-        Returns:
-            tuple: (Number of saved objects, original number of objects before size filtering)
+        Raises:
+            planktoscope.segmenter.worker.Cancelled: the segmentation was stopped
         """
+        if self.__job is not None:
+            self.__job.checkpoint()
 
-        def __augment_slice(dim_slice, max_dims, size=10):
-            # transform tuple in list
-            dim_slice = list(dim_slice)
-            # dim_slice[0] is the vertical component
-            # dim_slice[1] is the horizontal component
-            # dim_slice[1].start,dim_slice[0].start is the top left corner
-            for i in range(2):
-                if dim_slice[i].start < size:
-                    dim_slice[i] = slice(0, dim_slice[i].stop)
-                else:
-                    dim_slice[i] = slice(dim_slice[i].start - size, dim_slice[i].stop)
-
-            # dim_slice[1].stop,dim_slice[0].stop is the bottom right corner
-            for i in range(2):
-                if dim_slice[i].stop + size == max_dims[i]:
-                    dim_slice[i] = slice(dim_slice[i].start, max_dims[i])
-                else:
-                    dim_slice[i] = slice(dim_slice[i].start, dim_slice[i].stop + size)
-
-            # transform back list in tuple
-            dim_slice = tuple(dim_slice)
-            return dim_slice
-
-        labels, nlabels = skimage.measure.label(mask, return_num=True)
-        regionprops = skimage.measure.regionprops(labels)
-        regionprops_filtered = [
-            region
-            for region in regionprops
-            if region.equivalent_diameter_area >= self.__process_min_ESD
-        ]
-        object_number = len(regionprops_filtered)
-        logger.debug(f"Found {nlabels} labels, or {object_number} after size filtering")
-
-        for i, region in enumerate(regionprops_filtered):
-            region.label = i + start_count
-
-            # Publish the object_id to via MQTT to Node-RED
-            self.segmenter_client.client.publish(
-                "status/segmenter/object_id",
-                f'{{"object_id":"{region.label}"}}',
-            )
-
-            # First extract to get all the metadata about the image
-            obj_image = img[region.slice]
-            colors = self._get_color_info(obj_image, region.filled_image)
-            metadata = self._extract_metadata_from_regionprop(region)
-
-            # Calculate blur metric for this object (Laplacian variance)
-            blur_laplacian = planktoscope.segmenter.operations.calculate_blur(obj_image)
-            metadata["blur_laplacian"] = blur_laplacian
-
-            # Second extract to get a bigger image for saving
-            obj_image = img[__augment_slice(region.slice, labels.shape, 10)]
-            object_id = f"{name}_{i}"
-            object_fn = os.path.join(self.__working_obj_path, f"{object_id}.jpg")
-
-            self._save_image(obj_image, object_fn)
-
-            if self.__save_debug_img:
-                self._save_mask(
-                    region.filled_image,
-                    os.path.join(self.__working_debug_path, f"obj_{i}_mask.jpg"),
-                )
-
-            object_metadata = {
-                "name": f"{object_id}",
-                "metadata": {**metadata, **colors},
-            }
-
-            # publish metrics about the found object
-            self.segmenter_client.client.publish(
-                "status/segmenter/metric",
-                json.dumps(object_metadata, cls=planktoscope.segmenter.encoder.NpEncoder),
-            )
+    def _can_resume(self, state):
+        """Checks that the files recorded in the state of a segmentation are still there"""
+        store_filepath = os.path.join(
+            self.__working_obj_path, planktoscope.segmenter.objects.OBJECTS_FILENAME
+        )
+        if state["store"] and (
+            not os.path.exists(store_filepath) or os.path.getsize(store_filepath) < state["store"]
+        ):
+            return False
+        if state["archive"]:
+            # the archive is moved aside while it is resumed
+            for archive_filepath in (self.__archive_fn, f"{self.__archive_fn}.partial"):
+                if os.path.exists(archive_filepath):
+                    return os.path.getsize(archive_filepath) >= state["archive"]
+            return False
+        return True
 
-            if "objects" in self.__global_metadata:
-                self.__global_metadata["objects"].append(object_metadata)
-            else:
-                self.__global_metadata.update({"objects": [object_metadata]})
-
-        if self.__save_debug_img:
-            if object_number:
-                for region in regionprops_filtered:
-                    tagged_image = cv2.drawMarker(
-                        img,
-                        (int(region.centroid[1]), int(region.centroid[0])),
-                        (0, 0, 255),
-                        cv2.MARKER_CROSS,
-                    )
-                    tagged_image = cv2.rectangle(
-                        tagged_image,
-                        pt1=region.bbox[-3:-5:-1],
-                        pt2=region.bbox[-1:-3:-1],
-                        color=(150, 0, 200),
-                        thickness=1,
-                    )
-                    contours, hierarchy = cv2.findContours(
-                        np.uint8(region.image),
-                        mode=cv2.RETR_TREE,  # RETR_FLOODFILL or RETR_EXTERNAL
-                        method=cv2.CHAIN_APPROX_NONE,
-                    )
-                    tagged_image = cv2.drawContours(
-                        tagged_image,
-                        contours,
-                        -1,
-                        (238, 130, 238),
-                        thickness=1,
-                        offset=(region.bbox[1], region.bbox[0]),
-                    )
-                self._save_image(
-                    tagged_image,
-                    os.path.join(self.__working_debug_path, "tagged.jpg"),
-                )
-            else:
-                self._save_image(
-                    img,
-                    os.path.join(self.__working_debug_path, "tagged.jpg"),
-                )
-        return (object_number, len(regionprops))
+    def _frame_segmenter(self, ecotaxa_export):
+        """Returns the segmenter of the frames, with the settings of the segmentation"""
+        return planktoscope.segmenter.frame.FrameSegmenter(
+            debug=self.__debug,
+            process_min_ESD=self.__process_min_ESD,
+            remove_previous_mask=self.__remove_previous_mask,
+            extended_color_statistics=self.__extended_color_statistics,
+            # the objects images are added to the archive as they are segmented
+            archive_objects=ecotaxa_export,
+            keep_objects=self.__keep_objects,
+            memory_budget=self.__memory_budget * 2**20,
+            coarse_scale=self.__coarse_scale,
+        )
 
-    def _pipe(self, ecotaxa_export):
-        logger.info("Finding images")
-        images_list = self._find_files(self.__working_path, ("JPG", "jpg", "JPEG", "jpeg"))
+    def _pipe(self, ecotaxa_export, resume=True, follow=None):
+        if follow is None:
+            logger.info("Finding images")
+            images_list = self._find_files(self.__working_path, ("JPG", "jpg", "JPEG", "jpeg"))
+        else:
+            logger.info(f"Waiting for the first images of {self.__working_path}")
+            # the flat is made of the first images
+            follow.wait(planktoscope.segmenter.flat.FLAT_WINDOW, self._checkpoint)
+            images_list = list(follow.filenames)
 
         logger.debug(f"Images found are {images_list}")
         images_count = len(images_list)
@@ -551,145 +250,409 @@ class SegmenterProcess(multiprocessing.Process):
 
         first_start = time.monotonic()
         self.__mask_to_remove = None
+        planktoscope.segmenter.operations.reset_previous_mask()
         # average = 0
         total_objects = 0
         average_objects = 0
-        recalculate_flat = True
-        # TODO check image list here to find if a flat exists
-        # we recalculate the flat every 10 pictures
-        if recalculate_flat:
-            recalculate_flat = False
-            self.segmenter_client.client.publish(
-                "status/segmenter", '{"status":"Calculating flat"}'
-            )
-            if images_count < 10:
-                self._calculate_flat(images_list[0:images_count], images_count, self.__working_path)
-            else:
-                self._calculate_flat(images_list[0:10], 10, self.__working_path)
-
-            if self.__save_debug_img:
-                self._save_image(
-                    self.__flat,
-                    os.path.join(self.__working_debug_path, "flat_color.jpg"),
-                )
-
+        recalculate_flat = False
         average_time = 0
 
-        # TODO here would be a good place to parallelize the computation
-        for i, filename in enumerate(images_list):
-            name = os.path.splitext(filename)[0]
+        segmenter = self._frame_segmenter(ecotaxa_export)
 
-            # Publish the object_id to via MQTT to Node-RED
-            self.segmenter_client.client.publish(
-                "status/segmenter",
-                f'{{"status":"Segmenting image {filename}, image {i + 1}/{images_count}"}}',
+        workers = self.__workers
+        max_frames = self.__frames_in_flight
+        if self.__remove_previous_mask and (workers > 1 or max_frames > 1):
+            logger.warning(
+                "remove_previous_mask needs the mask of the previous image, we segment one image at a time"
             )
+            workers = 1
+            max_frames = 1
+        if workers > 1:
+            max_frames = 2 * workers
+
+        # the flat is the median of a window of images, which must be odd
+        flat_window = min(planktoscope.segmenter.flat.FLAT_WINDOW, images_count)
+        if not flat_window % 2:
+            flat_window -= 1
+
+        images_paths = [os.path.join(self.__working_path, filename) for filename in images_list]
+        flat_cache = planktoscope.segmenter.flat.FlatCache(
+            self.__flat_root, os.path.relpath(self.__working_path, self.__img_path)
+        )
 
-            # we recalculate the flat if the heuristics detected we should
-            if recalculate_flat:  # not i % 10 and i < (images_count - 10)
-                recalculate_flat = False
-                if len(images_list) == 10:
-                    # We are too close to the end of the list, take the previous 10 images instead of the next 10
-                    flat = self._calculate_flat(images_list, 10, self.__working_path)
-                elif i > (len(images_list) - 11):
-                    # We are too close to the end of the list, take the previous 10 images instead of the next 10
-                    flat = self._calculate_flat(images_list[i - 10 : i], 10, self.__working_path)
-                else:
-                    flat = self._calculate_flat(images_list[i : i + 10], 10, self.__working_path)  # noqa: F841
-                if self.__save_debug_img:
-                    self._save_image(
-                        self.__flat,
-                        os.path.join(
-                            os.path.dirname(self.__working_debug_path),
-                            f"flat_color_{i}.jpg",
-                        ),
+        # the progress is recorded after each image, to resume the segmentation if it stops
+        journal = planktoscope.segmenter.journal.Journal(self.__working_path)
+        journal_key = planktoscope.segmenter.journal.journal_key(
+            # the images of a followed acquisition are not known yet, they are only added
+            images_paths if follow is None else [],
+            {
+                "metadata": {
+                    key: value
+                    for key, value in self.__global_metadata.items()
+                    if key not in ("process_datetime", "process_uuid", "process_id")
+                },
+                "process_min_ESD": self.__process_min_ESD,
+                "remove_previous_mask": self.__remove_previous_mask,
+                "extended_color_statistics": self.__extended_color_statistics,
+                "save_debug_img": self.__debug.enabled,
+                "ecotaxa_export": ecotaxa_export,
+                "keep_objects": self.__keep_objects,
+                "flat_window": flat_window,
+                "follow": follow is not None,
+            },
+        )
+        # the journal file is closed if the segmentation fails or is stopped
+        with journal:
+            journal_entries = journal.load(journal_key) if resume else None
+            # state of the segmentation after the last image segmented
+            state = None
+            if journal_entries is None:
+                journal.start(
+                    {
+                        "key": journal_key,
+                        "process_datetime": self.__global_metadata["process_datetime"],
+                        "process_uuid": self.__global_metadata["process_uuid"],
+                        "process_id": self.__global_metadata["process_id"],
+                    }
+                )
+            else:
+                header, state = journal_entries
+                if state is not None and not self._can_resume(state):
+                    logger.warning(
+                        "The files of the interrupted segmentation are missing, starting over"
                     )
-
-            self.__working_debug_path = os.path.join(
-                self.__debug_objects_root,
-                self.__working_path.split(self.__img_path)[1].strip(),
-                name,
+                    state = None
+                # the resumed segmentation is the one that was interrupted
+                for key in ("process_datetime", "process_uuid", "process_id"):
+                    self.__global_metadata[key] = header[key]
+
+            # index of the first image to segment
+            start = 0
+            # first image of the window of the flat in use
+            flat_first = 0
+            if state is not None:
+                start = state["frame"]
+                logger.info(f"Resuming the segmentation at image {start + 1}/{images_count}")
+                total_objects = state["objects"]
+                average_objects = state["average_objects"]
+                average_time = state["average_time"]
+                recalculate_flat = state["recalculate_flat"]
+                flat_first = state["flat"]
+            # the images and objects of this run, without the ones of the interrupted segmentation
+            first_image = start
+            first_objects = total_objects
+
+            flat_key = flat_cache.key(images_paths[flat_first : flat_first + flat_window])
+            self.__flat = flat_cache.load(flat_key)
+            # the previous image is segmented again for remove_previous_mask
+            prime_mask = self.__remove_previous_mask and start > 0
+            first_frame = max(0, min(start - prime_mask, images_count - flat_window))
+
+            # the mask of an image depends on the previous one with remove_previous_mask
+            stage_cache = None
+            if self.__cache and not self.__remove_previous_mask:
+                stage_cache = planktoscope.segmenter.cache.StageCache(self.__cache_root)
+            segmenter.cache = stage_cache
+
+            def cache_key(index):
+                """Returns the key of an image in the stages cache, with the flat in use"""
+                if stage_cache is None:
+                    return None
+                return planktoscope.segmenter.cache.frame_key(images_paths[index], flat_key)
+
+            # the images are decoded once, for the flat and for the segmentation, and not at all
+            # when their objects are restored from the stages cache, only the images in flight
+            # are decoded ahead, the window of a flat is decoded when the flat is made
+            reader = planktoscope.segmenter.pipeline.FrameReader(
+                images_paths,
+                lookahead=max_frames,
+                start=first_frame if self.__flat is not None else min(first_frame, flat_first),
+                skip=(lambda index: segmenter.restorable(index, cache_key(index)))
+                if stage_cache is not None
+                else None,
             )
 
-            logger.debug(f"The debug objects path is {self.__working_debug_path}")
-            # Create the debug objects path if needed
-            if self.__save_debug_img:
-                # create the path!
-                os.makedirs(self.__working_debug_path, exist_ok=True)
-
-            start = time.monotonic()
-            logger.info(f"Starting work on {name}, image {i + 1}/{images_count}")
-
-            img = self._open_and_apply_flat(
-                os.path.join(self.__working_path, images_list[i]), self.__flat
-            )
+            def available(count):
+                """Returns the number of images, waiting for count images of a followed one"""
+                if follow is not None:
+                    follow.wait(count, checkpoint)
+                    filepaths = [
+                        os.path.join(self.__working_path, filename)
+                        for filename in follow.filenames[len(images_list) :]
+                    ]
+                    images_list.extend(follow.filenames[len(images_list) :])
+                    images_paths.extend(filepaths)
+                    reader.extend(filepaths)
+                return len(images_list)
+
+            with reader:
+                self.segmenter_client.client.publish(
+                    "status/segmenter", '{"status":"Calculating flat"}'
+                )
+                # the median is only made when a flat is not in the cache
+                if self.__flat is None:
+                    self.__flat = planktoscope.segmenter.flat.median(
+                        [reader.get(k)[0] for k in range(flat_first, flat_first + flat_window)]
+                    )
+                    flat_cache.save(flat_key, self.__flat)
+                    reader.release(first_frame)
+                segmenter.flat = self.__flat
 
-            # logger.debug(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
-            # logger.debug(time.monotonic() - start)
+                if self.__debug.enabled and start == 0:
+                    self._save_image(
+                        self.__flat,
+                        os.path.join(self.__working_debug_path, "flat_color.jpg"),
+                    )
 
-            # start = time.monotonic()
-            # logger.debug(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
+                # the images are written in the background, the workers of a pool write theirs
+                writer = planktoscope.segmenter.writer.ImageWriter(self.__writers)
+                if workers > 1:
+                    logger.info(f"Segmenting the images with {workers} workers")
+                    runner = planktoscope.segmenter.pipeline.PoolPipeline(
+                        segmenter, workers, max_frames
+                    )
+                else:
+                    segmenter.writer = writer
+                    runner = planktoscope.segmenter.pipeline.Pipeline(segmenter, max_frames)
+                    runner.stats.add_stage(writer.stats)
+
+                publisher = planktoscope.segmenter.publisher.Publisher(
+                    self.segmenter_client.client,
+                    progress_interval=self.__progress_interval,
+                    metrics_interval=self.__metrics_interval,
+                    per_object=self.__publish_objects,
+                )
 
-            mask = self._create_mask(img, self.__working_debug_path)
+                # the metadata of the objects are kept as columns, on disk for long acquisitions
+                objects_store = planktoscope.segmenter.objects.ObjectStore.restore(
+                    self.__working_obj_path,
+                    planktoscope.segmenter.objects.OBJECTS_FILENAME,
+                    state["store"] if state is not None else 0,
+                )
 
-            # logger.debug(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
-            # logger.debug(time.monotonic() - start)
+                archive = None
+                if ecotaxa_export:
+                    archive = planktoscope.segmenter.ecotaxa.EcotaxaArchive(
+                        self.__archive_fn, state["archive"] if state is not None else None
+                    )
 
-            # start = time.monotonic()
-            # logger.debug(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
+                if prime_mask:
+                    # the mask of the previous image is removed from the next one
+                    previous = planktoscope.segmenter.frame.Frame(
+                        start - 1,
+                        images_paths[start - 1],
+                        os.path.splitext(images_list[start - 1])[0],
+                        self.__working_obj_path,
+                        self.__working_debug_path,
+                    )
+                    previous.image = reader.get(start - 1)[0]
+                    for stage in ("correct", "mask"):
+                        previous = segmenter.run_stage(stage, previous)
+
+                # state of the segmentation after the last image segmented, and the number of images
+                # it was saved after, see save_progress
+                progress = None
+                saved = start
+
+                def save_progress():
+                    """Records the progress in the journal, the files it refers to reach the disk"""
+                    journal.commit(
+                        dict(
+                            progress,
+                            store=objects_store.checkpoint(),
+                            archive=archive.checkpoint() if archive is not None else None,
+                        )
+                    )
 
-            objects_count, _ = self._slice_image(img, name, mask, total_objects)
-            total_objects += objects_count
-            # Simple heuristic to detect a movement of the flow cell and a change in the resulting flat
-            # TODO: this heuristic should be improved or removed if deemed unnecessary
-            if average_objects != 0 and objects_count > average_objects + 20:
-                # FIXME: this should force a new slice of the current image
-                logger.debug(
-                    f"We need to recalculate a flat since we have {objects_count} new objects instead of the average of {average_objects}"
-                )
-                recalculate_flat = True
-            average_objects = (average_objects * i + objects_count) / (i + 1)
+                def checkpoint():
+                    """Pauses or stops the segmentation between two images, see _checkpoint
 
-            # logger.debug(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
-            # logger.debug(time.monotonic() - start)
-            delay = time.monotonic() - start
-            average_time = (average_time * i + delay) / (i + 1)
+                    The progress is saved before it stops, so the images segmented since the last
+                    save are not segmented again.
+                    """
+                    try:
+                        self._checkpoint()
+                    except planktoscope.segmenter.worker.Cancelled:
+                        if progress is not None and progress["frame"] > saved:
+                            save_progress()
+                        raise
+
+                with writer, runner, archive or contextlib.nullcontext():
+                    # index of the next image to submit to the pipeline
+                    submitted = start
+                    for i in itertools.count(start):
+                        # the images before are recorded in the journal, the segmentation can stop
+                        checkpoint()
+                        # the images of a followed acquisition are segmented as they are saved
+                        images_count = available(i + 1)
+                        if i == images_count:
+                            break
+                        filename = images_list[i]
+                        name = os.path.splitext(filename)[0]
+
+                        # Publish the progress to via MQTT to Node-RED
+                        publisher.progress(
+                            f'{{"status":"Segmenting image {filename}, image {i + 1}/{images_count}"}}'
+                        )
+
+                        # we recalculate the flat if the heuristics detected we should
+                        if recalculate_flat:
+                            recalculate_flat = False
+                            # the window holds the next images, or the last ones at the end
+                            flat_first = min(i, available(i + flat_window) - flat_window)
+                            logger.info(
+                                f"Using the median of the images {flat_first} to {flat_first + flat_window - 1} as flat"
+                            )
+                            flat_key = flat_cache.key(
+                                images_paths[flat_first : flat_first + flat_window]
+                            )
+                            self.__flat = flat_cache.load(flat_key)
+                            if self.__flat is None:
+                                # the next images of the window are kept until they are segmented
+                                self.__flat = planktoscope.segmenter.flat.median(
+                                    [
+                                        reader.get(k)[0]
+                                        for k in range(flat_first, flat_first + flat_window)
+                                    ]
+                                )
+                                flat_cache.save(flat_key, self.__flat)
+                            if self.__debug.enabled:
+                                self._save_image(
+                                    self.__flat,
+                                    os.path.join(
+                                        os.path.dirname(self.__working_debug_path),
+                                        f"flat_color_{i}.jpg",
+                                    ),
+                                )
+                            # the images in flight used the previous flat, they are submitted again
+                            runner.set_flat(self.__flat)
+                            submitted = i
+
+                        # keep the pipeline busy with the next images, without loading all of them
+                        while submitted < min(i + runner.max_frames, images_count):
+                            next_name = os.path.splitext(images_list[submitted])[0]
+                            next_frame = planktoscope.segmenter.frame.Frame(
+                                submitted,
+                                os.path.join(self.__working_path, images_list[submitted]),
+                                next_name,
+                                self.__working_obj_path,
+                                self._get_debug_path(next_name),
+                            )
+                            next_frame.cache_key = cache_key(submitted)
+                            if not segmenter.restore(next_frame):
+                                next_frame.image, next_frame.timings["decode"] = reader.get(
+                                    submitted
+                                )
+                            runner.submit(next_frame)
+                            submitted += 1
+
+                        logger.info(f"Starting work on {name}, image {i + 1}/{images_count}")
+                        frame = runner.get()
+                        if stage_cache is not None:
+                            stage_cache.use(frame.cache_results)
+                        self.__working_debug_path = frame.debug_path
+                        logger.debug(f"The debug objects path is {self.__working_debug_path}")
+
+                        start = time.monotonic()
+                        objects = frame.objects
+                        objects_count = len(objects)
+                        for object_metadata in objects:
+                            # objects are numbered from 0 in each image, make their label unique
+                            object_metadata["metadata"]["label"] += total_objects
+                        # publish metrics about the found objects
+                        publisher.objects(objects)
+
+                        objects_store.append(frame.name, objects)
+                        if archive is not None:
+                            for filename, data in frame.archived:
+                                archive.add_image(filename, data)
+                            frame.archived = []
+                        runner.stats.stages["publish"].add(time.monotonic() - start)
+
+                        total_objects += objects_count
+                        # Simple heuristic to detect a movement of the flow cell and a change in the resulting flat
+                        # TODO: this heuristic should be improved or removed if deemed unnecessary
+                        if average_objects != 0 and objects_count > average_objects + 20:
+                            # FIXME: this should force a new slice of the current image
+                            logger.debug(
+                                f"We need to recalculate a flat since we have {objects_count} new objects instead of the average of {average_objects}"
+                            )
+                            recalculate_flat = True
+                        average_objects = (average_objects * i + objects_count) / (i + 1)
+
+                        delay = frame.duration
+                        average_time = (average_time * i + delay) / (i + 1)
+                        logger.success(
+                            f"Work on {name} is OVER! Done in {delay}s, average time is {average_time}s, average number of objects is {average_objects}"
+                        )
+                        logger.success(
+                            f"We also found {objects_count} objects in this image, at a rate of {objects_count / delay} objects per second"
+                        )
+                        logger.success(f"So far we found {total_objects} objects")
+
+                        # the images before the window of a flat made near the end are decoded again
+                        reader.release(i + 1)
+
+                        progress = {
+                            "frame": i + 1,
+                            "objects": total_objects,
+                            "average_objects": average_objects,
+                            "average_time": average_time,
+                            "recalculate_flat": recalculate_flat,
+                            "flat": flat_first,
+                        }
+                        # each save adds a chunk to the objects file, so the progress is saved every
+                        # few images, the images after it are segmented again after a crash
+                        if (
+                            i + 1 - saved >= planktoscope.segmenter.journal.CHECKPOINT_FRAMES
+                            or objects_store.memory
+                            >= planktoscope.segmenter.journal.CHECKPOINT_MEMORY
+                        ):
+                            save_progress()
+                            saved = i + 1
+
+                    writer.flush()
+                    publisher.flush()
+
+                    if archive is not None and len(objects_store):
+                        # the table comes last, once all the objects are known
+                        archive.write_table(
+                            self.__global_metadata,
+                            objects_store,
+                            self.__working_obj_path if self.__keep_objects else None,
+                        )
+
+                runner.stats.log()
+
+            total_duration = (time.monotonic() - first_start) / 60
             logger.success(
-                f"Work on {name} is OVER! Done in {delay}s, average time is {average_time}s, average number of objects is {average_objects}"
+                f"{images_count} images done in {total_duration} minutes, or an average of {average_time}s per image or {total_duration * 60 / images_count}s per image"
             )
             logger.success(
-                f"We also found {objects_count} objects in this image, at a rate of {objects_count / delay} objects per second"
+                f"We also found {total_objects} objects, or an average of {total_objects / (total_duration * 60)}objects per second"
             )
-            logger.success(f"So far we found {total_objects} objects")
 
-        total_duration = (time.monotonic() - first_start) / 60
-        logger.success(
-            f"{images_count} images done in {total_duration} minutes, or an average of {average_time}s per image or {total_duration * 60 / images_count}s per image"
-        )
-        logger.success(
-            f"We also found {total_objects} objects, or an average of {total_objects / (total_duration * 60)}objects per second"
-        )
-
-        if ecotaxa_export:
-            if "objects" in self.__global_metadata:
-                if planktoscope.segmenter.ecotaxa.ecotaxa_export(
-                    self.__archive_fn,
-                    self.__global_metadata,
-                    self.__working_obj_path,
-                    keep_files=True,
-                ):
-                    logger.success("Ecotaxa archive export completed for this folder")
+            with objects_store:
+                if ecotaxa_export:
+                    if len(objects_store):
+                        logger.success("Ecotaxa archive export completed for this folder")
+                    else:
+                        os.remove(self.__archive_fn)
+                        logger.info("There are no objects to export")
                 else:
-                    logger.error("The ecotaxa export could not be completed")
-            else:
-                logger.info("There are no objects to export")
-        else:
-            logger.info("We are not creating the ecotaxa output archive for this folder")
+                    logger.info("We are not creating the ecotaxa output archive for this folder")
+            journal.remove()
 
         # cleanup
         # we're done free some mem
         self.__flat = None
 
+        return {
+            "images": images_count - first_image,
+            "objects": total_objects - first_objects,
+            "duration": total_duration * 60,
+        }
+
     def segment_all(self, paths: list, force=False, ecotaxa_export=True):
         """Starts the segmentation in all the folders given recursively
 
@@ -698,11 +661,10 @@ class SegmenterProcess(multiprocessing.Process):
             force (bool, optional): force the rework on all paths given. Defaults to False.
             ecotaxa_export (bool, optional): generates ecotaxa export data. Defaults to True.
         """
-        img_paths = []
-        for path in paths:
-            for x in os.walk(path):
-                if x[0] not in img_paths:
-                    img_paths.append(x[0])
+        # only the folders modified since the last segmentation are listed
+        acquisitions = self.__catalog.acquisitions(paths)
+        logger.info(f"{len(acquisitions)} acquisitions found in {paths}")
+        img_paths = [path for path, segmented in acquisitions if force or not segmented]
         self.segment_list(img_paths, force, ecotaxa_export)
 
     def segment_list(self, path_list: list, force=False, ecotaxa_export=True):
@@ -716,33 +678,49 @@ class SegmenterProcess(multiprocessing.Process):
         logger.info(f"The pipeline will be run in {len(path_list)} directories")
         logger.debug(f"Those are {path_list}")
 
-        self.__process_uuid = str(uuid4())
-
-        if self.__process_id == "":
-            self.__process_id = self.__process_uuid
-
-        logger.info(f"The process_uuid of this run is {self.__process_uuid}")
-        logger.info(f"The process_id of this run is {self.__process_id}")
+        self._new_process()
         exception = None
+        interrupted = False
+
+        # whether the folders are segmented, for the ones with a metadata.json
+        acquisitions = dict(self.__catalog.acquisitions(path_list, recursive=False))
 
         for path in path_list:
+            try:
+                self._checkpoint()
+            except planktoscope.segmenter.worker.Cancelled:
+                interrupted = True
+                break
             logger.debug(f"{path}: Checking for the presence of metadata.json")
-            if os.path.exists(os.path.join(path, "metadata.json")):
+            if os.path.abspath(path) in acquisitions:
                 # The file exists, let's check if we force or not
                 # we also need to check for the presence of done.txt in each folder
                 logger.debug(f"{path}: Checking for the presence of done.txt or forcing({force})")
-                if os.path.exists(os.path.join(path, "done.txt")) and not force:
+                if acquisitions[os.path.abspath(path)] and not force:
                     logger.debug(f"Moving to the next folder, {path} has already been segmented")
                 else:
                     # forcing, let's gooooo
                     try:
-                        self.segment_path(path, ecotaxa_export)
+                        # an interrupted segmentation is resumed, unless we force
+                        follow = None
+                        if self.__follow:
+                            follow = planktoscope.segmenter.follow.AcquisitionWatcher(
+                                path, self.__imager_client, self.__follow_timeout
+                            )
+                        self.segment_path(path, ecotaxa_export, resume=not force, follow=follow)
+                    except planktoscope.segmenter.worker.Cancelled:
+                        logger.info(f"The segmentation of {path} has been interrupted")
+                        interrupted = True
+                        break
                     except Exception as e:
                         logger.error(f"There was an error while segmenting {path}")
                         exception = e
             else:
                 logger.debug(f"Moving to the next folder, {path} has no metadata.json")
-        if exception is None:
+        if interrupted:
+            # Publish the status "Interrupted" to via MQTT to Node-RED
+            self.segmenter_client.client.publish("status/segmenter", '{"status":"Interrupted"}')
+        elif exception is None:
             # Publish the status "Done" to via MQTT to Node-RED
             self.segmenter_client.client.publish("status/segmenter", '{"status":"Done"}')
         else:
@@ -753,12 +731,46 @@ class SegmenterProcess(multiprocessing.Process):
         # Reset process_id
         self.__process_id = ""
 
-    def segment_path(self, path, ecotaxa_export):
+    def _new_process(self):
+        """Starts a new process, the acquisitions segmented until the next one share its uuid"""
+        self.__process_uuid = str(uuid4())
+
+        if self.__process_id == "":
+            self.__process_id = self.__process_uuid
+
+        logger.info(f"The process_uuid of this run is {self.__process_uuid}")
+        logger.info(f"The process_id of this run is {self.__process_id}")
+
+    def segment_path(self, path, ecotaxa_export, resume=True, follow=None):
         """Starts the segmentation in the given path
 
         Args:
             path (string): path of folder to do segmentation in
+            resume (bool, optional): resume an interrupted segmentation of this folder. Defaults
+                to True.
+            follow (planktoscope.segmenter.follow.AcquisitionWatcher, optional): watcher of the
+                acquisition in progress in this folder, its images are segmented as they are
+                saved. Defaults to None.
         """
+        self._prepare_path(path)
+
+        logger.info(f"Starting the pipeline in {path}")
+
+        try:
+            summary = self._pipe(ecotaxa_export, resume, follow)
+        except planktoscope.segmenter.worker.Cancelled:
+            raise
+        except Exception as e:
+            logger.exception(f"There was an error in the pipeline {e}")
+            raise e
+
+        self._finish_path()
+        self.summaries.append(dict(summary, path=self.__working_path))
+
+        return True
+
+    def _prepare_path(self, path):
+        """Loads the metadata of the acquisition in the given path, and makes its folders"""
         logger.info(f"Loading the metadata file for {path}")
         with open(os.path.join(path, "metadata.json"), "r") as config_file:
             self.__global_metadata = json.load(config_file)
@@ -840,26 +852,498 @@ class SegmenterProcess(multiprocessing.Process):
 
         # Create the paths
         for path in [self.__working_obj_path, self.__working_debug_path]:
-            if not os.path.exists(path):
-                # create the path!
-                os.makedirs(path)
+            # the workers of a distributed segmentation create the paths of an acquisition too
+            os.makedirs(path, exist_ok=True)
 
         logger.debug(f"The archive folder is {self.__archive_fn}")
 
-        logger.info(f"Starting the pipeline in {path}")
-
-        try:
-            self._pipe(ecotaxa_export)
-        except Exception as e:
-            logger.exception(f"There was an error in the pipeline {e}")
-            raise e
-
+    def _finish_path(self):
+        """Marks the acquisition being segmented as segmented"""
         # Add file 'done' to path to mark the folder as already segmented
         with open(os.path.join(self.__working_path, "done.txt"), "w") as done_file:
             done_file.writelines(datetime.datetime.utcnow().isoformat())
-        logger.info(f"Pipeline has been run for {path}")
+        self.__catalog.refresh([self.__working_path], recursive=False)
+        logger.info(f"Pipeline has been run for {self.__working_path}")
 
-        return True
+    def segment_unit(self, path, unit, flat, result_path):
+        """Segments the images of a work unit of a distributed segmentation, see distributed
+
+        The objects of the unit are saved in result_path, to be merged with the ones of the other
+        units of the acquisition, see merge_units: their metadata in an ObjectStore file and their
+        images for the EcoTaxa archive in a zip file. The debug images and the objects images kept
+        on disk are saved in the data path, as usual.
+
+        Args:
+            path (str): folder of the acquisition
+            unit (dict): the unit, see distributed.split
+            flat (array): flat of the unit, see distributed.unit_flat
+            result_path (str): folder of the result of the unit
+
+        Returns:
+            dict: the images and objects segmented, the time spent and the size of the objects
+                file, see ObjectStore.checkpoint
+        """
+        self._prepare_path(path)
+        logger.info(f"Segmenting the unit {unit['id']} of {path}")
+        start_time = time.monotonic()
+        ecotaxa_export = unit["ecotaxa"]
+        planktoscope.segmenter.operations.reset_previous_mask()
+        segmenter = self._frame_segmenter(ecotaxa_export)
+        segmenter.flat = flat
+        if self.__debug.enabled:
+            # named as the flats calculated again by _pipe, after the first image they are used on
+            self._save_image(
+                flat,
+                os.path.join(
+                    self.__working_debug_path,
+                    f"flat_color_{unit['first']}.jpg" if unit["first"] else "flat_color.jpg",
+                ),
+            )
+
+        # the mask of an image depends on the previous one with remove_previous_mask
+        max_frames = 1 if self.__remove_previous_mask else self.__frames_in_flight
+        images_list = unit["images"]
+        images_paths = [os.path.join(path, filename) for filename in images_list]
+
+        if self.__remove_previous_mask and unit["previous"] is not None:
+            # the mask of the last image of the previous unit is removed from the first one
+            previous_name = os.path.splitext(unit["previous"])[0]
+            previous = planktoscope.segmenter.frame.Frame(
+                unit["first"] - 1,
+                os.path.join(path, unit["previous"]),
+                previous_name,
+                self.__working_obj_path,
+                self._get_debug_path(previous_name),
+            )
+            for stage in ("decode", "correct", "mask"):
+                previous = segmenter.run_stage(stage, previous)
+
+        total_objects = 0
+        objects_store = planktoscope.segmenter.objects.ObjectStore(
+            result_path, filename=planktoscope.segmenter.workqueue.RESULT_OBJECTS_FILENAME
+        )
+        archive = None
+        if ecotaxa_export:
+            archive = planktoscope.segmenter.ecotaxa.EcotaxaArchive(
+                os.path.join(result_path, planktoscope.segmenter.workqueue.RESULT_ARCHIVE_FILENAME)
+            )
+        reader = planktoscope.segmenter.pipeline.FrameReader(images_paths, lookahead=max_frames)
+        writer = planktoscope.segmenter.writer.ImageWriter(self.__writers)
+        segmenter.writer = writer
+        runner = planktoscope.segmenter.pipeline.Pipeline(segmenter, max_frames)
+        runner.stats.add_stage(writer.stats)
+        with reader, writer, runner, archive or contextlib.nullcontext():
+            submitted = 0
+            for i in range(len(images_list)):
+                while submitted < min(i + runner.max_frames, len(images_list)):
+                    next_name = os.path.splitext(images_list[submitted])[0]
+                    next_frame = planktoscope.segmenter.frame.Frame(
+                        # the index in the acquisition, for the debug images kept
+                        unit["first"] + submitted,
+                        images_paths[submitted],
+                        next_name,
+                        self.__working_obj_path,
+                        self._get_debug_path(next_name),
+                    )
+                    next_frame.image, next_frame.timings["decode"] = reader.get(submitted)
+                    runner.submit(next_frame)
+                    submitted += 1
+
+                frame = runner.get()
+                # the labels are made unique in the acquisition when the units are merged
+                objects_store.append(frame.name, frame.objects)
+                if archive is not None:
+                    for filename, data in frame.archived:
+                        archive.add_image(filename, data)
+                    frame.archived = []
+                total_objects += len(frame.objects)
+                reader.release(i + 1)
+            writer.flush()
+        runner.stats.log()
+
+        # the file is kept for the coordinator
+        store_size = objects_store.checkpoint()
+        objects_store.close(remove=False)
+        duration = time.monotonic() - start_time
+        logger.success(
+            f"The unit {unit['id']} is done, {total_objects} objects found in {duration}s"
+        )
+        return {
+            "images": len(images_list),
+            "objects": total_objects,
+            "duration": duration,
+            "store": store_size,
+        }
+
+    def merge_units(self, path, results, ecotaxa_export):
+        """Merges the results of the units of an acquisition into its EcoTaxa archive
+
+        The labels of the objects are made unique in the acquisition, and the objects images and
+        the table are written to its EcoTaxa archive. The acquisition is then segmented.
+
+        Args:
+            path (str): folder of the acquisition
+            results (list): folder of the result of each unit and the result, see segment_unit,
+                in the order of their images
+            ecotaxa_export (bool): write the EcoTaxa archive
+
+        Returns:
+            dict: the images and objects of the acquisition, with the time spent merging them
+        """
+        if not self.__process_uuid:
+            self._new_process()
+        self._prepare_path(path)
+        logger.info(f"Merging the {len(results)} units of {path}")
+        start_time = time.monotonic()
+
+        images_count = 0
+        total_objects = 0
+        objects_store = planktoscope.segmenter.objects.ObjectStore(self.__working_obj_path)
+        archive = None
+        if ecotaxa_export:
+            archive = planktoscope.segmenter.ecotaxa.EcotaxaArchive(self.__archive_fn)
+        with objects_store:
+            with archive or contextlib.nullcontext():
+                for result_path, result in results:
+                    images_count += result["images"]
+                    unit_store = planktoscope.segmenter.objects.ObjectStore.restore(
+                        result_path,
+                        planktoscope.segmenter.workqueue.RESULT_OBJECTS_FILENAME,
+                        result["store"],
+                    )
+                    with unit_store:
+                        for frame_name, objects in unit_store.by_frame():
+                            for object_metadata in objects:
+                                # objects are numbered from 0 in each image, make their label unique
+                                object_metadata["metadata"]["label"] += total_objects
+                            objects_store.append(frame_name, objects)
+                            total_objects += len(objects)
+                    if archive is not None:
+                        with zipfile.ZipFile(
+                            os.path.join(
+                                result_path,
+                                planktoscope.segmenter.workqueue.RESULT_ARCHIVE_FILENAME,
+                            )
+                        ) as unit_archive:
+                            for filename in unit_archive.namelist():
+                                archive.add_image(filename, unit_archive.read(filename))
+
+                if archive is not None and len(objects_store):
+                    archive.write_table(
+                        self.__global_metadata,
+                        objects_store,
+                        self.__working_obj_path if self.__keep_objects else None,
+                    )
+            if ecotaxa_export and not len(objects_store):
+                os.remove(self.__archive_fn)
+                logger.info("There are no objects to export")
+
+        self._finish_path()
+        summary = {
+            "images": images_count,
+            "objects": total_objects,
+            "duration": time.monotonic() - start_time,
+            "path": self.__working_path,
+        }
+        self.summaries.append(summary)
+        return summary
+
+    def configure(self, settings):
+        """Reads the settings of the segmentation of a segment message
+
+        Args:
+            settings (dict): settings of the message, the missing ones get their default value
+        """
+        # keep debug images, all of them or a tier, for some of the images
+        self.__debug = planktoscope.segmenter.debug.DebugImages(
+            planktoscope.segmenter.debug.parse_tier(settings.get("keep", True)),
+            every=int(settings.get("debug_every", 1)),
+            objects=int(settings.get("debug_objects", 0)),
+            scale=int(settings.get("debug_scale", 4)),
+        )
+
+        if "process_id" in settings:
+            self.__process_id = settings["process_id"]
+
+        self.__process_min_ESD = settings.get("process_min_ESD", 20)
+
+        self.__remove_previous_mask = settings.get("remove_previous_mask", False)
+
+        self.__extended_color_statistics = settings.get("extended_color_statistics", False)
+
+        # number of images segmented at the same time
+        self.__workers = max(1, int(settings.get("workers", 1)))
+
+        # number of images in flight in the pipeline, this bounds the memory used
+        self.__frames_in_flight = max(1, int(settings.get("frames_in_flight", 3)))
+
+        # number of images written at the same time
+        self.__writers = max(1, int(settings.get("writers", 2)))
+
+        # the images too big for this budget are segmented in bands
+        self.__memory_budget = max(0, int(settings.get("memory_budget", 0)))
+
+        # the mask is only made around the objects found on the downscaled images
+        self.__coarse_scale = max(0, int(settings.get("coarse_scale", 0)))
+
+        # rate of the MQTT progress updates and metrics batches
+        self.__progress_interval = float(settings.get("progress_interval", 1))
+        self.__metrics_interval = float(settings.get("metrics_interval", 1))
+        self.__publish_objects = settings.get("publish_objects", False)
+
+        # also keep the objects images on disk when they are in the EcoTaxa archive
+        self.__keep_objects = settings.get("keep_objects", True)
+
+        # save the results of the stages, to segment the images again with other
+        # parameters
+        self.__cache = settings.get("cache", False)
+
+        # segment the images of an acquisition in progress as they are saved
+        self.__follow = settings.get("follow", False)
+        self.__follow_timeout = float(settings.get("follow_timeout", 600))
+
+    def _segment(self, job):
+        """Runs the segmentation asked by a segment message, in the worker
+
+        Args:
+            job (planktoscope.segmenter.worker.Job): job of the segmentation
+        """
+        last_message = job.message
+        self.__job = job
+        try:
+            if "settings" in last_message:
+                settings = last_message["settings"]
+
+                # force rework of already done folder
+                force = settings.get("force", False)
+
+                # parse folders recursively starting from the given parameter
+                recursive = settings.get("recursive", True)
+
+                # generate ecotaxa output archive
+                ecotaxa_export = settings.get("ecotaxa", True)
+
+                self.configure(settings)
+
+            path = last_message["path"] if "path" in last_message else None
+            if isinstance(path, str):
+                # a single folder
+                path = [path]
+
+            if self.__follow:
+                self._follow(path, force, ecotaxa_export)
+                return
+
+            # Publish the status "Started" to via MQTT to Node-RED
+            self.segmenter_client.client.publish("status/segmenter", '{"status":"Started"}')
+            if path:
+                if recursive:
+                    self.segment_all(path, force, ecotaxa_export)
+                else:
+                    self.segment_list(path, force, ecotaxa_export)
+            else:
+                self.segment_all([self.__img_path], force, ecotaxa_export)
+        finally:
+            self.__job = None
+
+    def run_job(self, job, client):
+        """Runs a job in this process, without the MQTT control loop, see batch
+
+        Args:
+            job (planktoscope.segmenter.worker.Job): job to run, it is started here
+            client (planktoscope.segmenter.batch.LocalClient): client the status updates are
+                published to, instead of the MQTT client
+        """
+        self.open_locally(client)
+        job.start()
+        try:
+            self._run_job(job)
+        finally:
+            job.finish()
+            self.close_locally()
+
+    def open_locally(self, client):
+        """Prepares this process to segment without the MQTT control loop, see batch
+
+        Args:
+            client (planktoscope.segmenter.batch.LocalClient): client the status updates are
+                published to, instead of the MQTT client
+        """
+        self.segmenter_client = client
+        self.__catalog = planktoscope.segmenter.catalog.Catalog(self.__catalog_fn)
+
+    def close_locally(self):
+        self.__catalog.close()
+        self.__catalog = None
+
+    def _run_job(self, job):
+        """Runs a job of the worker, a segmentation or a parameters sweep"""
+        if job.message.get("action") == "sweep":
+            self._sweep(job)
+        else:
+            self._segment(job)
+
+    def _sweep(self, job):
+        """Runs the parameters sweep asked by a sweep message, in the worker
+
+        Args:
+            job (planktoscope.segmenter.worker.Job): job of the sweep
+        """
+        last_message = job.message
+        self.__job = job
+        try:
+            settings = last_message.get("settings", {})
+            path = last_message.get("path")
+            # Publish the status "Started" to via MQTT to Node-RED
+            self.segmenter_client.client.publish("status/segmenter", '{"status":"Started"}')
+            try:
+                report = self.sweep_path(
+                    path,
+                    settings.get("variants", [{}]),
+                    images=max(0, int(settings.get("images", 0))),
+                    progress_interval=float(settings.get("progress_interval", 1)),
+                )
+            except planktoscope.segmenter.worker.Cancelled:
+                logger.info(f"The sweep of {path} has been interrupted")
+                self.segmenter_client.client.publish("status/segmenter", '{"status":"Interrupted"}')
+                return
+            except Exception as e:
+                logger.exception(f"There was an error while sweeping {path}")
+                self.segmenter_client.client.publish(
+                    "status/segmenter",
+                    f'{{"status":"An exception was raised during the sweep: {e}."}}',
+                )
+                return
+            self.segmenter_client.client.publish("status/segmenter/sweep", json.dumps(report))
+            self.segmenter_client.client.publish("status/segmenter", '{"status":"Done"}')
+        finally:
+            self.__job = None
+
+    def sweep_path(self, path, variants, images=0, progress_interval=1.0):
+        """Segments the images of a folder with several variants of the parameters
+
+        Each image is decoded and corrected with the flat once, then segmented with all the
+        variants, see planktoscope.segmenter.sweep.Sweep. Nothing is written, apart from the
+        flat in the flat cache.
+
+        Args:
+            path (string): folder of the acquisition
+            variants (list): parameters of each variant, see planktoscope.segmenter.sweep.DEFAULTS
+            images (int, optional): number of images to segment, from the first one. Defaults
+                to 0, all the images.
+            progress_interval (float, optional): minimum time between two progress updates, in
+                seconds. Defaults to 1.
+
+        Returns:
+            dict: the objects and the time spent of each variant, and the time spent on the
+                images
+        """
+        if not isinstance(path, str):
+            raise ValueError("The sweep needs the path of the folder of an acquisition")
+        sweep = planktoscope.segmenter.sweep.Sweep(variants)
+        images_list = self._find_files(path, ("JPG", "jpg", "JPEG", "jpeg"))
+        if not images_list:
+            logger.error(f"There is no image to sweep the parameters on in {path}")
+            raise FileNotFoundError
+        images_paths = [os.path.join(path, filename) for filename in images_list]
+        images_count = min(images, len(images_list)) if images else len(images_list)
+        logger.info(f"Sweeping {len(sweep.variants)} variants on {images_count} images of {path}")
+
+        first_start = time.monotonic()
+        # the flat is the one of the segmentation, made of the first images
+        flat_window = min(planktoscope.segmenter.flat.FLAT_WINDOW, len(images_list))
+        if not flat_window % 2:
+            flat_window -= 1
+        flat_cache = planktoscope.segmenter.flat.FlatCache(
+            self.__flat_root, os.path.relpath(path, self.__img_path)
+        )
+        flat_key = flat_cache.key(images_paths[:flat_window])
+        flat = flat_cache.load(flat_key)
+
+        # the correction of the segmentation, without debug images
+        segmenter = planktoscope.segmenter.frame.FrameSegmenter(
+            debug=planktoscope.segmenter.debug.DebugImages(planktoscope.segmenter.debug.NONE)
+        )
+        publisher = planktoscope.segmenter.publisher.Publisher(
+            self.segmenter_client.client, progress_interval=progress_interval
+        )
+        timings = {"decode": 0.0, "correct": 0.0}
+        with planktoscope.segmenter.pipeline.FrameReader(images_paths, lookahead=2) as reader:
+            if flat is None:
+                self.segmenter_client.client.publish(
+                    "status/segmenter", '{"status":"Calculating flat"}'
+                )
+                flat = planktoscope.segmenter.flat.median(
+                    [reader.get(k)[0] for k in range(flat_window)]
+                )
+                flat_cache.save(flat_key, flat)
+            segmenter.flat = flat
+
+            for i in range(images_count):
+                self._checkpoint()
+                filename = images_list[i]
+                publisher.progress(
+                    f'{{"status":"Sweeping image {filename}, image {i + 1}/{images_count}"}}'
+                )
+                frame = planktoscope.segmenter.frame.Frame(
+                    i, images_paths[i], os.path.splitext(filename)[0], None, None
+                )
+                frame.image, frame.timings["decode"] = reader.get(i)
+                frame = segmenter.run_stage("correct", frame)
+                if frame.error is not None:
+                    raise frame.error
+                reader.release(i + 1)
+                sweep.add(frame.image)
+                for stage in timings:
+                    timings[stage] += frame.timings[stage]
+            publisher.flush()
+
+        report = {
+            "path": path,
+            "images": images_count,
+            # time spent on each image before the variants, shared by all of them
+            "decode_time": timings["decode"] / images_count,
+            "correct_time": timings["correct"] / images_count,
+            "variants_time": sweep.busy / images_count,
+            "duration": time.monotonic() - first_start,
+            "variants": sweep.report(),
+        }
+        for variant in report["variants"]:
+            logger.success(
+                f"{variant['objects']} objects found with {variant['parameters']}, in "
+                f"{variant['mask_time'] + variant['label_time']}s per image"
+            )
+        return report
+
+    def _follow(self, path, force, ecotaxa_export):
+        """Segments the acquisitions in progress in the given folders, or the next one
+
+        Args:
+            path (list): folders of the acquisitions, None for the next acquisition of the imager
+            force (bool): force the rework of the folders
+            ecotaxa_export (bool): generates ecotaxa export data
+        """
+        # the imager publishes the progress of the acquisition and its end on status/imager
+        self.__imager_client = planktoscope.mqtt.MQTT_Client(
+            topic="status/imager", name="segmenter_imager_client"
+        )
+        try:
+            if not path:
+                self.segmenter_client.client.publish(
+                    "status/segmenter", '{"status":"Waiting for an acquisition"}'
+                )
+                path = [
+                    planktoscope.segmenter.follow.wait_for_acquisition(
+                        self.__imager_client, self._checkpoint
+                    )
+                ]
+            # Publish the status "Started" to via MQTT to Node-RED
+            self.segmenter_client.client.publish("status/segmenter", '{"status":"Started"}')
+            # only the given folders are followed, not their subfolders
+            self.segment_list(path, force, ecotaxa_export)
+        finally:
+            self.__imager_client.shutdown()
+            self.__imager_client = None
 
     @logger.catch
     def treat_message(self):
@@ -872,47 +1356,67 @@ class SegmenterProcess(multiprocessing.Process):
 
         if "action" in last_message:
             # If the command is "segment"
-            if last_message["action"] == "segment":
+            if last_message["action"] in ("segment", "sweep"):
                 # {"action":"segment"}
-                if "settings" in last_message:
-                    settings = last_message["settings"]
-
-                    # force rework of already done folder
-                    force = settings.get("force", False)
-
-                    # parse folders recursively starting from the given parameter
-                    recursive = settings.get("recursive", True)
-
-                    # generate ecotaxa output archive
-                    ecotaxa_export = settings.get("ecotaxa", True)
-
-                    # keep debug images
-                    self.__save_debug_img = settings.get("keep", True)
+                # {"action":"sweep","path":"<folder>","settings":{"variants":[...]}}
+                # the segmentation runs in the worker, this loop keeps reading the messages
+                job = planktoscope.segmenter.worker.Job(
+                    last_message, priority=int(last_message.get("priority", 0))
+                )
+                self.__worker.submit(job)
+                logger.info(f"The segmentation {job.name} is queued")
+                self.segmenter_client.client.publish(
+                    "status/segmenter", f'{{"status":"Queued","job":"{job.id}"}}'
+                )
 
-                    if "process_id" in last_message["settings"]:
-                        self.__process_id = settings["process_id"]
+            elif last_message["action"] == "list":
+                # {"action":"list"}
+                self.segmenter_client.client.publish(
+                    "status/segmenter/jobs",
+                    json.dumps({"jobs": [job.summary() for job in self.__worker.jobs()]}),
+                )
 
-                    self.__process_min_ESD = settings.get("process_min_ESD", 20)
+            elif last_message["action"] == "cancel":
+                # {"action":"cancel","job":"<job id>"}
+                job_id = last_message.get("job")
+                if job_id is not None and self.__worker.cancel(job_id):
+                    logger.info(f"The segmentation {job_id} has been cancelled.")
+                    self.segmenter_client.client.publish(
+                        "status/segmenter", f'{{"status":"Cancelled","job":"{job_id}"}}'
+                    )
+                else:
+                    logger.warning(f"There is no segmentation {job_id} to cancel.")
+                    self.segmenter_client.client.publish(
+                        "status/segmenter", f'{{"status":"Unknown job","job":"{job_id}"}}'
+                    )
 
-                    self.__remove_previous_mask = settings.get("remove_previous_mask", False)
+            elif last_message["action"] == "stop":
+                if self.__worker.cancel():
+                    # the segmentation publishes "Interrupted" once it stopped
+                    logger.info("The segmentation is being interrupted.")
+                else:
+                    logger.info("There is no segmentation to interrupt.")
 
-                path = last_message["path"] if "path" in last_message else None
+                    # Publish the status "Interrupted" to via MQTT to Node-RED
+                    self.segmenter_client.client.publish(
+                        "status/segmenter", '{"status":"Interrupted"}'
+                    )
 
-                # Publish the status "Started" to via MQTT to Node-RED
-                self.segmenter_client.client.publish("status/segmenter", '{"status":"Started"}')
-                if path:
-                    if recursive:
-                        self.segment_all(path, force, ecotaxa_export)
-                    else:
-                        self.segment_list(path, force, ecotaxa_export)
+            elif last_message["action"] == "pause":
+                job = self.__worker.current
+                if job is not None and job.pause():
+                    logger.info("The segmentation has been paused.")
+                    self.segmenter_client.client.publish("status/segmenter", '{"status":"Paused"}')
                 else:
-                    self.segment_all(self.__img_path, force, ecotaxa_export)
+                    logger.warning("There is no segmentation running to pause.")
 
-            elif last_message["action"] == "stop":
-                logger.info("The segmentation has been interrupted.")
-
-                # Publish the status "Interrupted" to via MQTT to Node-RED
-                self.segmenter_client.client.publish("status/segmenter", '{"status":"Interrupted"}')
+            elif last_message["action"] == "resume":
+                job = self.__worker.current
+                if job is not None and job.resume():
+                    logger.info("The segmentation has been resumed.")
+                    self.segmenter_client.client.publish("status/segmenter", '{"status":"Resumed"}')
+                else:
+                    logger.warning("There is no segmentation paused to resume.")
 
             elif last_message["action"] == "update_config":
                 logger.error("We can't update the configuration while we are segmenting.")
@@ -939,14 +1443,23 @@ class SegmenterProcess(multiprocessing.Process):
         # Publish the status "Ready" to via MQTT to Node-RED
         self.segmenter_client.client.publish("status/segmenter", '{"status":"Ready"}')
 
+        self.__catalog = planktoscope.segmenter.catalog.Catalog(self.__catalog_fn)
+
+        # the segmentations run in this thread, starting with the ones queued before a restart
+        self.__worker = planktoscope.segmenter.worker.Worker(self._run_job, self.__queue_fn)
+
         logger.success("Segmenter is READY!")
 
         # This is the loop
         while not self.stop_event.is_set():
             self.treat_message()
-            time.sleep(0.5)
+            # the pause and stop messages are handled between two images
+            time.sleep(0.1)
 
         logger.info("Shutting down the segmenter process")
+        # an interrupted segmentation is resumed from its journal the next time
+        self.__worker.close()
+        self.__catalog.close()
         self.segmenter_client.client.publish("status/segmenter", '{"status":"Dead"}')
         self.segmenter_client.shutdown()
         logger.success("Segmenter process shut down! See you!")
@@ -0,0 +1,307 @@
+# Copyright (C) 2021 Romain Bazile
+#
+# This file is part of the PlanktoScope software.
+#
+# PlanktoScope is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# PlanktoScope is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with PlanktoScope.  If not, see <http://www.gnu.org/licenses/>.
+
+import cv2
+import numpy as np
+import skimage.measure
+
+# Logger library compatible with multiprocessing
+from loguru import logger
+
+import planktoscope.segmenter.features
+import planktoscope.segmenter.operations
+
+# rows read above and below a row of the mask by the morphology of the mask stage: the 2x2
+# erosion, the 8x8 dilation, the 8x8 closing, which is a dilation and an erosion, and the 8x8
+# erosion
+MORPHOLOGY_OVERLAP = 1 + 7 + 2 * 7 + 7
+
+# memory used for each pixel of a frame whatever the bands: the frame, its corrected copy, its
+# thresholded mask and its final mask, in bytes
+FRAME_BYTES_PER_PIXEL = 3 + 3 + 1 + 1
+
+# memory used for each pixel of a band, in bytes, its labels and properties use about 20
+BAND_BYTES_PER_PIXEL = 24
+
+# the bands are at least this high, so that the overlap is not most of the work
+MINIMUM_BAND_ROWS = 4 * MORPHOLOGY_OVERLAP
+
+
+def band_rows(shape, memory_budget):
+    """Returns the height of the bands segmenting a frame within the memory budget
+
+    Args:
+        shape (tuple): shape of the frame
+        memory_budget (int): memory the segmentation of the frame may use, in bytes, 0 for no
+            limit
+
+    Returns:
+        int: number of rows of the bands, None if the frame is segmented whole
+    """
+    if not memory_budget:
+        return None
+    height, width = shape[:2]
+    available = memory_budget - FRAME_BYTES_PER_PIXEL * height * width
+    rows = available // (BAND_BYTES_PER_PIXEL * width)
+    if rows >= height:
+        return None
+    if rows < MINIMUM_BAND_ROWS:
+        logger.warning(
+            f"A {width}x{height} frame doesn't fit in {memory_budget // 2**20} MB, "
+            f"segmenting it in bands of {MINIMUM_BAND_ROWS} rows"
+        )
+        rows = MINIMUM_BAND_ROWS
+    return int(rows)
+
+
+def bands(height, rows, overlap=0):
+    """Yields the bands of a frame, with the rows they read and the rows they produce
+
+    Args:
+        height (int): number of rows of the frame
+        rows (int): number of rows produced by each band
+        overlap (int, optional): rows read above and below the rows produced. Defaults to 0.
+
+    Yields:
+        tuple: the slice of the rows read, and the slice of the rows produced in the rows read
+    """
+    for start in range(0, height, rows):
+        stop = min(start + rows, height)
+        read_start = max(start - overlap, 0)
+        read_stop = min(stop + overlap, height)
+        yield slice(read_start, read_stop), slice(start - read_start, stop - read_start)
+
+
+def threshold(image, rows):
+    """Thresholds the frame band by band, like operations.simple_threshold
+
+    The triangle threshold is found from the histogram of the whole frame, accumulated over the
+    bands, so the mask is the same as the mask of the whole frame.
+
+    Args:
+        image (array): BGR frame
+        rows (int): number of rows of the bands
+
+    Returns:
+        array: binary mask
+    """
+    histogram = np.zeros(256, dtype=np.int64)
+    for band, _ in bands(len(image), rows):
+        gray = cv2.cvtColor(image[band], cv2.COLOR_BGR2GRAY)
+        histogram += planktoscope.segmenter.operations.gray_histogram(gray)
+    value = planktoscope.segmenter.operations.triangle_threshold(histogram)
+    logger.info(f"Threshold value used was {value}")
+    mask = np.empty(image.shape[:2], dtype=np.uint8)
+    for band, _ in bands(len(image), rows):
+        gray = cv2.cvtColor(image[band], cv2.COLOR_BGR2GRAY)
+        cv2.threshold(gray, value, 255, cv2.THRESH_BINARY_INV, dst=mask[band])
+    return mask
+
+
+def morphology(mask, rows, transformations, keep=False):
+    """Applies the transformations of operations to the mask band by band
+
+    Each band reads MORPHOLOGY_OVERLAP rows above and below the rows it produces, which are all
+    the rows the transformations depend on, so the mask is the same as the mask of the whole
+    frame.
+
+    Args:
+        mask (array): binary mask
+        rows (int): number of rows of the bands
+        transformations (list): names of the functions of operations to apply, in order
+        keep (bool, optional): also return the mask after each transformation. Defaults to
+            False.
+
+    Returns:
+        tuple: the final mask, and the list of the masks after each transformation if keep
+    """
+    steps = [np.empty_like(mask) for _ in transformations] if keep else []
+    final = np.empty_like(mask)
+    for band, produced in bands(len(mask), rows, MORPHOLOGY_OVERLAP):
+        band_mask = mask[band]
+        for i, transformation in enumerate(transformations):
+            band_mask = getattr(planktoscope.segmenter.operations, transformation)(band_mask)
+            if keep:
+                steps[i][band][produced] = band_mask[produced]
+        final[band][produced] = band_mask[produced]
+    return final, steps
+
+
+def _shift(table, rows, columns):
+    """Moves the properties of regionprops_table by the given offset
+
+    The centroids are found again from the sums of the coordinates, so that they are the ones
+    regionprops finds in the whole frame, bit for bit.
+    """
+    area = table["area"]
+    for axis, offset in enumerate((rows, columns)):
+        if not offset:
+            continue
+        table[f"bbox-{axis}"] = table[f"bbox-{axis}"] + offset
+        table[f"bbox-{axis + 2}"] = table[f"bbox-{axis + 2}"] + offset
+        total = np.round(table[f"centroid-{axis}"] * area) + area * offset
+        table[f"centroid-{axis}"] = total / area
+    slices = np.empty(len(area), dtype=object)
+    slices[:] = [
+        (
+            slice(row_slice.start + rows, row_slice.stop + rows),
+            slice(column_slice.start + columns, column_slice.stop + columns),
+        )
+        for row_slice, column_slice in table["slice"]
+    ]
+    table["slice"] = slices
+    return table
+
+
+class BandObjects:
+    """Labels the objects of a mask band by band
+
+    The objects are the ones of features.label_objects on the whole mask, with the same numbers,
+    and their properties are the ones of features.regions_table, so the objects and their
+    features don't depend on the bands.
+
+    The bands are labelled once to join the objects crossing their boundaries and to filter the
+    objects on their size, and once more for their properties. The labels of the whole frame,
+    which take 8 bytes per pixel, are never made.
+    """
+
+    def __init__(self, mask, min_esd, rows):
+        """Labels the objects of the mask
+
+        Args:
+            mask (array): mask of the frame
+            min_esd (float): minimum equivalent spherical diameter of the objects, in pixels
+            rows (int): number of rows of the bands
+        """
+        self.mask = mask
+        self.rows = rows
+        # first global number of the labels of each band, minus one
+        self.__offsets = []
+        areas = [np.zeros(1, dtype=np.int64)]
+        # global numbers of the labels joined across the boundaries of the bands
+        joined = []
+        offset = 0
+        previous_row = None
+        for band, _ in bands(len(mask), rows):
+            labels, area = planktoscope.segmenter.features.label_components(mask[band])
+            count = len(area) - 1
+            np.add(labels, offset, out=labels, where=labels > 0)
+            self.__offsets.append(offset)
+            areas.append(area[1:].astype(np.int64))
+            if previous_row is not None:
+                joined.append(self.__boundary(previous_row, labels[0]))
+            previous_row = labels[-1].copy()
+            offset += count
+            # released before the next band is labelled
+            del labels
+        # the labels of an object are joined to the first one, which is the first in raster
+        # order, as in the labels of the whole frame
+        root = np.arange(offset + 1)
+        for first, second in np.concatenate(joined, axis=1).T if joined else []:
+            first, second = self.__find(root, first), self.__find(root, second)
+            root[max(first, second)] = min(first, second)
+        while (root[root] != root).any():
+            root = root[root]
+        area = np.bincount(root, weights=np.concatenate(areas), minlength=offset + 1)
+        roots = np.flatnonzero(root == np.arange(offset + 1))[1:]
+        self.nlabels = len(roots)
+        # the same diameter as regionprops equivalent_diameter_area
+        kept = roots[(4 * area[roots] / np.pi) ** (1 / 2) >= min_esd]
+        number = np.zeros(offset + 1, dtype=np.int32)
+        number[kept] = np.arange(1, len(kept) + 1, dtype=np.int32)
+        # number of the object of each label, 0 for the filtered ones
+        self.__numbers = number[root]
+        # the objects in several bands
+        self.__crossing = np.zeros(len(kept) + 1, dtype=bool)
+        members = np.bincount(self.__numbers, minlength=len(kept) + 1)
+        self.__crossing[1:] = members[1:] > 1
+
+    @staticmethod
+    def __find(root, label):
+        while root[label] != label:
+            root[label] = root[root[label]]
+            label = root[label]
+        return label
+
+    @staticmethod
+    def __boundary(above, below):
+        """Returns the labels of the two rows touching each other, in 8-connectivity"""
+        pairs = []
+        width = len(above)
+        for shift in (-1, 0, 1):
+            first = above[max(0, -shift) : width - max(0, shift)]
+            second = below[max(0, shift) : width - max(0, -shift)]
+            touching = (first > 0) & (second > 0)
+            pairs.append(np.stack([first[touching], second[touching]]))
+        pairs = np.concatenate(pairs, axis=1)
+        return np.unique(pairs, axis=1) if pairs.size else pairs
+
+    def __band_numbers(self, band, offset):
+        """Returns the numbers of the objects of the pixels of a band, 0 outside the objects"""
+        labels, _ = planktoscope.segmenter.features.label_components(self.mask[band])
+        np.add(labels, offset, out=labels, where=labels > 0)
+        return self.__numbers[labels]
+
+    def regions(self, image):
+        """Returns the properties of the objects, and the colours of their pixels
+
+        Args:
+            image (array): BGR frame
+
+        Returns:
+            tuple: the properties of the objects, see features.regions_table, and the colours of
+                their pixels, see features.object_pixels
+        """
+        properties = planktoscope.segmenter.features.PROPERTIES + ["label"]
+        tables = []
+        pixels = []
+        crossing = []
+        for (band, _), offset in zip(bands(len(self.mask), self.rows), self.__offsets):
+            numbers = self.__band_numbers(band, offset)
+            pixels.append(planktoscope.segmenter.features.object_pixels(image[band], numbers))
+            in_band = numbers.copy()
+            across = self.__crossing[numbers]
+            if across.any():
+                rows, columns = np.nonzero(across)
+                crossing.append(np.stack([numbers[rows, columns], rows + band.start, columns]))
+                in_band[across] = 0
+            if in_band.any():
+                table = skimage.measure.regionprops_table(in_band, properties=properties)
+                tables.append(_shift(table, band.start, 0))
+            # released before the next band is labelled
+            del numbers, in_band, across
+
+        # the objects crossing bands are measured on their own, from their pixels
+        if crossing:
+            crossing = np.concatenate(crossing, axis=1)
+            crossing = crossing[:, np.argsort(crossing[0], kind="stable")]
+            objects, starts = np.unique(crossing[0], return_index=True)
+            for number, coordinates in zip(objects, np.split(crossing[1:], starts[1:], axis=1)):
+                top, left = coordinates.min(axis=1)
+                bottom, right = coordinates.max(axis=1)
+                object_image = np.zeros((bottom - top + 1, right - left + 1), dtype=np.int32)
+                object_image[coordinates[0] - top, coordinates[1] - left] = number
+                table = skimage.measure.regionprops_table(object_image, properties=properties)
+                tables.append(_shift(table, top, left))
+
+        colors = tuple(np.concatenate(arrays) for arrays in zip(*pixels))
+        if not tables:
+            return planktoscope.segmenter.features.regions_table(np.zeros((1, 1), np.int32)), colors
+        regions = {name: np.concatenate([table[name] for table in tables]) for name in tables[0]}
+        # the objects in the order of their numbers, as in the labels of the whole frame
+        order = np.argsort(regions.pop("label"), kind="stable")
+        return {name: column[order] for name, column in regions.items()}, colors
@@ -0,0 +1,325 @@
+# Copyright (C) 2021 Romain Bazile
+#
+# This file is part of the PlanktoScope software.
+#
+# PlanktoScope is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# PlanktoScope is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with PlanktoScope.  If not, see <http://www.gnu.org/licenses/>.
+
+import argparse
+import concurrent.futures
+import json
+import multiprocessing
+import os
+import signal
+import sys
+import threading
+import time
+import uuid
+
+import paho.mqtt.client as mqtt
+
+# Logger library compatible with multiprocessing
+from loguru import logger
+
+import planktoscope.segmenter
+import planktoscope.segmenter.catalog
+import planktoscope.segmenter.debug
+import planktoscope.segmenter.worker
+
+# the data path of main.py
+DATA_PATH = os.getenv(
+    "PLANKTOSCOPE_DATA_PATH",
+    os.path.normpath(os.path.join(os.path.dirname(__file__), "../../../data")),
+)
+
+# set in the processes of the pool once the batch is interrupted, see init_worker
+_stop_event = None
+
+
+class LocalMessage:
+    """Stands in for the message returned by paho, it is published at once"""
+
+    rc = mqtt.MQTT_ERR_SUCCESS
+
+    def is_published(self):
+        return True
+
+
+class LocalClient:
+    """Stands in for planktoscope.mqtt.MQTT_Client, the status updates are only logged
+
+    The last status published on status/segmenter is kept, it tells how the segmentation ended.
+    """
+
+    def __init__(self):
+        # the segmenter publishes with segmenter_client.client.publish
+        self.client = self
+        self.status = None
+
+    def publish(self, topic, payload=None, qos=0, retain=False):
+        if topic == "status/segmenter":
+            self.status = json.loads(payload)["status"]
+            logger.debug(f"Status: {self.status}")
+        return LocalMessage()
+
+
+def stop_on_signals():
+    """Returns a threading.Event set by SIGINT and SIGTERM, it must only be polled
+
+    A multiprocessing.Event set by a signal handler deadlocks when the main thread waits on it,
+    the events of the processes are set by the main loop instead.
+    """
+    stop_event = threading.Event()
+
+    def stop(signum, _):
+        logger.info(f"Received a signal asking to stop {signum}")
+        stop_event.set()
+
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGTERM, stop)
+    return stop_event
+
+
+def init_worker(stop_event, log_level):
+    """Initializer of the processes of the pool, they stop when stop_event is set"""
+    global _stop_event
+    _stop_event = stop_event
+    # the control process tells the segmentations to stop, between two images
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    logger.remove()
+    logger.add(sys.stderr, level=log_level)
+
+
+def _cancel_on_stop(job):
+    while not job.wait(0.5):
+        if _stop_event is not None and _stop_event.is_set():
+            job.cancel()
+            return
+
+
+def segment_acquisition(data_path, path, settings):
+    """Segments an acquisition, in a process of the pool
+
+    Args:
+        data_path (str): data path, the acquisition is in its img folder
+        path (str): folder of the acquisition
+        settings (dict): settings of the segment message
+
+    Returns:
+        dict: the images and objects segmented and the time spent, see
+            SegmenterProcess.segment_path, or the status of the segmentation if it didn't finish
+    """
+    client = LocalClient()
+    process = planktoscope.segmenter.SegmenterProcess(multiprocessing.Event(), data_path)
+    job = planktoscope.segmenter.worker.Job(
+        {"action": "segment", "path": [path], "settings": dict(settings, recursive=False)}
+    )
+    threading.Thread(target=_cancel_on_stop, args=(job,), daemon=True).start()
+    process.run_job(job, client)
+    if process.summaries:
+        return process.summaries[0]
+    return {"path": path, "status": client.status}
+
+
+def count_images(path):
+    """Returns the number of images of an acquisition"""
+    return sum(
+        1
+        for entry in os.scandir(path)
+        if entry.is_file() and entry.name.endswith(("JPG", "jpg", "JPEG", "jpeg"))
+    )
+
+
+def parse_keep(keep):
+    if keep in ("true", "false"):
+        return keep == "true"
+    return keep
+
+
+def summary(results, duration, interrupted):
+    """Returns the summary of the batch, printed as JSON
+
+    Args:
+        results (list): result of each acquisition, see segment_acquisition
+        duration (float): time spent, in seconds
+        interrupted (bool): the batch was interrupted
+    """
+    segmented = [result for result in results if "status" not in result]
+    for result in segmented:
+        result["images_per_second"] = result["images"] / max(result["duration"], 1e-9)
+    images = sum(result["images"] for result in segmented)
+    objects = sum(result["objects"] for result in segmented)
+    return {
+        "acquisitions": results,
+        "segmented": len(segmented),
+        "failed": len(results) - len(segmented),
+        "interrupted": interrupted,
+        "images": images,
+        "objects": objects,
+        "duration": duration,
+        "images_per_second": images / max(duration, 1e-9),
+        "objects_per_second": objects / max(duration, 1e-9),
+    }
+
+
+def add_arguments(parser):
+    """Adds the arguments choosing the acquisitions and their settings, see settings_of"""
+    parser.add_argument(
+        "paths",
+        nargs="*",
+        help="folders to look for acquisitions in, in the img folder of the data path, all of it "
+        "by default",
+    )
+    parser.add_argument("--data-path", default=DATA_PATH, help=f"data path, {DATA_PATH} by default")
+    parser.add_argument("--force", action="store_true", help="segment the segmented folders too")
+    parser.add_argument(
+        "--no-recursive", action="store_true", help="only look for acquisitions in the paths"
+    )
+    parser.add_argument(
+        "--no-ecotaxa", action="store_true", help="don't write the EcoTaxa archives"
+    )
+    parser.add_argument(
+        "--keep",
+        default="true",
+        choices=["true", "false"] + planktoscope.segmenter.debug.TIERS,
+        help="debug images to keep, see the keep setting, true by default",
+    )
+    parser.add_argument(
+        "--min-esd", type=float, default=20, help="minimum size of the objects, 20 by default"
+    )
+    parser.add_argument(
+        "--settings",
+        type=json.loads,
+        default={},
+        help="other settings of the segment message, as JSON, the options above come first",
+    )
+    parser.add_argument("--log-level", default="INFO", help="level of the logs, INFO by default")
+
+
+def settings_of(args):
+    """Returns the settings of the segment message for the arguments, see add_arguments"""
+    settings = dict(args.settings)
+    settings.update(
+        {
+            "force": args.force,
+            "ecotaxa": not args.no_ecotaxa,
+            "keep": parse_keep(args.keep),
+            "process_min_ESD": args.min_esd,
+        }
+    )
+    # the acquisitions of a batch are one process, as the ones of a segment message
+    settings.setdefault("process_id", str(uuid.uuid4()))
+    return settings
+
+
+def find_acquisitions(parser, args):
+    """Returns the data path and the acquisitions to segment, see add_arguments"""
+    data_path = os.path.abspath(args.data_path)
+    img_path = os.path.join(data_path, "img")
+    paths = [os.path.abspath(path) for path in args.paths] or [img_path]
+    for path in paths:
+        # the objects and the archives are saved in the data path, after their path in img
+        if os.path.commonpath([path, img_path]) != img_path:
+            parser.error(f"{path} is not in {img_path}")
+
+    catalog = planktoscope.segmenter.catalog.Catalog(
+        os.path.join(data_path, planktoscope.segmenter.catalog.CATALOG_FILENAME)
+    )
+    with catalog:
+        acquisitions = [
+            path
+            for path, segmented in catalog.acquisitions(paths, recursive=not args.no_recursive)
+            if args.force or not segmented
+        ]
+    return data_path, acquisitions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Segments the acquisitions of the data path without MQTT, several at a "
+        "time, and prints a JSON summary of the throughput"
+    )
+    add_arguments(parser)
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="number of images of an acquisition segmented at the same time, 1 by default",
+    )
+    parser.add_argument(
+        "--jobs",
+        type=int,
+        default=0,
+        help="number of acquisitions segmented at the same time, by default the number of "
+        "cores divided by the workers",
+    )
+    args = parser.parse_args(argv)
+
+    logger.remove()
+    logger.add(sys.stderr, level=args.log_level)
+
+    data_path, acquisitions = find_acquisitions(parser, args)
+    # the longest acquisitions start first, so that the cores stay busy until the end
+    acquisitions.sort(key=count_images, reverse=True)
+    jobs = args.jobs or max(1, (os.cpu_count() or 1) // max(1, args.workers))
+    logger.info(f"Segmenting {len(acquisitions)} acquisitions, {jobs} at a time")
+
+    settings = settings_of(args)
+    settings["workers"] = args.workers
+
+    stop_event = stop_on_signals()
+    context = multiprocessing.get_context("spawn")
+    # set by the main loop once it is asked to stop, not by the signal handler
+    workers_stop_event = context.Event()
+
+    start = time.monotonic()
+    results = []
+    # spawn instead of fork, as the pool of the workers
+    with concurrent.futures.ProcessPoolExecutor(
+        max_workers=jobs,
+        mp_context=context,
+        initializer=init_worker,
+        initargs=(workers_stop_event, args.log_level),
+    ) as pool:
+        futures = {
+            pool.submit(segment_acquisition, data_path, path, settings): path
+            for path in acquisitions
+        }
+        pending = set(futures)
+        while pending:
+            done, pending = concurrent.futures.wait(
+                pending, timeout=1, return_when=concurrent.futures.FIRST_COMPLETED
+            )
+            for future in done:
+                if future.cancelled():
+                    continue
+                try:
+                    result = future.result()
+                except Exception as e:
+                    logger.exception(f"The segmentation of {futures[future]} failed")
+                    result = {"path": futures[future], "status": str(e)}
+                results.append(result)
+            if stop_event.is_set():
+                workers_stop_event.set()
+                # the acquisitions not started yet are not segmented
+                for future in pending:
+                    future.cancel()
+
+    print(json.dumps(summary(results, time.monotonic() - start, stop_event.is_set()), indent=2))
+    if stop_event.is_set():
+        return 130
+    return 0 if all("status" not in result for result in results) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,177 @@
+# Copyright (C) 2021 Romain Bazile
+#
+# This file is part of the PlanktoScope software.
+#
+# PlanktoScope is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# PlanktoScope is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with PlanktoScope.  If not, see <http://www.gnu.org/licenses/>.
+
+import collections
+import hashlib
+import json
+import os
+import zipfile
+
+import numpy as np
+
+# Logger library compatible with multiprocessing
+from loguru import logger
+
+# Version of the stages results, to change when the results of a stage change
+STAGE_CACHE_VERSION = 1
+
+# Maximum size of the stages cache, in MB
+STAGE_CACHE_SIZE = int(os.getenv("SEGMENTER_STAGE_CACHE_SIZE", "2048")) * 1024 * 1024
+
+
+def frame_key(filepath, flat_key):
+    """Returns the key of a frame corrected with a flat
+
+    The frame is known by its path, its size and its modification time, like the frames of the
+    flat, see flat.FlatCache.key.
+
+    Args:
+        filepath (str): path of the frame
+        flat_key (str): key of the flat, see flat.FlatCache.key
+
+    Returns:
+        str: key of the frame, the results of its stages are keyed by it
+    """
+    stat = os.stat(filepath)
+    description = {
+        "frame": [os.path.abspath(filepath), stat.st_size, stat.st_mtime_ns],
+        "flat": flat_key,
+        "version": STAGE_CACHE_VERSION,
+    }
+    return hashlib.sha256(json.dumps(description).encode()).hexdigest()
+
+
+def stage_key(key, stage, parameters):
+    """Returns the key of the result of a stage
+
+    Args:
+        key (str): key of the frame, or of the result of the previous stage
+        stage (str): name of the stage
+        parameters (dict): parameters the result of the stage depends on
+
+    Returns:
+        str: key of the result
+    """
+    description = {"key": key, "stage": stage, "parameters": parameters}
+    return hashlib.sha256(json.dumps(description, sort_keys=True).encode()).hexdigest()
+
+
+class StageCache:
+    """Results of the segmentation stages saved on disk, to only run the stages whose inputs changed
+
+    Segmenting an acquisition again with other parameters starts at the first stage they change.
+    A result is a set of arrays saved in a .npz file named after its key. The results are read
+    and written by the stages, in the worker processes too, and the least recently used ones are
+    removed by the control process, which is told about them through the frames, see use.
+    """
+
+    def __init__(self, root, max_size=STAGE_CACHE_SIZE):
+        """Initialize the cache, and lists the results saved
+
+        Args:
+            root (string): directory where the results are saved
+            max_size (int, optional): maximum size of the cache, in bytes.
+                Defaults to STAGE_CACHE_SIZE.
+        """
+        self.root = root
+        self.max_size = max_size
+        os.makedirs(self.root, exist_ok=True)
+        # size of the results, from the least recently used one
+        self.__sizes = collections.OrderedDict()
+        results = []
+        for entry in os.scandir(self.root):
+            if entry.name.endswith(".npz"):
+                stat = entry.stat()
+                results.append((stat.st_mtime, entry.path, stat.st_size))
+        for _, path, size in sorted(results):
+            self.__sizes[path] = size
+        self.size = sum(self.__sizes.values())
+
+    def __getstate__(self):
+        # the workers don't evict the results, they don't need to know them
+        state = self.__dict__.copy()
+        state["_StageCache__sizes"] = collections.OrderedDict()
+        return state
+
+    def __path(self, key):
+        return os.path.join(self.root, f"{key}.npz")
+
+    def contains(self, key):
+        """Whether a result is saved with the given key"""
+        return os.path.exists(self.__path(key))
+
+    def load(self, key):
+        """Returns the arrays saved with the given key, or None
+
+        Returns:
+            tuple: the arrays by name and the path of their file, or None
+        """
+        path = self.__path(key)
+        try:
+            with np.load(path, allow_pickle=False) as result:
+                arrays = {name: result[name] for name in result.files}
+        except (OSError, ValueError, zipfile.BadZipFile):
+            return None
+        # the modification time tells which results were used recently, after a restart
+        os.utime(path)
+        return arrays, path
+
+    def save(self, key, arrays, compressed=False):
+        """Saves the arrays with the given key
+
+        Args:
+            key (str): key of the result
+            arrays (dict): arrays of the result, by name
+            compressed (bool, optional): compress the arrays. Defaults to False.
+
+        Returns:
+            tuple: the path of the file and its size, or None if the cache is disabled
+        """
+        if self.max_size <= 0:
+            return None
+        path = self.__path(key)
+        # write to a temporary file first, so that an interrupted write is never loaded
+        temporary_path = f"{path}.tmp"
+        with open(temporary_path, "wb") as result_file:
+            (np.savez_compressed if compressed else np.savez)(result_file, **arrays)
+        os.replace(temporary_path, path)
+        return path, os.path.getsize(path)
+
+    def use(self, results):
+        """Records the results used by a frame, and removes the least recently used ones if needed
+
+        Args:
+            results (list): the paths of the results and their size, None for the ones read
+        """
+        for path, size in results:
+            if path in self.__sizes:
+                self.__sizes.move_to_end(path)
+                if size is None:
+                    continue
+                self.size -= self.__sizes[path]
+            elif size is None:
+                continue
+            self.__sizes[path] = size
+            self.size += size
+        while self.size > self.max_size and len(self.__sizes) > 1:
+            path, size = self.__sizes.popitem(last=False)
+            logger.debug(f"Removing {path} from the stages cache")
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            self.size -= size
@@ -0,0 +1,228 @@
+# Copyright (C) 2021 Romain Bazile
+#
+# This file is part of the PlanktoScope software.
+#
+# PlanktoScope is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# PlanktoScope is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with PlanktoScope.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import sqlite3
+import threading
+import time
+from stat import S_ISDIR
+
+# Logger library compatible with multiprocessing
+from loguru import logger
+
+# name of the file of the catalog, in the data path
+CATALOG_FILENAME = "segmenter_catalog.sqlite3"
+
+# version of the schema, a catalog of another version is made again
+CATALOG_VERSION = 1
+
+# a folder modified less than this before it is listed may be modified again in the same tick of
+# its modification time, it is listed again at the next refresh, in nanoseconds
+RACY_DELAY = 2 * 10**9
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS folders (
+    path TEXT PRIMARY KEY,
+    parent TEXT,
+    mtime_ns INTEGER,
+    acquisition INTEGER NOT NULL,
+    segmented INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS folders_parent ON folders (parent);
+"""
+
+
+def _subtree(path):
+    """Returns the range of the paths below path, the first one included and not the last"""
+    prefix = path.rstrip(os.sep) + os.sep
+    # the separator is followed by the next character in the order of the strings
+    return prefix, prefix[:-1] + chr(ord(os.sep) + 1)
+
+
+class Catalog:
+    """Keeps the folders of the data path, and whether they are segmented, in a SQLite database
+
+    A folder is an acquisition when it has a metadata.json file, and it is segmented when it also
+    has a done.txt file. The folders are only listed again when their modification time changed,
+    which happens when a file or a folder is added to or removed from them, so finding the
+    acquisitions to segment doesn't list the thousands of images of the acquisitions already
+    known.
+
+    The catalog is only a cache of the data path, it is made again if it can't be read.
+    """
+
+    def __init__(self, filepath):
+        """Opens the catalog, and creates it if needed
+
+        Args:
+            filepath (str): file of the catalog
+        """
+        self.filepath = filepath
+        # the catalog is opened by the main thread and used by the worker
+        self.__lock = threading.Lock()
+        try:
+            self.__connection = self.__open()
+        except sqlite3.DatabaseError:
+            logger.exception(f"The catalog {self.filepath} can't be read, it is made again")
+            for suffix in ("", "-wal", "-shm"):
+                if os.path.exists(f"{self.filepath}{suffix}"):
+                    os.remove(f"{self.filepath}{suffix}")
+            self.__connection = self.__open()
+
+    def __open(self):
+        connection = sqlite3.connect(self.filepath, check_same_thread=False)
+        try:
+            version = connection.execute("PRAGMA user_version").fetchone()[0]
+            if version != CATALOG_VERSION:
+                if version:
+                    logger.info(f"The catalog {self.filepath} is of version {version}, resetting")
+                connection.execute("DROP TABLE IF EXISTS folders")
+                connection.executescript(SCHEMA)
+                connection.execute(f"PRAGMA user_version = {CATALOG_VERSION}")
+            # the catalog can be made again, the speed matters more than the durability
+            connection.execute("PRAGMA journal_mode = WAL")
+            connection.execute("PRAGMA synchronous = NORMAL")
+            connection.commit()
+        except sqlite3.DatabaseError:
+            connection.close()
+            raise
+        return connection
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __remove(self, path):
+        """Removes a folder and its subfolders"""
+        self.__connection.execute(
+            "DELETE FROM folders WHERE path = ? OR (path >= ? AND path < ?)",
+            (path, *_subtree(path)),
+        )
+
+    def __list(self, path, stat):
+        """Lists a folder again, and records what it holds
+
+        Returns:
+            list: the paths of its subfolders
+        """
+        subfolders = []
+        filenames = set()
+        try:
+            with os.scandir(path) as entries:
+                for entry in entries:
+                    if entry.is_dir(follow_symlinks=False):
+                        subfolders.append(entry.path)
+                    else:
+                        filenames.add(entry.name)
+        except OSError:
+            logger.exception(f"The folder {path} can't be listed, it is skipped")
+            self.__remove(path)
+            return []
+        mtime_ns = stat.st_mtime_ns
+        if time.time_ns() - mtime_ns < RACY_DELAY:
+            # a change in the same tick wouldn't change the modification time
+            mtime_ns = None
+        self.__connection.execute(
+            "INSERT OR REPLACE INTO folders VALUES (?, ?, ?, ?, ?)",
+            (
+                path,
+                os.path.dirname(path),
+                mtime_ns,
+                "metadata.json" in filenames,
+                "done.txt" in filenames,
+            ),
+        )
+        # the subfolders removed since the last listing
+        known = self.__connection.execute("SELECT path FROM folders WHERE parent = ?", (path,))
+        listed = set(subfolders)
+        for (subfolder,) in known.fetchall():
+            if subfolder not in listed:
+                self.__remove(subfolder)
+        return subfolders
+
+    def __refresh(self, path, recursive):
+        listed = 0
+        pending = [path]
+        while pending:
+            path = pending.pop()
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                stat = None
+            if stat is None or not S_ISDIR(stat.st_mode):
+                self.__remove(path)
+                continue
+            row = self.__connection.execute(
+                "SELECT mtime_ns FROM folders WHERE path = ?", (path,)
+            ).fetchone()
+            if row is not None and row[0] == stat.st_mtime_ns:
+                if recursive:
+                    subfolders = self.__connection.execute(
+                        "SELECT path FROM folders WHERE parent = ?", (path,)
+                    )
+                    pending.extend(subfolder for (subfolder,) in subfolders.fetchall())
+                continue
+            subfolders = self.__list(path, stat)
+            listed += 1
+            if recursive:
+                pending.extend(subfolders)
+        return listed
+
+    def refresh(self, paths, recursive=True):
+        """Brings the catalog up to date with the given folders
+
+        Args:
+            paths (list): folders to look at
+            recursive (bool, optional): also look at their subfolders. Defaults to True.
+        """
+        start = time.monotonic()
+        with self.__lock, self.__connection:
+            listed = sum(self.__refresh(os.path.abspath(path), recursive) for path in paths)
+        logger.debug(f"{listed} folders listed in {time.monotonic() - start:.3f}s")
+
+    def acquisitions(self, paths, recursive=True):
+        """Returns the acquisitions in the given folders, once the catalog is up to date
+
+        Args:
+            paths (list): folders to look into
+            recursive (bool, optional): also look into their subfolders. Defaults to True.
+
+        Returns:
+            list: the paths of the acquisitions and whether they are segmented, sorted by path
+                and without duplicates
+        """
+        self.refresh(paths, recursive)
+        acquisitions = set()
+        with self.__lock:
+            for path in paths:
+                path = os.path.abspath(path)
+                query = "SELECT path, segmented FROM folders WHERE acquisition AND (path = ?"
+                parameters = [path]
+                if recursive:
+                    query += " OR (path >= ? AND path < ?)"
+                    parameters.extend(_subtree(path))
+                acquisitions.update(
+                    (acquisition, bool(segmented))
+                    for acquisition, segmented in self.__connection.execute(f"{query})", parameters)
+                )
+        return sorted(acquisitions)
+
+    def close(self):
+        with self.__lock:
+            self.__connection.close()
@@ -0,0 +1,137 @@
+# Copyright (C) 2021 Romain Bazile
+#
+# This file is part of the PlanktoScope software.
+#
+# PlanktoScope is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# PlanktoScope is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with PlanktoScope.  If not, see <http://www.gnu.org/licenses/>.
+
+import cv2
+import numpy as np
+
+# Logger library compatible with multiprocessing
+from loguru import logger
+
+import planktoscope.segmenter.bands
+import planktoscope.segmenter.operations
+
+# when the regions around the candidates cover more than this part of the frame, the mask is made
+# on the whole frame, the regions would cost more than they save
+MAXIMUM_COVERAGE = 0.5
+
+# size of the tiles the regions are made of, in pixels
+TILE_SIZE = 256
+
+
+def candidate_regions(mask, scale):
+    """Returns the regions of the frame where the transformations of its mask may not be empty
+
+    The mask is downscaled by keeping the maximum of each block of scale x scale pixels, so a
+    block is a candidate when one of its pixels is in the mask. The candidates are grown by the
+    rows and columns the morphology reads, see bands.MORPHOLOGY_OVERLAP. Outside of them, the
+    mask is empty and stays empty through the morphology.
+
+    The frame is cut in tiles of about TILE_SIZE pixels, and the tiles with grown candidates next
+    to each other in a row of tiles make a region. The number of regions is bounded by the number
+    of tiles, however scattered the candidates are.
+
+    Args:
+        mask (array): thresholded mask of the frame
+        scale (int): size of the blocks, in pixels
+
+    Returns:
+        list: the regions, as tuples of the slices of their rows and columns
+    """
+    height, width = mask.shape
+    # the maximum of the block starting at each pixel, kept for the first pixel of the blocks
+    blocks = cv2.dilate(mask, np.ones((scale, scale), np.uint8), anchor=(0, 0))
+    candidates = (blocks[::scale, ::scale] > 0).astype(np.uint8)
+    del blocks
+    margin = -(-planktoscope.segmenter.bands.MORPHOLOGY_OVERLAP // scale)
+    candidates = cv2.dilate(candidates, np.ones((2 * margin + 1, 2 * margin + 1), np.uint8))
+
+    # the tiles with candidates, the blocks of the last tiles are padded
+    tile_blocks = max(1, TILE_SIZE // scale)
+    tile = tile_blocks * scale
+    tiles_shape = (-(-len(candidates) // tile_blocks), -(-candidates.shape[1] // tile_blocks))
+    padded = np.zeros((tiles_shape[0] * tile_blocks, tiles_shape[1] * tile_blocks), np.uint8)
+    padded[: len(candidates), : candidates.shape[1]] = candidates
+    tiles = padded.reshape(tiles_shape[0], tile_blocks, tiles_shape[1], tile_blocks).any(
+        axis=(1, 3)
+    )
+
+    regions = []
+    for tile_row, row in enumerate(tiles):
+        rows = slice(tile_row * tile, min((tile_row + 1) * tile, height))
+        # the runs of tiles with candidates in this row
+        edges = np.flatnonzero(np.diff(np.concatenate([[False], row, [False]]).astype(np.int8)))
+        for first, last in zip(edges[::2], edges[1::2]):
+            regions.append((rows, slice(first * tile, min(last * tile, width))))
+    return regions
+
+
+def mask(image, scale, transformations, keep=False):
+    """Thresholds the frame and applies the transformations of operations around the objects
+
+    The threshold is operations.simple_threshold on the whole frame, it depends on the histogram
+    of the whole frame. The transformations, which take most of the time, are only applied in the
+    regions around the candidates, see candidate_regions. Each region reads the rows and columns
+    the transformations depend on around it, so the mask is the same as the mask of the whole
+    frame.
+
+    Args:
+        image (array): BGR frame
+        scale (int): size of the blocks looked for candidates, in pixels
+        transformations (list): names of the functions of operations to apply after the
+            threshold, in order
+        keep (bool, optional): also return the mask after the threshold and after each
+            transformation. Defaults to False.
+
+    Returns:
+        tuple: the final mask, and the list of the masks after the threshold and after each
+            transformation if keep
+    """
+    threshold_mask = planktoscope.segmenter.operations.simple_threshold(image)
+    height, width = threshold_mask.shape
+    regions = candidate_regions(threshold_mask, scale)
+    coverage = sum(
+        (rows.stop - rows.start) * (columns.stop - columns.start) for rows, columns in regions
+    )
+    logger.debug(f"The objects are in {len(regions)} regions, {coverage / (height * width):.1%}")
+    if coverage > MAXIMUM_COVERAGE * height * width:
+        # the whole frame, without copies
+        region_mask = threshold_mask
+        steps = [threshold_mask]
+        for transformation in transformations:
+            region_mask = getattr(planktoscope.segmenter.operations, transformation)(region_mask)
+            steps.append(region_mask)
+        return region_mask, steps if keep else []
+
+    overlap = planktoscope.segmenter.bands.MORPHOLOGY_OVERLAP
+    steps = [threshold_mask] + [np.zeros_like(threshold_mask) for _ in transformations]
+    final = np.zeros_like(threshold_mask)
+    for rows, columns in regions:
+        read = (
+            slice(max(rows.start - overlap, 0), min(rows.stop + overlap, height)),
+            slice(max(columns.start - overlap, 0), min(columns.stop + overlap, width)),
+        )
+        produced = (
+            slice(rows.start - read[0].start, rows.stop - read[0].start),
+            slice(columns.start - read[1].start, columns.stop - read[1].start),
+        )
+        region_mask = threshold_mask[read]
+        for i, transformation in enumerate(transformations):
+            region_mask = getattr(planktoscope.segmenter.operations, transformation)(region_mask)
+            if keep:
+                steps[i + 1][rows, columns] = region_mask[produced]
+        final[rows, columns] = region_mask[produced]
+    return final, steps if keep else []
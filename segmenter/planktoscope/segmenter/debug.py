@@ -0,0 +1,153 @@
+# Copyright (C) 2021 Romain Bazile
+#
+# This file is part of the PlanktoScope software.
+#
+# PlanktoScope is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# PlanktoScope is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with PlanktoScope.  If not, see <http://www.gnu.org/licenses/>.
+
+import cv2
+import numpy as np
+
+# tiers of the debug images, from the cheapest
+# no debug images
+NONE = "none"
+# the tagged frame, downscaled
+PREVIEW = "preview"
+# the tagged frame and the labels of its objects, in a single PNG file
+LABELS = "labels"
+# the corrected frame, the mask after each step, the mask of each object and the tagged frame
+FULL = "full"
+TIERS = [NONE, PREVIEW, LABELS, FULL]
+
+
+def parse_tier(keep):
+    """Returns the tier of the debug images asked by the keep setting
+
+    Args:
+        keep (bool or str): true for all the debug images, false for none, or the name of a tier
+
+    Raises:
+        ValueError: the tier is unknown
+
+    Returns:
+        str: the tier
+    """
+    if keep is True:
+        return FULL
+    if keep is False or keep is None:
+        return NONE
+    if keep not in TIERS:
+        raise ValueError(f"The debug images tier {keep} is unknown, it must be one of {TIERS}")
+    return keep
+
+
+class DebugImages:
+    """Chooses the frames that get debug images, and which ones
+
+    The frames are sampled on their index, every few frames. The frames with many objects, where
+    the segmentation is the most likely to go wrong, get their debug images too. Those are only
+    known once the objects are measured, so they get the images made from the objects, not the
+    corrected frame and the masks of the steps.
+    """
+
+    def __init__(self, tier=FULL, every=1, objects=0, scale=4):
+        """Initialize the debug images
+
+        Args:
+            tier (str, optional): tier of the debug images, see TIERS. Defaults to FULL.
+            every (int, optional): the debug images are made for one frame out of every. Defaults
+                to 1.
+            objects (int, optional): the frames with at least this many objects get their debug
+                images even when they are not sampled. Defaults to 0, only the sampled frames.
+            scale (int, optional): the preview is this many times smaller than the frame.
+                Defaults to 4.
+        """
+        self.tier = tier
+        self.every = max(1, every)
+        self.objects = objects
+        self.scale = max(1, scale)
+
+    @property
+    def enabled(self):
+        return self.tier != NONE
+
+    def sampled(self, index):
+        """Returns the tier of the debug images of the frame of the given index, None for none"""
+        if self.enabled and index % self.every == 0:
+            return self.tier
+        return None
+
+    def anomaly(self, objects_count):
+        """Returns the tier of the debug images of a frame not sampled, from its objects"""
+        if self.enabled and self.objects and objects_count >= self.objects:
+            return self.tier
+        return None
+
+    def preview(self, image):
+        """Returns the image downscaled for the preview"""
+        if self.scale == 1:
+            return image
+        return cv2.resize(
+            image,
+            (max(1, image.shape[1] // self.scale), max(1, image.shape[0] // self.scale)),
+            interpolation=cv2.INTER_AREA,
+        )
+
+
+def labels_image(shape, regions):
+    """Returns the labels of the objects of a frame, numbered from 1 like their files
+
+    Args:
+        shape (tuple): shape of the frame
+        regions (dict): properties of the objects, see features.regions_table
+
+    Returns:
+        array: labels of the objects, 0 outside of them, as uint16 to be saved in a PNG file
+    """
+    labels = np.zeros(shape[:2], dtype=np.uint16)
+    for i, (region_slice, image) in enumerate(zip(regions["slice"], regions["image"])):
+        # the numbers wrap after 65535 objects, which no frame has
+        labels[region_slice][image] = (i + 1) % 2**16
+    return labels
+
+
+class DebugCost:
+    """Time spent making and writing the debug images of a tier, and their size"""
+
+    def __init__(self, tier):
+        self.tier = tier
+        self.frames = 0
+        self.images = 0
+        # time spent drawing, encoding and writing the images, in seconds
+        self.busy = 0.0
+        # size of the files written, in bytes
+        self.size = 0
+
+    def add(self, duration, size=0, images=0):
+        self.busy += duration
+        self.size += size
+        self.images += images
+
+    def merge(self, cost):
+        """Adds the cost of the debug images of a frame"""
+        self.frames += 1
+        self.add(cost.busy, cost.size, cost.images)
+
+    def report(self):
+        return {
+            "tier": self.tier,
+            "frames": self.frames,
+            "images": self.images,
+            "busy": self.busy,
+            "size": self.size,
+        }
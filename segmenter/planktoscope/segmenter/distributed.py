@@ -0,0 +1,384 @@
+# Copyright (C) 2021 Romain Bazile
+#
+# This file is part of the PlanktoScope software.
+#
+# PlanktoScope is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# PlanktoScope is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with PlanktoScope.  If not, see <http://www.gnu.org/licenses/>.
+
+import argparse
+import json
+import multiprocessing
+import os
+import shutil
+import signal
+import sys
+import threading
+import time
+
+import cv2
+
+# Logger library compatible with multiprocessing
+from loguru import logger
+
+import planktoscope.segmenter
+import planktoscope.segmenter.batch
+import planktoscope.segmenter.flat
+import planktoscope.segmenter.journal
+import planktoscope.segmenter.workqueue
+
+# number of images of a unit
+UNIT_FRAMES = 100
+
+
+def _find_images(path):
+    # the same images as SegmenterProcess._pipe, in the same order
+    return sorted(
+        entry.name
+        for entry in os.scandir(path)
+        if entry.is_file() and entry.name.endswith(("JPG", "jpg", "JPEG", "jpeg"))
+    )
+
+
+def unit_flat(data_path, path, images_paths, first):
+    """Returns the flat of the unit starting at the image first, see split
+
+    The flat is the one SegmenterProcess._pipe would use if it calculated it again on the first
+    image of the unit: the median of the images from first, or of the last ones at the end. The
+    flat of the first unit is the first one of _pipe. The flats are shared through the flats cache.
+    """
+    flat_window = min(planktoscope.segmenter.flat.FLAT_WINDOW, len(images_paths))
+    if not flat_window % 2:
+        flat_window -= 1
+    flat_first = min(first, len(images_paths) - flat_window)
+    flat_cache = planktoscope.segmenter.flat.FlatCache(
+        os.path.join(data_path, "flat/"), os.path.relpath(path, os.path.join(data_path, "img/"))
+    )
+    flat_key = flat_cache.key(images_paths[flat_first : flat_first + flat_window])
+    flat = flat_cache.load(flat_key)
+    if flat is None:
+        flat = planktoscope.segmenter.flat.median(
+            [
+                cv2.imread(filepath)
+                for filepath in images_paths[flat_first : flat_first + flat_window]
+            ]
+        )
+        flat_cache.save(flat_key, flat)
+    return flat
+
+
+def split(queue, data_path, path, settings, frames=UNIT_FRAMES):
+    """Splits an acquisition into units of consecutive images, and queues them
+
+    The units of an acquisition are named after its images and the settings, without the ids of
+    the process that change on every run, so the units queued by a previous coordinator are not
+    queued again.
+
+    Args:
+        queue (planktoscope.segmenter.workqueue.WorkQueue): the queue
+        data_path (str): data path, the acquisition is in its img folder
+        path (str): folder of the acquisition
+        settings (dict): settings of the segment message
+        frames (int, optional): number of images of a unit. Defaults to UNIT_FRAMES.
+
+    Raises:
+        FileNotFoundError: the acquisition has no images
+
+    Returns:
+        list: the ids of the units, in the order of their images
+    """
+    images_list = _find_images(path)
+    if not images_list:
+        raise FileNotFoundError(f"There is no image to segment in {path}")
+    images_paths = [os.path.join(path, filename) for filename in images_list]
+    key = planktoscope.segmenter.journal.journal_key(
+        images_paths + [os.path.join(path, "metadata.json")],
+        {
+            "settings": {
+                key: value
+                for key, value in settings.items()
+                if key not in ("process_datetime", "process_uuid", "process_id")
+            },
+            "frames": frames,
+        },
+    )[:16]
+
+    unit_ids = []
+    for first in range(0, len(images_list), frames):
+        unit_id = f"{key}-{first:06d}"
+        flat_name = f"{unit_id}.npy"
+        if not os.path.exists(queue.flat_path(flat_name)):
+            queue.save_flat(flat_name, unit_flat(data_path, path, images_paths, first))
+        unit = {
+            "id": unit_id,
+            "acquisition": os.path.relpath(path, os.path.join(data_path, "img")),
+            "images": images_list[first : first + frames],
+            "first": first,
+            # the mask of the previous image is removed with remove_previous_mask
+            "previous": images_list[first - 1] if first else None,
+            "flat": flat_name,
+            "settings": settings,
+            "ecotaxa": settings.get("ecotaxa", True),
+        }
+        queue.put(unit)
+        unit_ids.append(unit["id"])
+    logger.info(f"{path} is split into {len(unit_ids)} units")
+    return unit_ids
+
+
+def _heartbeat(queue, unit_id, done):
+    while not done.wait(planktoscope.segmenter.workqueue.HEARTBEAT):
+        if not queue.heartbeat(unit_id):
+            logger.warning(f"The unit {unit_id} is not claimed by this worker anymore")
+            return
+
+
+def work(data_path, queue_root, poll=1.0, exit_when_empty=False, stop_event=None):
+    """Segments the units of the queue until the coordinator is done
+
+    Args:
+        data_path (str): data path, the acquisitions are in its img folder
+        queue_root (str): folder of the queue
+        poll (float, optional): time between two looks at an empty queue, in seconds. Defaults
+            to 1.0.
+        exit_when_empty (bool, optional): stop once there are no pending units, instead of
+            waiting for the coordinator. Defaults to False.
+        stop_event (threading.Event, optional): stops the worker once its unit is done, a
+            multiprocessing.Event in the processes of the coordinator. Defaults to None.
+
+    Returns:
+        int: the number of units done
+    """
+    queue = planktoscope.segmenter.workqueue.WorkQueue(queue_root)
+    process = planktoscope.segmenter.SegmenterProcess(multiprocessing.Event(), data_path)
+    done = 0
+    while stop_event is None or not stop_event.is_set():
+        unit = queue.claim()
+        if unit is None:
+            if exit_when_empty or queue.finished:
+                break
+            time.sleep(poll)
+            continue
+
+        heartbeat_done = threading.Event()
+        heartbeat = threading.Thread(
+            target=_heartbeat, args=(queue, unit["id"], heartbeat_done), daemon=True
+        )
+        heartbeat.start()
+        result_path = None
+        try:
+            process.configure(unit["settings"])
+            result_path = queue.start_result(unit["id"])
+            result = process.segment_unit(
+                os.path.join(data_path, "img", unit["acquisition"]),
+                unit,
+                queue.load_flat(unit["flat"]),
+                result_path,
+            )
+            if queue.commit(unit["id"], result_path, result):
+                done += 1
+        except Exception as e:
+            logger.exception(f"The unit {unit['id']} failed")
+            if result_path is not None:
+                shutil.rmtree(result_path, ignore_errors=True)
+            queue.fail(unit["id"], unit, str(e))
+        finally:
+            heartbeat_done.set()
+            heartbeat.join()
+    logger.info(f"This worker is done, it segmented {done} units")
+    return done
+
+
+def run_local_worker(data_path, queue_root, poll, stop_event, log_level):
+    """Runs a worker in a process of the coordinator, it stops with the coordinator"""
+    # the coordinator tells the workers to stop, once their unit is done
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    logger.remove()
+    logger.add(sys.stderr, level=log_level)
+    work(data_path, queue_root, poll, stop_event=stop_event)
+
+
+def coordinate(parser, args):
+    """Queues the units of the acquisitions, and merges them once their units are done"""
+    data_path, acquisitions = planktoscope.segmenter.batch.find_acquisitions(parser, args)
+    settings = planktoscope.segmenter.batch.settings_of(args)
+    ecotaxa_export = settings["ecotaxa"]
+    queue = planktoscope.segmenter.workqueue.WorkQueue(os.path.abspath(args.queue))
+    queue.reopen()
+
+    stop_event = planktoscope.segmenter.batch.stop_on_signals()
+    context = multiprocessing.get_context("spawn")
+    # set by the coordinator once it is asked to stop, not by the signal handler
+    workers_stop_event = context.Event()
+
+    start = time.monotonic()
+    # spawn instead of fork, as the pool of the workers
+    workers = [
+        context.Process(
+            target=run_local_worker,
+            args=(data_path, queue.root, args.poll, workers_stop_event, args.log_level),
+            name=f"segmenter-worker-{i}",
+        )
+        for i in range(args.local_workers)
+    ]
+    # the workers segment the first units while the flats of the next ones are calculated
+    for worker in workers:
+        worker.start()
+
+    results = []
+    # units of the acquisitions not merged yet
+    pending = {}
+    for path in acquisitions:
+        if stop_event.is_set():
+            break
+        try:
+            pending[path] = split(queue, data_path, path, settings, args.frames)
+        except Exception as e:
+            logger.exception(f"{path} can't be split into units")
+            results.append({"path": path, "status": str(e)})
+    logger.info(f"Segmenting {len(pending)} acquisitions with {args.local_workers} local workers")
+
+    process = planktoscope.segmenter.SegmenterProcess(multiprocessing.Event(), data_path)
+    process.configure(settings)
+    process.open_locally(planktoscope.segmenter.batch.LocalClient())
+    try:
+        while pending and not stop_event.is_set():
+            queue.requeue_stale()
+            for path, unit_ids in list(pending.items()):
+                states = [queue.state(unit_id) for unit_id in unit_ids]
+                if planktoscope.segmenter.workqueue.FAILED in states:
+                    unit_id = unit_ids[states.index(planktoscope.segmenter.workqueue.FAILED)]
+                    logger.error(f"The unit {unit_id} of {path} failed")
+                    results.append({"path": path, "status": queue.error(unit_id)})
+                    # the workers don't segment the other units of an acquisition not merged
+                    for other_id in unit_ids:
+                        queue.cancel(other_id)
+                    del pending[path]
+                elif all(state == planktoscope.segmenter.workqueue.DONE for state in states):
+                    try:
+                        summary = process.merge_units(
+                            path,
+                            [
+                                (queue.result_path(unit_id), queue.result(unit_id))
+                                for unit_id in unit_ids
+                            ],
+                            ecotaxa_export,
+                        )
+                    except Exception as e:
+                        logger.exception(f"The units of {path} can't be merged")
+                        results.append({"path": path, "status": str(e)})
+                    else:
+                        # the time from the start of the coordinator, the units ran in parallel
+                        results.append(
+                            dict(
+                                summary,
+                                units=len(unit_ids),
+                                merge_duration=summary["duration"],
+                                duration=time.monotonic() - start,
+                            )
+                        )
+                        for unit_id in unit_ids:
+                            queue.remove(unit_id)
+                    del pending[path]
+            time.sleep(args.poll)
+    finally:
+        process.close_locally()
+        if pending or stop_event.is_set():
+            # interrupted, the workers stop once their unit is done
+            workers_stop_event.set()
+        else:
+            # the workers stop once the queue is empty
+            queue.finish()
+        for worker in workers:
+            worker.join()
+
+    print(
+        json.dumps(
+            planktoscope.segmenter.batch.summary(
+                results, time.monotonic() - start, stop_event.is_set()
+            ),
+            indent=2,
+        )
+    )
+    if stop_event.is_set():
+        return 130
+    return 0 if all("status" not in result for result in results) else 1
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Segments acquisitions with several workers sharing a queue folder, on one "
+        "machine or on several machines mounting the data path and the queue"
+    )
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    coordinator = commands.add_parser(
+        "coordinator",
+        help="split the acquisitions into units, and merge their results into EcoTaxa archives",
+    )
+    planktoscope.segmenter.batch.add_arguments(coordinator)
+    coordinator.add_argument("--queue", required=True, help="folder of the queue")
+    coordinator.add_argument(
+        "--frames",
+        type=int,
+        default=UNIT_FRAMES,
+        help=f"number of images of a unit, {UNIT_FRAMES} by default",
+    )
+    coordinator.add_argument(
+        "--local-workers",
+        type=int,
+        default=os.cpu_count() or 1,
+        help="number of workers started by the coordinator, the number of cores by default",
+    )
+    coordinator.add_argument(
+        "--poll", type=float, default=1.0, help="time between two looks at the queue, 1s by default"
+    )
+
+    worker = commands.add_parser("worker", help="segment the units of the queue")
+    worker.add_argument(
+        "--data-path",
+        default=planktoscope.segmenter.batch.DATA_PATH,
+        help=f"data path, {planktoscope.segmenter.batch.DATA_PATH} by default",
+    )
+    worker.add_argument("--queue", required=True, help="folder of the queue")
+    worker.add_argument(
+        "--exit-when-empty",
+        action="store_true",
+        help="stop once there are no pending units, instead of waiting for the coordinator",
+    )
+    worker.add_argument(
+        "--poll", type=float, default=1.0, help="time between two looks at the queue, 1s by default"
+    )
+    worker.add_argument("--log-level", default="INFO", help="level of the logs, INFO by default")
+    args = parser.parse_args(argv)
+
+    logger.remove()
+    logger.add(sys.stderr, level=args.log_level)
+
+    if args.command == "coordinator":
+        if args.frames < 1:
+            parser.error("A unit has at least one image")
+        return coordinate(parser, args)
+
+    stop_event = planktoscope.segmenter.batch.stop_on_signals()
+    work(
+        os.path.abspath(args.data_path),
+        os.path.abspath(args.queue),
+        args.poll,
+        args.exit_when_empty,
+        stop_event,
+    )
+    return 130 if stop_event.is_set() else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -19,11 +19,17 @@
 from loguru import logger
 
 
+import contextlib
+import csv
+import io
+import math
 import numpy
-import pandas  # FIXME: just use python's csv library, to shave off pandas's 60 MB of unnecessary disk space usage
+import struct
 import zipfile
+import zlib
 import os
-import io
+
+import planktoscope.segmenter.features
 
 """
 Example of metadata file received
@@ -202,85 +208,204 @@ The metadata and data for each image is organised in various levels (image, obje
 """
 
 
-def dtype_to_ecotaxa(dtype):
-    """Determines the EcoTaxa header field type annotation for the dtype"""
-    # Note: this code was copied from the MIT-licensed MorphoCut library at
-    # https://github.com/morphocut/morphocut/blob/0.1.2/src/morphocut/contrib/ecotaxa.py .
-    # The MorphoCut library is copyright 2019 Simon-Martin Schroeder and others.
-    try:
-        if numpy.issubdtype(dtype, numpy.number):
-            return "[f]"
-    except TypeError:  # pragma: no cover
-        print(type(dtype))
-        raise
-
+def type_to_ecotaxa(value):
+    """Determines the EcoTaxa header field type annotation for the value"""
+    if isinstance(value, (int, float, numpy.number)) and not isinstance(value, (bool, numpy.bool_)):
+        return "[f]"
     return "[t]"
 
 
-def ecotaxa_export(archive_filepath, metadata, image_base_path, keep_files=False):
-    """Generates the archive compatible with an export to ecotaxa
+def _object_types(features):
+    """Returns the types of the columns of the objects, from the schema of their features
+
+    Raises:
+        ValueError: a feature is not in the schema, see features.feature_names
+    """
+    # the features the objects may have, all with the extended colour statistics
+    unknown = set(features) - set(planktoscope.segmenter.features.feature_names(extended=True))
+    if unknown:
+        raise ValueError(f"The features {sorted(unknown)} are not in the schema of the objects")
+    types = {f"object_{name}": "[f]" for name in features}
+    types.update({"object_id": "[t]", "img_file_name": "[t]", "img_rank": "[f]"})
+    return types
+
+
+def value_to_ecotaxa(value):
+    """Formats the value for the EcoTaxa table, missing values are left empty"""
+    if value is None:
+        return ""
+    if isinstance(value, (float, numpy.floating)):
+        return "" if math.isnan(value) else repr(float(value))
+    return str(value)
+
+
+# local file header of a zip archive: signature, versions, flags, compression, time, date, crc,
+# sizes and lengths of the name and of the extra field
+LOCAL_FILE_HEADER = struct.Struct("<4s2B4HL2L2H")
+
+
+def _read_files(archive_file, size):
+    """Yields the names and contents of the files of an archive that was not closed
+
+    Only the archives of EcotaxaArchive can be read this way, their files are stored and their
+    sizes are known before they are written.
 
     Args:
-        archive_filepath (str): path where you want the archive to be saved.
-        metadata (dict): metadata regarding the files you want to export
-        image_base_path (str): path where the files where saved
-        keep_files (bool, optional): Whether to keep the original files or just the archive. Defaults to False (keep the archive only).
+        archive_file (file): the archive, opened in binary mode
+        size (int): size of the archive to read
+
+    Raises:
+        zipfile.BadZipFile: the archive is corrupted
     """
-    logger.info("Starting the ecotaxa archive export")
-    with zipfile.ZipFile(archive_filepath, "w") as archive:
-        # empty table, one line per object
-        tsv_content = []
+    while archive_file.tell() < size:
+        (
+            signature,
+            _,
+            _,
+            flags,
+            compression,
+            _,
+            _,
+            crc,
+            compressed_size,
+            _,
+            name_length,
+            extra_length,
+        ) = LOCAL_FILE_HEADER.unpack(archive_file.read(LOCAL_FILE_HEADER.size))
+        if signature != b"PK\x03\x04" or compression != zipfile.ZIP_STORED:
+            raise zipfile.BadZipFile(f"Unexpected file at {archive_file.tell()}")
+        name = archive_file.read(name_length).decode("utf-8" if flags & 0x800 else "cp437")
+        archive_file.seek(extra_length, os.SEEK_CUR)
+        data = archive_file.read(compressed_size)
+        if zlib.crc32(data) != crc:
+            raise zipfile.BadZipFile(f"Bad CRC-32 for {name}")
+        yield name, data
 
-        if "objects" in metadata:
-            object_list = metadata.pop("objects")
-        else:
-            logger.error("No objects metadata recorded, cannot continue the export")
-            return 0
 
-        # sometimes the camera resolution is not exported as string
-        if not isinstance(metadata["acq_camera_resolution"], str):
-            metadata["acq_camera_resolution"] = (
-                f"{metadata['acq_camera_resolution'][0]}x{metadata['acq_camera_resolution'][1]}"
-            )
+class EcotaxaArchive:
+    """Archive compatible with an export to ecotaxa, written while the objects are segmented
+
+    The images of the objects can be added as they are encoded, without going through the disk.
+    The table is written last, since a file cannot be added while another one is being written.
+
+    An archive interrupted by an error is left without its table of contents, so that it can't be
+    mistaken for an export, and it can be resumed from its last checkpoint.
+    """
 
-        # let's go!
-        for rank, roi in enumerate(object_list, start=1):
-            tsv_line = {}
-            tsv_line.update(metadata)
-            tsv_line.update(("object_" + k, v) for k, v in roi["metadata"].items())
-            tsv_line["object_id"] = roi["name"]
+    def __init__(self, archive_filepath, size=None):
+        """Creates the archive
 
-            filename = roi["name"] + ".jpg"
+        Args:
+            archive_filepath (str): path where you want the archive to be saved.
+            size (int, optional): size of the interrupted archive to resume, see checkpoint.
+                Defaults to None, to start a new archive.
+        """
+        self.archive_filepath = archive_filepath
+        partial_filepath = f"{archive_filepath}.partial"
+        if size and not os.path.exists(partial_filepath):
+            # the partial archive is kept until it is copied, in case this is interrupted too
+            os.replace(archive_filepath, partial_filepath)
+        self.__file = open(archive_filepath, "w+b")
+        self.__archive = zipfile.ZipFile(self.__file, "w")
+        if size:
+            logger.info(f"Resuming {archive_filepath}")
+            with open(partial_filepath, "rb") as partial_file:
+                for filename, data in _read_files(partial_file, size):
+                    self.add_image(filename, data)
+            os.remove(partial_filepath)
 
-            tsv_line.update({"img_file_name": filename, "img_rank": 1})
-            tsv_content.append(tsv_line)
+    def __enter__(self):
+        return self
 
-            image_path = os.path.join(image_base_path, filename)
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+            return
+        # the table of contents written on close is removed
+        size = self.__file.tell()
+        self.close()
+        with open(self.archive_filepath, "r+b") as archive_file:
+            archive_file.truncate(size)
 
-            archive.write(image_path, arcname=filename)
-            if not keep_files:
-                # we remove the image file if we don't want to keep it!
-                os.remove(image_path)
+    def checkpoint(self):
+        """Makes sure the files added so far reached the disk
 
-        tsv_content = pandas.DataFrame(tsv_content)
+        Returns:
+            int: size of the archive, to resume it as it is now, see EcotaxaArchive
+        """
+        self.__file.flush()
+        os.fsync(self.__file.fileno())
+        return self.__file.tell()
 
-        tsv_type_header = [dtype_to_ecotaxa(dt) for dt in tsv_content.dtypes]
-        tsv_content.columns = pandas.MultiIndex.from_tuples(
-            list(zip(tsv_content.columns, tsv_type_header))
-        )
+    def add_image(self, filename, data):
+        """Adds an encoded image to the archive
+
+        Args:
+            filename (str): name of the image in the archive
+            data (bytes): the image file
+        """
+        self.__archive.writestr(filename, data)
+
+    def write_table(self, metadata, objects, tsv_folder=None):
+        """Writes the table of the objects, one object at a time
+
+        The columns are the ones of the first object. The features of the objects are numbers,
+        see features.feature_names, only the types of the metadata are guessed from their values.
+
+        Args:
+            metadata (dict): metadata of the acquisition, repeated for each object
+            objects (iterable): metadata of the objects, like an ObjectStore
+            tsv_folder (str, optional): folder where to also save the table. Defaults to None.
+        """
+        # sometimes the camera resolution is not exported as string
+        if not isinstance(metadata["acq_camera_resolution"], str):
+            metadata["acq_camera_resolution"] = (
+                f"{metadata['acq_camera_resolution'][0]}x{metadata['acq_camera_resolution'][1]}"
+            )
 
         # create the filename with the acquisition ID
         acquisition_id = metadata.get("acq_id")
         acquisition_id = acquisition_id.replace(" ", "_")
         tsv_filename = f"ecotaxa_{acquisition_id}.tsv"
 
-        # add the tsv to the archive
-        archive.writestr(
-            tsv_filename,
-            io.BytesIO(tsv_content.to_csv(sep="\t", encoding="utf-8", index=False).encode()).read(),
-        )
-        if keep_files:
-            tsv_file = os.path.join(image_base_path, tsv_filename)
-            tsv_content.to_csv(path_or_buf=tsv_file, sep="\t", encoding="utf-8", index=False)
-    logger.success("Ecotaxa archive is ready!")
-    return 1
+        with contextlib.ExitStack() as stack:
+            tsv_files = [
+                stack.enter_context(
+                    io.TextIOWrapper(
+                        self.__archive.open(tsv_filename, "w"), encoding="utf-8", newline=""
+                    )
+                )
+            ]
+            if tsv_folder is not None:
+                tsv_path = os.path.join(tsv_folder, tsv_filename)
+                tsv_files.append(
+                    stack.enter_context(open(tsv_path, "w", encoding="utf-8", newline=""))
+                )
+            writers = [
+                csv.writer(tsv_file, delimiter="\t", lineterminator="\n") for tsv_file in tsv_files
+            ]
+
+            # the metadata are free-form, their types are the ones of their values
+            types = {key: type_to_ecotaxa(value) for key, value in metadata.items()}
+            header = None
+            # one line per object
+            for roi in objects:
+                tsv_line = {}
+                tsv_line.update(metadata)
+                tsv_line.update(("object_" + k, v) for k, v in roi["metadata"].items())
+                tsv_line["object_id"] = roi["name"]
+                tsv_line.update({"img_file_name": roi["name"] + ".jpg", "img_rank": 1})
+
+                if header is None:
+                    header = list(tsv_line)
+                    types.update(_object_types(roi["metadata"]))
+                    for writer in writers:
+                        writer.writerow(header)
+                        writer.writerow([types[name] for name in header])
+                row = [value_to_ecotaxa(tsv_line.get(name)) for name in header]
+                for writer in writers:
+                    writer.writerow(row)
+
+    def close(self):
+        self.__archive.close()
+        self.__file.close()
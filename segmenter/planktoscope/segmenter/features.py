@@ -0,0 +1,340 @@
+# Copyright (C) 2021 Romain Bazile
+#
+# This file is part of the PlanktoScope software.
+#
+# PlanktoScope is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# PlanktoScope is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with PlanktoScope.  If not, see <http://www.gnu.org/licenses/>.
+
+import cv2
+import numpy as np
+import skimage.measure
+
+# regionprops properties of the objects, the features are derived from them
+PROPERTIES = [
+    "area",
+    "area_bbox",
+    "area_convex",
+    "area_filled",
+    "axis_major_length",
+    "axis_minor_length",
+    "bbox",
+    "centroid",
+    "centroid_local",
+    "eccentricity",
+    "equivalent_diameter_area",
+    "euler_number",
+    "extent",
+    "image",
+    "image_filled",
+    "orientation",
+    "perimeter",
+    "slice",
+    "solidity",
+]
+
+
+# quantiles of the colour channels in the extended colour statistics, by feature name prefix
+QUANTILES = {
+    "min": 0,
+    "Q05": 0.05,
+    "Q25": 0.25,
+    "Q50": 0.50,
+    "Q75": 0.75,
+    "Q95": 0.95,
+    "max": 1,
+}
+
+
+# names of the features of features_table, in order
+FEATURES = [
+    "label",
+    "width",
+    "height",
+    "bx",
+    "by",
+    "circ.",
+    "area_exc",
+    "area",
+    "%area",
+    "major",
+    "minor",
+    "y",
+    "x",
+    "convex_area",
+    "perim.",
+    "elongation",
+    "perimareaexc",
+    "perimmajor",
+    "circex",
+    "angle",
+    "bounding_box_area",
+    "eccentricity",
+    "equivalent_diameter",
+    "euler_number",
+    "extent",
+    "local_centroid_col",
+    "local_centroid_row",
+    "solidity",
+]
+
+# channels of the colour statistics of color_table, and the ones of the extended statistics
+COLOR_CHANNELS = ["Hue", "Saturation", "Value"]
+EXTENDED_COLOR_CHANNELS = ["RedLevel", "GreenLevel", "BlueLevel"]
+
+
+def color_names(extended=False):
+    """Returns the names of the colour statistics of color_table, in order"""
+    channels = COLOR_CHANNELS + (EXTENDED_COLOR_CHANNELS if extended else [])
+    # the HSV means and standard deviations come first, as they always did
+    names = [f"{statistic}{name}" for statistic in ("Mean", "Std") for name in COLOR_CHANNELS]
+    for name in channels:
+        for statistic in ("Mean", "Std"):
+            if f"{statistic}{name}" not in names:
+                names.append(f"{statistic}{name}")
+        if extended:
+            names += [f"{prefix}{name}" for prefix in QUANTILES]
+            names += [f"Skew{name}", f"Kurt{name}"]
+    return names
+
+
+def feature_names(extended=False):
+    """Returns the names of the features of the objects, see FrameSegmenter.measure
+
+    All the features are numbers, the EcoTaxa table declares them as such.
+
+    Args:
+        extended (bool, optional): with the extended colour statistics. Defaults to False.
+    """
+    # the blur is measured by FrameSegmenter, between the features and the colours
+    return FEATURES + ["blur_laplacian"] + color_names(extended)
+
+
+def label_components(mask):
+    """Labels the connected components of the mask, in 8-connectivity, with their areas
+
+    The labels are the ones of skimage.measure.label, numbered from 1 in raster order, the Wu
+    algorithm of OpenCV numbers them in this order too. The areas are counted in the same pass.
+
+    Args:
+        mask (array): mask of the frame
+
+    Returns:
+        tuple: the labels, as int32, and the area of each label, the background first
+    """
+    _, labels, stats, _ = cv2.connectedComponentsWithStatsWithAlgorithm(
+        mask, 8, cv2.CV_32S, cv2.CCL_WU
+    )
+    return labels, stats[:, cv2.CC_STAT_AREA]
+
+
+def label_objects(mask, min_esd):
+    """Labels the objects of the mask that are big enough
+
+    The size is filtered on the areas of all the labels at once, so the properties of the small
+    objects are never computed.
+
+    Args:
+        mask (array): mask of the frame
+        min_esd (float): minimum equivalent spherical diameter of the objects, in pixels
+
+    Returns:
+        tuple: the labels of the objects, numbered from 1 in raster order, and the number of
+            labels before filtering
+    """
+    labels, area = label_components(mask)
+    nlabels = len(area) - 1
+    # the same diameter as regionprops equivalent_diameter_area
+    diameter = (4 * area / np.pi) ** (1 / 2)
+    kept = diameter >= min_esd
+    kept[0] = False
+    # new label of each label, 0 for the filtered ones
+    relabel = np.zeros(nlabels + 1, dtype=np.int32)
+    relabel[kept] = np.arange(1, np.count_nonzero(kept) + 1, dtype=np.int32)
+    return relabel[labels], nlabels
+
+
+def regions_table(labels):
+    """Returns the regionprops properties of the labelled objects, as columns"""
+    return skimage.measure.regionprops_table(labels, properties=PROPERTIES)
+
+
+def features_table(regions):
+    """Returns the EcoTaxa features of the objects, as columns
+
+    Args:
+        regions (dict): properties of the objects, see regions_table
+
+    Returns:
+        dict: arrays of the features, by name
+    """
+    area = regions["area"]
+    filled_area = regions["area_filled"]
+    perimeter = regions["perimeter"]
+    major = regions["axis_major_length"]
+    minor = regions["axis_minor_length"]
+    # degenerate objects give infinite or undefined ratios, as they did one object at a time
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return {
+            # objects are numbered from 0 in each frame
+            "label": np.arange(len(area)),
+            # width of the smallest rectangle enclosing the object
+            "width": regions["bbox-3"] - regions["bbox-1"],
+            # height of the smallest rectangle enclosing the object
+            "height": regions["bbox-2"] - regions["bbox-0"],
+            # X coordinates of the top left point of the smallest rectangle enclosing the object
+            "bx": regions["bbox-1"],
+            # Y coordinates of the top left point of the smallest rectangle enclosing the object
+            "by": regions["bbox-0"],
+            # circularity : (4∗π ∗Area)/Perim^2 a value of 1 indicates a perfect circle, a value approaching 0 indicates an increasingly elongated polygon
+            "circ.": (4 * np.pi * filled_area) / perimeter**2,
+            # Surface area of the object excluding holes, in square pixels (=Area*(1-(%area/100))
+            "area_exc": area,
+            # Surface area of the object in square pixels
+            "area": filled_area,
+            # Percentage of object’s surface area that is comprised of holes, defined as the background grey level
+            "%area": 1 - (area / filled_area),
+            # Primary axis of the best fitting ellipse for the object
+            "major": major,
+            # Secondary axis of the best fitting ellipse for the object
+            "minor": minor,
+            # Y position of the center of gravity of the object
+            "y": regions["centroid-0"],
+            # X position of the center of gravity of the object
+            "x": regions["centroid-1"],
+            # The area of the smallest polygon within which all points in the object fit
+            "convex_area": regions["area_convex"],
+            # The length of the outside boundary of the object
+            "perim.": perimeter,
+            # major/minor
+            "elongation": np.divide(major, minor),
+            # perim/area_exc
+            "perimareaexc": perimeter / area,
+            # perim/major
+            "perimmajor": perimeter / major,
+            # (4 ∗ π ∗ Area_exc)/perim 2
+            "circex": np.divide(4 * np.pi * area, perimeter**2),
+            # Angle between the primary axis and a line parallel to the x-axis of the image
+            "angle": regions["orientation"] / np.pi * 180 + 90,
+            "bounding_box_area": regions["area_bbox"],
+            "eccentricity": regions["eccentricity"],
+            "equivalent_diameter": regions["equivalent_diameter_area"],
+            "euler_number": regions["euler_number"],
+            "extent": regions["extent"],
+            "local_centroid_col": regions["centroid_local-1"],
+            "local_centroid_row": regions["centroid_local-0"],
+            "solidity": regions["solidity"],
+        }
+
+
+def _quantiles(histograms, count, quantile):
+    """Returns the quantile of the objects values, interpolated like numpy.quantile"""
+    cumulative = histograms.cumsum(axis=1)
+    # rank of the quantile in the sorted values, as numpy computes it for the linear method
+    rank = (count - 1) * quantile
+    previous_rank = np.minimum(np.floor(rank), count - 1)
+    next_rank = np.minimum(previous_rank + 1, count - 1)
+    previous_value = (cumulative <= previous_rank[:, None]).sum(axis=1)
+    next_value = (cumulative <= next_rank[:, None]).sum(axis=1)
+    gamma = rank - previous_rank
+    difference = next_value - previous_value
+    return np.where(
+        gamma >= 0.5,
+        next_value - difference * (1 - gamma),
+        previous_value + difference * gamma,
+    )
+
+
+def object_pixels(image, labels):
+    """Returns the colours of the pixels of the objects, without their holes
+
+    Args:
+        image (array): BGR frame
+        labels (array): labels of the objects, see label_objects
+
+    Returns:
+        tuple: the BGR colours of the pixels, and the index of their object
+    """
+    inside = np.flatnonzero(labels.ravel() != 0)
+    return image.reshape(-1, 3)[inside], labels.ravel()[inside].astype(np.intp) - 1
+
+
+def color_table(image, objects_pixels, regions, extended=False):
+    """Returns the colour statistics of the filled objects, as columns
+
+    The statistics are computed from the histograms of the channels in each object, which are
+    accumulated over the pixels of all the objects in one pass per channel, so this scales with
+    the number of pixels in the objects rather than with the number of objects.
+
+    Args:
+        image (array): BGR frame
+        objects_pixels (tuple): colours of the pixels of the objects, see object_pixels
+        regions (dict): properties of the objects, see regions_table
+        extended (bool, optional): also compute the statistics of the RGB channels, and the
+            quantiles, skewness and kurtosis of all the channels. Defaults to False.
+
+    Returns:
+        dict: arrays of the statistics, by name
+    """
+    nobjects = len(regions["slice"])
+    if not nobjects:
+        return {}
+    # the holes are not in the labels, they are added one at a time
+    pixels = [objects_pixels[0]]
+    pixels_labels = [objects_pixels[1]]
+    for i, (region_slice, region_image, filled_image) in enumerate(
+        zip(regions["slice"], regions["image"], regions["image_filled"])
+    ):
+        hole = filled_image & ~region_image
+        if hole.any():
+            pixels.append(image[region_slice][hole])
+            pixels_labels.append(np.full(np.count_nonzero(hole), i, dtype=np.intp))
+    bgr_pixels = np.concatenate(pixels)
+    # one bin per object and value
+    bins = np.concatenate(pixels_labels) * 256
+
+    # only the pixels of the objects are converted
+    hsv_pixels = cv2.cvtColor(bgr_pixels[:, None, :], cv2.COLOR_BGR2HSV)[:, 0, :]
+    channels = dict(zip(COLOR_CHANNELS, hsv_pixels.T))
+    if extended:
+        # RGB, from the BGR pixels
+        channels.update(zip(EXTENDED_COLOR_CHANNELS, bgr_pixels[:, ::-1].T))
+
+    values = np.arange(256)
+    statistics = {}
+    for name, channel in channels.items():
+        histograms = np.bincount(bins + channel, minlength=nobjects * 256).reshape(nobjects, 256)
+        count = histograms.sum(axis=1)
+        # the sum of the values is exact, so the mean is the one of numpy.mean
+        mean = (histograms @ values) / count
+        deviations = values - mean[:, None]
+        variance = (histograms * deviations**2).sum(axis=1) / count
+        statistics[f"Mean{name}"] = mean
+        statistics[f"Std{name}"] = np.sqrt(variance)
+        if extended:
+            for prefix, quantile in QUANTILES.items():
+                statistics[f"{prefix}{name}"] = _quantiles(histograms, count, quantile)
+            # biased skewness and excess kurtosis, undefined for uniform objects
+            with np.errstate(divide="ignore", invalid="ignore"):
+                uniform = variance == 0
+                skewness = (histograms * deviations**3).sum(axis=1) / count / variance**1.5
+                kurtosis = (histograms * deviations**4).sum(axis=1) / count / variance**2 - 3
+            statistics[f"Skew{name}"] = np.where(uniform, np.nan, skewness)
+            statistics[f"Kurt{name}"] = np.where(uniform, np.nan, kurtosis)
+
+    return {name: statistics[name] for name in color_names(extended)}
+
+
+def records(table):
+    """Returns one dictionary per object from columns of the same length"""
+    names = list(table)
+    return [dict(zip(names, values)) for values in zip(*table.values())]
@@ -0,0 +1,246 @@
+# Copyright (C) 2021 Romain Bazile
+#
+# This file is part of the PlanktoScope software.
+#
+# PlanktoScope is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# PlanktoScope is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with PlanktoScope.  If not, see <http://www.gnu.org/licenses/>.
+
+import hashlib
+import json
+import os
+
+import cv2
+import numpy as np
+import skimage.exposure
+
+# Logger library compatible with multiprocessing
+from loguru import logger
+
+# Number of frames used to calculate the flat, must be odd
+FLAT_WINDOW = 9
+
+# Version of the flat calculation, to change when the calculation changes
+FLAT_VERSION = 1
+
+# Maximum size of the flat cache, in MB
+FLAT_CACHE_SIZE = int(os.getenv("SEGMENTER_FLAT_CACHE_SIZE", "1024")) * 1024 * 1024
+
+# Ratio of a pixel to the flat mapped to white by the correction
+FLAT_CORRECTION_MAX = 1.04
+
+# Number of rows corrected at a time, this bounds the memory used by the correction
+FLAT_CORRECTION_ROWS = 128
+
+# Number of rows of the frames sorted at a time by the median, the frames are not copied whole
+FLAT_MEDIAN_ROWS = 16
+
+
+def _correction_table():
+    """Returns the corrected value of every pair of flat and pixel values
+
+    The value of the pixel p with the flat f is at the index f * 256 + p.
+    """
+    flat, pixel = np.meshgrid(np.arange(256.0), np.arange(256.0), indexing="ij")
+    # a black flat gives infinite or undefined ratios, as with the division of whole images
+    with np.errstate(divide="ignore", invalid="ignore"):
+        table = skimage.exposure.rescale_intensity(
+            pixel / flat, in_range=(0, FLAT_CORRECTION_MAX), out_range="uint8"
+        )
+    return table.ravel()
+
+
+# Corrected values by flat and pixel values, see _correction_table
+CORRECTION_TABLE = _correction_table()
+
+
+# Compare-exchanges of the median of 9 values, the median ends at index 4, see median
+MEDIAN_9_NETWORK = [
+    (1, 2), (4, 5), (7, 8), (0, 1), (3, 4), (6, 7), (1, 2), (4, 5), (7, 8), (0, 3),
+    (5, 8), (4, 7), (3, 6), (1, 4), (2, 5), (4, 7), (4, 2), (6, 4), (4, 2),
+]  # fmt: skip
+
+
+def _median_network(count):
+    """Returns compare-exchanges leaving the median of count values at index count // 2"""
+    if count == FLAT_WINDOW:
+        return MEDIAN_9_NETWORK
+    # odd-even transposition sort, for the short acquisitions
+    return [(k, k + 1) for rank in range(count) for k in range(rank % 2, count - 1, 2)]
+
+
+def median(frames, rows=FLAT_MEDIAN_ROWS):
+    """Returns the per-pixel median of uint8 frames
+
+    The median is made with a sorting network of cv2.min and cv2.max, without branches on the
+    values of the pixels, it is the same as np.median. The frames are sorted by bands of rows,
+    so only a band of each frame is copied and the bands stay in the cache of the CPU.
+
+    Args:
+        frames (list): the frames, their number must be odd, they are not modified
+        rows (int, optional): number of rows of a band. Defaults to FLAT_MEDIAN_ROWS.
+
+    Returns:
+        array: the median frame
+    """
+    if not len(frames) % 2:
+        raise ValueError("The median must be made of an odd number of frames")
+    logger.info(f"Manual median calc over {len(frames)} frames")
+    network = _median_network(len(frames))
+    result = np.empty_like(frames[0])
+    for top in range(0, result.shape[0], rows):
+        values = [np.array(frame[top : top + rows], copy=True) for frame in frames]
+        spare = np.empty_like(values[0])
+        for low, high in network:
+            # values[low] gets the minimum and values[high] the maximum of both
+            cv2.min(values[low], values[high], dst=spare)
+            cv2.max(values[low], values[high], dst=values[high])
+            values[low], spare = spare, values[low]
+        result[top : top + rows] = values[len(values) // 2]
+    logger.success("Manual median calc")
+    return result
+
+
+class FlatCache:
+    """Flats saved on disk, so that segmenting an acquisition again doesn't calculate them again
+
+    A flat is keyed by the acquisition, the frames it is calculated from with their size and
+    modification time, and the parameters of its calculation. The least recently used flats are
+    removed when the cache grows bigger than its maximum size.
+    """
+
+    def __init__(self, root, acquisition, max_size=FLAT_CACHE_SIZE):
+        """Initialize the cache
+
+        Args:
+            root (string): directory where the flats are saved
+            acquisition (string): identifier of the acquisition being segmented
+            max_size (int, optional): maximum size of the cache, in bytes.
+                Defaults to FLAT_CACHE_SIZE.
+        """
+        self.root = root
+        self.acquisition = acquisition
+        self.max_size = max_size
+        os.makedirs(self.root, exist_ok=True)
+
+    def key(self, filepaths):
+        """Returns the key of the flat calculated from the given frames"""
+        frames = []
+        for filepath in filepaths:
+            stat = os.stat(filepath)
+            frames.append([os.path.basename(filepath), stat.st_size, stat.st_mtime_ns])
+        description = {
+            "acquisition": self.acquisition,
+            "frames": frames,
+            "method": "median",
+            "window": len(filepaths),
+            "version": FLAT_VERSION,
+        }
+        return hashlib.sha256(json.dumps(description).encode()).hexdigest()
+
+    def __path(self, key):
+        return os.path.join(self.root, f"{key}.npy")
+
+    def load(self, key):
+        """Returns the flat saved with the given key, or None"""
+        path = self.__path(key)
+        try:
+            flat = np.load(path)
+        except (OSError, ValueError):
+            return None
+        # the modification time tells which flats were used recently
+        os.utime(path)
+        logger.info(f"Using the flat saved in {path}")
+        return flat
+
+    def save(self, key, flat):
+        """Saves the flat with the given key, removing the least recently used flats if needed"""
+        if self.max_size <= 0:
+            return
+        path = self.__path(key)
+        # write to a temporary file first, so that an interrupted write is never loaded
+        temporary_path = f"{path}.tmp"
+        with open(temporary_path, "wb") as flat_file:
+            np.save(flat_file, flat)
+        os.replace(temporary_path, path)
+        logger.debug(f"The flat is saved in {path}")
+        self.__evict(path)
+
+    def __evict(self, keep):
+        flats = []
+        for filename in os.listdir(self.root):
+            path = os.path.join(self.root, filename)
+            if filename.endswith(".npy") and path != keep:
+                # the segmentations running at the same time share the cache, see batch
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                flats.append((stat.st_mtime, stat.st_size, path))
+        size = sum(flat[1] for flat in flats) + os.path.getsize(keep)
+        # remove the least recently used flats first
+        for _, flat_size, path in sorted(flats):
+            if size <= self.max_size:
+                break
+            logger.debug(f"Removing {path} from the flat cache")
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            size -= flat_size
+
+
+class FlatCorrection:
+    """Divides uint8 frames by a flat and rescales the result to uint8
+
+    The result is the same as dividing the whole frame by the flat and calling
+    rescale_intensity(in_range=(0, FLAT_CORRECTION_MAX), out_range="uint8"), bit for bit. Since
+    both the frame and the flat are uint8, every possible result is computed once in
+    CORRECTION_TABLE, and the correction only looks it up a few rows at a time. This avoids the
+    float64 copies of the frame, which take 8 times the memory of the frame each.
+
+    The rows buffer is reused between frames, so a correction must not be used by several threads
+    at the same time.
+    """
+
+    def __init__(self, flat):
+        """Initialize the correction
+
+        Args:
+            flat (array): flat to divide the frames by, uint8
+        """
+        self.flat = flat
+        self.__indices = np.empty(
+            (min(FLAT_CORRECTION_ROWS, len(flat)),) + flat.shape[1:], dtype=np.uint16
+        )
+
+    def apply(self, image, out=None):
+        """Returns the corrected image
+
+        Args:
+            image (array): frame to correct, uint8 with the shape of the flat
+            out (array, optional): uint8 array where to write the corrected image. Defaults to
+                None, a new array is returned.
+        """
+        if image.shape != self.flat.shape:
+            raise ValueError(
+                f"The image shape {image.shape} is not the flat shape {self.flat.shape}"
+            )
+        if out is None:
+            out = np.empty_like(image)
+        for start in range(0, len(image), len(self.__indices)):
+            end = min(start + len(self.__indices), len(image))
+            indices = self.__indices[: end - start]
+            np.left_shift(self.flat[start:end], 8, out=indices, dtype=np.uint16)
+            np.bitwise_or(indices, image[start:end], out=indices)
+            np.take(CORRECTION_TABLE, indices, out=out[start:end])
+        return out
@@ -0,0 +1,162 @@
+# Copyright (C) 2021 Romain Bazile
+#
+# This file is part of the PlanktoScope software.
+#
+# PlanktoScope is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# PlanktoScope is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with PlanktoScope.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import time
+
+# Logger library compatible with multiprocessing
+from loguru import logger
+
+# file where the imager lists the files of an acquisition once they are written
+INTEGRITY_FILENAME = "integrity.check"
+
+# extensions of the frames
+EXTENSIONS = ("JPG", "jpg", "JPEG", "jpeg")
+
+
+def imager_message(imager_client):
+    """Returns the last message of the imager on status/imager, if it wasn't read yet"""
+    if imager_client is None or not imager_client.new_message_received():
+        return None
+    message = imager_client.msg["payload"]
+    imager_client.read_message()
+    return message
+
+
+def wait_for_acquisition(imager_client, checkpoint, poll_interval=0.5):
+    """Waits until the imager saves the first frame of an acquisition
+
+    Args:
+        imager_client (planktoscope.mqtt.MQTT_Client): client subscribed to status/imager
+        checkpoint (callable): called while waiting, to pause or stop
+        poll_interval (float, optional): time between two looks at the messages, in seconds.
+            Defaults to 0.5.
+
+    Returns:
+        str: folder of the acquisition
+    """
+    while True:
+        checkpoint()
+        message = imager_message(imager_client)
+        if message is not None and message.get("type") == "progress":
+            return os.path.dirname(message["path"])
+        time.sleep(poll_interval)
+
+
+class AcquisitionWatcher:
+    """Lists the frames of an acquisition while they are saved
+
+    A frame is listed once the imager added it to the integrity file of the acquisition, which it
+    does once the frame is written. Without integrity file, the frames of the folder are listed,
+    but the last one until the acquisition is over, it may not be written completely.
+
+    The acquisition is over when the imager publishes Done for it, or Interrupted, on
+    status/imager. It is also over when no frame was saved for timeout seconds, if the imager
+    died or if the acquisition ended before it was watched.
+    """
+
+    def __init__(self, path, imager_client=None, timeout=600, poll_interval=0.5):
+        """Initialize the watcher
+
+        Args:
+            path (str): folder of the acquisition
+            imager_client (planktoscope.mqtt.MQTT_Client, optional): client subscribed to
+                status/imager. Defaults to None, the acquisition is then over after the timeout.
+            timeout (float, optional): time without a new frame after which the acquisition is
+                over, in seconds. Defaults to 600.
+            poll_interval (float, optional): time between two looks at the folder, in seconds.
+                Defaults to 0.5.
+        """
+        self.path = path
+        self.imager_client = imager_client
+        self.timeout = timeout
+        self.poll_interval = poll_interval
+        # names of the frames listed so far, in the order they were saved
+        self.filenames = []
+        # no frame will be added anymore
+        self.finished = False
+
+    def __imager_finished(self):
+        message = imager_message(self.imager_client)
+        if message is None:
+            return False
+        if message.get("status") == "Done":
+            path = message.get("path")
+            return path is None or os.path.normpath(path) == os.path.normpath(self.path)
+        return message.get("status") == "Interrupted"
+
+    def __list(self):
+        """Returns the frames written, in order, and the time the last one was written"""
+        integrity_filepath = os.path.join(self.path, INTEGRITY_FILENAME)
+        if os.path.exists(integrity_filepath):
+            with open(integrity_filepath, "r") as integrity_file:
+                # the lines are complete once they end with a new line
+                lines = [line for line in integrity_file if line.endswith("\n") and line[0] != "#"]
+            filenames = [line.split(",", 1)[0] for line in lines]
+            filenames = [filename for filename in filenames if filename.endswith(EXTENSIONS)]
+            return filenames, os.path.getmtime(integrity_filepath)
+        filenames = sorted(
+            filename for filename in os.listdir(self.path) if filename.endswith(EXTENSIONS)
+        )
+        if not filenames:
+            return [], os.path.getmtime(self.path)
+        last_time = os.path.getmtime(os.path.join(self.path, filenames[-1]))
+        if not self.finished:
+            # the last frame may still be written
+            filenames = filenames[:-1]
+        return filenames, last_time
+
+    def poll(self):
+        """Adds the frames saved since the last poll
+
+        Returns:
+            list: the names of the new frames
+        """
+        if not self.finished:
+            if self.__imager_finished():
+                logger.info(f"The acquisition of {self.path} is over")
+                self.finished = True
+        # the frames are listed after the imager status, so the last frames are not missed
+        filenames, last_time = self.__list()
+        if not self.finished and time.time() - last_time > self.timeout:
+            logger.warning(
+                f"No frame was saved in {self.path} for {self.timeout}s, the acquisition is over"
+            )
+            self.finished = True
+            filenames, last_time = self.__list()
+        new_filenames = filenames[len(self.filenames) :]
+        self.filenames.extend(new_filenames)
+        return new_filenames
+
+    def wait(self, count, checkpoint=None):
+        """Waits until count frames are saved, or the acquisition is over
+
+        Args:
+            count (int): number of frames to wait for
+            checkpoint (callable, optional): called while waiting, to pause or stop. Defaults to
+                None.
+
+        Returns:
+            int: number of frames saved
+        """
+        self.poll()
+        while len(self.filenames) < count and not self.finished:
+            if checkpoint is not None:
+                checkpoint()
+            time.sleep(self.poll_interval)
+            self.poll()
+        return len(self.filenames)
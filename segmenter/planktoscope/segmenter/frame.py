@@ -0,0 +1,669 @@
+# Copyright (C) 2021 Romain Bazile
+#
+# This file is part of the PlanktoScope software.
+#
+# PlanktoScope is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# PlanktoScope is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with PlanktoScope.  If not, see <http://www.gnu.org/licenses/>.
+
+import json
+import os
+import time
+
+import cv2
+import numpy as np
+
+# Logger library compatible with multiprocessing
+from loguru import logger
+
+import planktoscope.segmenter.bands
+import planktoscope.segmenter.cache
+import planktoscope.segmenter.coarse
+import planktoscope.segmenter.debug
+import planktoscope.segmenter.features
+import planktoscope.segmenter.flat
+import planktoscope.segmenter.operations
+import planktoscope.segmenter.writer
+
+# Segmenter used by the current worker process, see init_worker
+_worker_segmenter = None
+# Path of the flat currently loaded in the worker process
+_worker_flat_path = None
+
+# Stages of the segmentation of a frame, in order
+STAGES = ["decode", "correct", "mask", "measure", "encode", "persist"]
+
+# stages skipped for the frames whose objects are restored from the stages cache
+RESTORED_STAGES = ["decode", "correct", "mask", "measure"]
+
+
+class Frame:
+    """A frame going through the segmentation stages
+
+    The arrays are only kept while the frame is in flight, they are released by the encode and
+    persist stages so that a segmented frame only carries its objects metadata.
+    """
+
+    def __init__(self, index, filepath, name, objects_path, debug_path, generation=0):
+        self.index = index
+        self.filepath = filepath
+        # name of the frame, used to name the objects
+        self.name = name
+        # path where to save the objects images
+        self.objects_path = objects_path
+        # path where to save the debug images
+        self.debug_path = debug_path
+        # generation of the flat this frame is corrected with
+        self.generation = generation
+        self.image = None
+        self.mask = None
+        # tier of the debug images of this frame, None without debug images
+        self.debug = None
+        # time spent on the debug images of this frame, and their size
+        self.debug_cost = None
+        # debug images to encode, as (path, array, is_bgr) tuples
+        self.images = []
+        # objects images to encode, as (filename, array) tuples
+        self.crops = []
+        # key of the frame in the stages cache, None when the stages results are not cached
+        self.cache_key = None
+        # the objects were restored from the stages cache, see FrameSegmenter.restore
+        self.restored = False
+        # objects images restored from the stages cache, as (filename, bytes) tuples
+        self.encoded = []
+        # result of the measure stage, saved in the stages cache with the objects images once
+        # they are encoded, as arrays by name
+        self.cache_measure = None
+        # the objects images of cache_measure, as bytes or as the futures of their writes
+        self.cache_crops = []
+        # results of the stages cache read or written, see cache.StageCache.use
+        self.cache_results = []
+        # encoded files to write, as (path, archive_name, bytes, cost) tuples, the path is None
+        # for the files only added to the archive and the archive name None for the debug
+        # images, the cost is the debug cost of the debug images
+        self.files = []
+        # images being written by an ImageWriter, as (archive_name, future) tuples
+        self.writes = []
+        # encoded objects images to add to the EcoTaxa archive, as (filename, bytes) tuples
+        self.archived = []
+        # metadata of the objects, labels are numbered from 0 in each frame
+        self.objects = []
+        # number of objects before size filtering
+        self.nlabels = 0
+        # time spent in each stage, in seconds
+        self.timings = {}
+        self.error = None
+
+    @property
+    def duration(self):
+        """Time spent segmenting this frame, in seconds"""
+        return sum(self.timings.values())
+
+
+class FrameSegmenter:
+    """Segments single frames into objects, independently of the MQTT control process
+
+    This class holds no reference to the MQTT client or to the global metadata, so it can be
+    shipped to worker processes to segment several frames at once. Object labels are numbered
+    from 0 in each frame, the caller is responsible for offsetting them.
+
+    Each step of the segmentation is a stage method taking and returning a Frame, see STAGES.
+    """
+
+    def __init__(
+        self,
+        debug=None,
+        process_min_ESD=20,
+        remove_previous_mask=False,
+        extended_color_statistics=False,
+        archive_objects=False,
+        keep_objects=True,
+        memory_budget=0,
+        coarse_scale=0,
+    ):
+        """Initialize the frame segmenter
+
+        Args:
+            debug (debug.DebugImages, optional): debug images to save. Defaults to all the
+                debug images of every frame.
+            process_min_ESD (int, optional): minimum object size (area-equivalent diameter).
+                Defaults to 20.
+            remove_previous_mask (bool, optional): remove the mask of the previous frame.
+                Defaults to False.
+            extended_color_statistics (bool, optional): add the RGB statistics and the
+                quantiles, skewness and kurtosis of the colour channels. Defaults to False.
+            archive_objects (bool, optional): give the encoded objects images back in the frame,
+                for the EcoTaxa archive. Defaults to False.
+            keep_objects (bool, optional): also write the objects images to disk when they are
+                archived. Defaults to True.
+            memory_budget (int, optional): memory the segmentation of a frame may use, in bytes,
+                the frames too big are segmented in bands, see bands.band_rows. Defaults to 0,
+                the frames are segmented whole.
+            coarse_scale (int, optional): size of the blocks of the frame looked for objects
+                first, the mask is only made around them, see coarse.mask. Defaults to 0, the
+                mask is made on the whole frame.
+        """
+        self.__correction = None
+        # ImageWriter writing the images in the background, they are encoded by the encode
+        # stage and written by the persist stage without it
+        self.writer = None
+        if debug is None:
+            debug = planktoscope.segmenter.debug.DebugImages()
+        self.debug = debug
+        self.process_min_ESD = process_min_ESD
+        # https://planktoscope.slack.com/archives/C01V5ENKG0M/p1714146253356569
+        self.remove_previous_mask = remove_previous_mask
+        self.extended_color_statistics = extended_color_statistics
+        self.archive_objects = archive_objects
+        self.keep_objects = keep_objects
+        self.memory_budget = memory_budget
+        self.coarse_scale = coarse_scale
+        # cache.StageCache the results of the stages are saved in, None to not save them
+        self.cache = None
+
+    @property
+    def flat(self):
+        if self.__correction is None:
+            return None
+        return self.__correction.flat
+
+    @flat.setter
+    def flat(self, flat):
+        # the correction is prepared once per flat, not once per frame
+        if flat is None:
+            self.__correction = None
+        else:
+            self.__correction = planktoscope.segmenter.flat.FlatCorrection(flat)
+
+    def decode(self, frame):
+        if frame.image is not None:
+            # the frame was decoded ahead of the pipeline
+            return frame
+        logger.info("Opening images")
+        # Read images
+        frame.image = cv2.imread(frame.filepath)
+        logger.success("Opening images")
+        return frame
+
+    def correct(self, frame):
+        logger.info("Flat calc")
+        # start = time.monotonic()
+        # logger.debug(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
+
+        # Correct image
+        image = self.__correction.apply(frame.image)
+
+        # adding one black pixel top left
+        image[0][0] = [0, 0, 0]
+
+        # logger.debug(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
+        # logger.debug(time.monotonic() - start)
+        # logger.debug(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
+        logger.success("Flat calc")
+
+        # cv2.imshow("img", img.astype("uint8"))
+        # cv2.waitKey(0)
+        frame.debug = self.debug.sampled(frame.index)
+        if frame.debug is not None:
+            frame.debug_cost = planktoscope.segmenter.debug.DebugCost(frame.debug)
+        if frame.debug == planktoscope.segmenter.debug.FULL:
+            frame.images.append((os.path.join(frame.debug_path, "cleaned_image.jpg"), image, True))
+        frame.image = image
+        return frame
+
+    def __cached(self, frame):
+        """Whether the results of the stages of the frame are read from and saved in the cache"""
+        # the mask of a frame depends on the previous frame with remove_previous_mask
+        return (
+            self.cache is not None and frame.cache_key is not None and not self.remove_previous_mask
+        )
+
+    def __mask_key(self, cache_key):
+        return planktoscope.segmenter.cache.stage_key(cache_key, "mask", {})
+
+    def __measure_key(self, cache_key):
+        return planktoscope.segmenter.cache.stage_key(
+            self.__mask_key(cache_key),
+            "measure",
+            {"extended_color_statistics": self.extended_color_statistics},
+        )
+
+    def restorable(self, index, cache_key):
+        """Whether the objects of a frame may be restored from the stages cache, see restore
+
+        Args:
+            index (int): index of the frame
+            cache_key (str): key of the frame in the stages cache
+        """
+        if self.cache is None or cache_key is None or self.remove_previous_mask:
+            return False
+        if self.debug.sampled(index) is not None:
+            return False
+        return self.cache.contains(self.__measure_key(cache_key))
+
+    def mask(self, frame):
+        logger.info("Starting the mask creation")
+
+        pipeline = [
+            # "adaptative_threshold",
+            "simple_threshold",
+            "remove_previous_mask" if self.remove_previous_mask else "no_op",
+            "erode",
+            "dilate",
+            "close",
+            "erode2",
+        ]
+
+        rows = planktoscope.segmenter.bands.band_rows(frame.image.shape, self.memory_budget)
+        # the masks of the steps are only kept for the full debug images
+        keep = frame.debug == planktoscope.segmenter.debug.FULL
+        cached = self.__cached(frame)
+        loaded = self.cache.load(self.__mask_key(frame.cache_key)) if cached and not keep else None
+        if loaded is not None:
+            arrays, path = loaded
+            shape = tuple(arrays["shape"])
+            mask = np.unpackbits(arrays["mask"], count=shape[0] * shape[1]).reshape(shape)
+            mask *= 255
+            masks = []
+            frame.cache_results.append((path, None))
+            logger.debug(f"The mask is restored from {path}")
+        elif self.coarse_scale > 1 and not self.remove_previous_mask:
+            # the previous mask needs the whole thresholded mask
+            mask, masks = planktoscope.segmenter.coarse.mask(
+                frame.image, self.coarse_scale, pipeline[1:], keep=keep
+            )
+        elif rows is None:
+            mask = frame.image
+            masks = []
+            for transformation in pipeline:
+                function = getattr(
+                    planktoscope.segmenter.operations, transformation
+                )  # Retrieves the actual operation
+                mask = function(mask)
+                masks.append(mask)
+
+                # cv2.imshow(f"mask {transformation}", mask)
+                # cv2.waitKey(0)
+        else:
+            logger.debug(f"Making the mask in bands of {rows} rows")
+            # the threshold and the previous mask need the whole frame, the morphology doesn't
+            mask = planktoscope.segmenter.bands.threshold(frame.image, rows)
+            masks = [mask]
+            mask = getattr(planktoscope.segmenter.operations, pipeline[1])(mask)
+            masks.append(mask)
+            mask, steps = planktoscope.segmenter.bands.morphology(
+                mask, rows, pipeline[2:], keep=keep
+            )
+            masks.extend(steps)
+        if cached and loaded is None:
+            result = self.cache.save(
+                self.__mask_key(frame.cache_key),
+                {"mask": np.packbits(mask > 0), "shape": np.array(mask.shape)},
+                compressed=True,
+            )
+            if result is not None:
+                frame.cache_results.append(result)
+
+        if keep:
+            for i, (transformation, step) in enumerate(zip(pipeline, masks)):
+                frame.images.append(
+                    (
+                        os.path.join(frame.debug_path, f"mask_{i}_{transformation}.jpg"),
+                        step,
+                        False,
+                    )
+                )
+
+        logger.success("Mask created")
+        frame.mask = mask
+        return frame
+
+    def measure(self, frame):
+        """Slice the frame using its mask and measure the objects
+
+        The objects images are views of the frame, they are encoded by the next stage.
+        """
+
+        def __augment_slice(dim_slice, max_dims, size=10):
+            # transform tuple in list
+            dim_slice = list(dim_slice)
+            # dim_slice[0] is the vertical component
+            # dim_slice[1] is the horizontal component
+            # dim_slice[1].start,dim_slice[0].start is the top left corner
+            for i in range(2):
+                if dim_slice[i].start < size:
+                    dim_slice[i] = slice(0, dim_slice[i].stop)
+                else:
+                    dim_slice[i] = slice(dim_slice[i].start - size, dim_slice[i].stop)
+
+            # dim_slice[1].stop,dim_slice[0].stop is the bottom right corner
+            for i in range(2):
+                if dim_slice[i].stop + size == max_dims[i]:
+                    dim_slice[i] = slice(dim_slice[i].start, max_dims[i])
+                else:
+                    dim_slice[i] = slice(dim_slice[i].start, dim_slice[i].stop + size)
+
+            # transform back list in tuple
+            dim_slice = tuple(dim_slice)
+            return dim_slice
+
+        img = frame.image
+        rows = planktoscope.segmenter.bands.band_rows(img.shape, self.memory_budget)
+        if rows is None:
+            labels, nlabels = planktoscope.segmenter.features.label_objects(
+                frame.mask, self.process_min_ESD
+            )
+            # the features of all the objects are computed at once, as columns
+            regions = planktoscope.segmenter.features.regions_table(labels)
+            pixels = planktoscope.segmenter.features.object_pixels(img, labels)
+            del labels
+        else:
+            objects = planktoscope.segmenter.bands.BandObjects(
+                frame.mask, self.process_min_ESD, rows
+            )
+            nlabels = objects.nlabels
+            regions, pixels = objects.regions(img)
+        features = planktoscope.segmenter.features.features_table(regions)
+        object_number = len(features["label"])
+        logger.debug(f"Found {nlabels} labels, or {object_number} after size filtering")
+
+        # Calculate blur metric for the objects (Laplacian variance)
+        features["blur_laplacian"] = [
+            planktoscope.segmenter.operations.calculate_blur(img[region_slice])
+            for region_slice in regions["slice"]
+        ]
+        features.update(
+            planktoscope.segmenter.features.color_table(
+                img, pixels, regions, self.extended_color_statistics
+            )
+        )
+        if self.__cached(frame):
+            # saved with the objects images once they are encoded, see persist
+            frame.cache_measure = self.__measure_result(features, nlabels)
+
+        # the features are only turned into one record per object here
+        for i, metadata in enumerate(planktoscope.segmenter.features.records(features)):
+            # Second extract to get a bigger image for saving
+            obj_image = img[__augment_slice(regions["slice"][i], img.shape[:2], 10)]
+            object_id = f"{frame.name}_{i}"
+            frame.crops.append((f"{object_id}.jpg", obj_image))
+
+            frame.objects.append(
+                {
+                    "name": f"{object_id}",
+                    "metadata": metadata,
+                }
+            )
+
+        if frame.debug is None:
+            # the frames with many objects get the debug images made from their objects
+            frame.debug = self.debug.anomaly(object_number)
+            if frame.debug is not None:
+                frame.debug_cost = planktoscope.segmenter.debug.DebugCost(frame.debug)
+        if frame.debug is not None:
+            start = time.monotonic()
+            self.__debug_objects(frame, img, regions, features)
+            frame.debug_cost.add(time.monotonic() - start)
+        frame.nlabels = nlabels
+        frame.mask = None
+        return frame
+
+    def __measure_result(self, features, nlabels):
+        """Returns the features of the objects as the arrays of a result of the stages cache"""
+        arrays = {f"feature_{name}": np.asarray(column) for name, column in features.items()}
+        # some features are lists, they are given back as such
+        names = [[name, isinstance(column, list)] for name, column in features.items()]
+        arrays["names"] = np.array(json.dumps(names))
+        arrays["nlabels"] = np.array(nlabels)
+        arrays["min_esd"] = np.array(self.process_min_ESD, dtype=np.float64)
+        return arrays
+
+    def restore(self, frame):
+        """Restores the objects of the frame from the stages cache, when its measure is cached
+
+        The objects measured with a smaller minimum size are filtered again, so changing
+        process_min_ESD doesn't segment the frames again. The frames that get debug images are not
+        restored, the debug images are made from the frame.
+
+        Args:
+            frame (Frame): frame to restore, not decoded yet
+
+        Returns:
+            bool: the objects were restored, the frame doesn't need to be decoded
+        """
+        if not self.__cached(frame) or self.debug.sampled(frame.index) is not None:
+            return False
+        loaded = self.cache.load(self.__measure_key(frame.cache_key))
+        if loaded is None:
+            return False
+        arrays, path = loaded
+        if arrays["min_esd"] > self.process_min_ESD:
+            return False
+        # the same diameter as features.label_objects
+        kept = (4 * arrays["feature_area_exc"] / np.pi) ** (1 / 2) >= self.process_min_ESD
+        if self.debug.anomaly(np.count_nonzero(kept)) is not None:
+            return False
+
+        features = {}
+        for name, is_list in json.loads(str(arrays["names"])):
+            column = arrays[f"feature_{name}"][kept]
+            features[name] = column.tolist() if is_list else column
+        # objects are numbered from 0 in each frame
+        features["label"] = np.arange(np.count_nonzero(kept))
+        offsets = arrays["offsets"]
+        crops = arrays["crops"]
+        for i, (index, metadata) in enumerate(
+            zip(np.flatnonzero(kept), planktoscope.segmenter.features.records(features))
+        ):
+            object_id = f"{frame.name}_{i}"
+            data = crops[offsets[index] : offsets[index + 1]].tobytes()
+            frame.encoded.append((f"{object_id}.jpg", data))
+            frame.objects.append({"name": object_id, "metadata": metadata})
+        frame.nlabels = int(arrays["nlabels"])
+        frame.restored = True
+        frame.cache_results.append((path, None))
+        logger.debug(f"The objects of {frame.name} are restored from {path}")
+        return True
+
+    def __debug_objects(self, frame, img, regions, features):
+        """Adds the debug images made from the objects of the frame, for its tier"""
+        tier = frame.debug
+        scale = self.debug.scale if tier == planktoscope.segmenter.debug.PREVIEW else 1
+        if tier == planktoscope.segmenter.debug.FULL:
+            for i, image_filled in enumerate(regions["image_filled"]):
+                frame.images.append(
+                    (os.path.join(frame.debug_path, f"obj_{i}_mask.jpg"), image_filled, False)
+                )
+        if tier == planktoscope.segmenter.debug.LABELS:
+            frame.images.append(
+                (
+                    os.path.join(frame.debug_path, "labels.png"),
+                    planktoscope.segmenter.debug.labels_image(img.shape, regions),
+                    False,
+                )
+            )
+
+        if scale > 1:
+            tagged_image = self.debug.preview(img)
+        elif len(features["label"]):
+            # the objects images are views of the frame, draw on a copy
+            tagged_image = img.copy()
+        else:
+            tagged_image = img
+        for i in range(len(features["label"])):
+            bbox = [regions[f"bbox-{k}"][i] // scale for k in range(4)]
+            tagged_image = cv2.drawMarker(
+                tagged_image,
+                (int(features["x"][i] / scale), int(features["y"][i] / scale)),
+                (0, 0, 255),
+                cv2.MARKER_CROSS,
+            )
+            tagged_image = cv2.rectangle(
+                tagged_image,
+                pt1=bbox[-3:-5:-1],
+                pt2=bbox[-1:-3:-1],
+                color=(150, 0, 200),
+                thickness=1,
+            )
+            contours, hierarchy = cv2.findContours(
+                np.uint8(regions["image"][i]),
+                mode=cv2.RETR_TREE,  # RETR_FLOODFILL or RETR_EXTERNAL
+                method=cv2.CHAIN_APPROX_NONE,
+            )
+            if scale > 1:
+                contours = [contour // scale for contour in contours]
+            tagged_image = cv2.drawContours(
+                tagged_image,
+                contours,
+                -1,
+                (238, 130, 238),
+                thickness=1,
+                offset=(bbox[1], bbox[0]),
+            )
+        frame.images.append((os.path.join(frame.debug_path, "tagged.jpg"), tagged_image, True))
+
+    def __destination(self, frame, filename):
+        """Returns the path of an object image and its name in the archive, either can be None"""
+        path = os.path.join(frame.objects_path, filename)
+        if not self.archive_objects:
+            return path, None
+        elif self.keep_objects:
+            return path, filename
+        else:
+            return None, filename
+
+    def __encode(self, frame, path, archive_name, image, is_bgr, cost=None):
+        """Encodes an image of the frame, in the background if there is a writer
+
+        Returns:
+            bytes or concurrent.futures.Future: the encoded image, or the future of its write
+        """
+        if self.writer is not None:
+            write = self.writer.write(path, image, is_bgr, cost)
+            frame.writes.append((archive_name, write))
+            return write
+        start = time.monotonic()
+        data = planktoscope.segmenter.writer.encode_image(path, image, is_bgr)
+        if cost is not None:
+            cost.add(time.monotonic() - start, len(data), 1)
+        frame.files.append((path, archive_name, data, cost))
+        return data
+
+    def encode(self, frame):
+        if frame.images:
+            # the folders of the frames without debug images are not made
+            os.makedirs(frame.debug_path, exist_ok=True)
+        for path, image, is_bgr in frame.images:
+            self.__encode(frame, path, None, image, is_bgr, frame.debug_cost)
+        for filename, image in frame.crops:
+            encoded = self.__encode(frame, *self.__destination(frame, filename), image, True)
+            if frame.cache_measure is not None:
+                frame.cache_crops.append(encoded)
+        # the objects images restored from the cache are encoded already
+        for filename, data in frame.encoded:
+            frame.files.append((*self.__destination(frame, filename), data, None))
+        frame.encoded = []
+        # the objects images were views of the frame, release it
+        frame.images = []
+        frame.crops = []
+        frame.image = None
+        return frame
+
+    def persist(self, frame):
+        for path, archive_name, data, cost in frame.files:
+            if path is not None:
+                start = time.monotonic()
+                with open(path, "wb") as image_file:
+                    image_file.write(data)
+                if cost is not None:
+                    cost.add(time.monotonic() - start)
+            if archive_name is not None:
+                frame.archived.append((archive_name, data))
+        frame.files = []
+        # the frame is done once its images are written in the background
+        for archive_name, write in frame.writes:
+            data = write.result()
+            if archive_name is not None:
+                frame.archived.append((archive_name, data))
+        frame.writes = []
+
+        if frame.cache_measure is not None:
+            crops = [
+                crop if isinstance(crop, bytes) else crop.result() for crop in frame.cache_crops
+            ]
+            frame.cache_measure["crops"] = np.frombuffer(b"".join(crops), dtype=np.uint8)
+            frame.cache_measure["offsets"] = np.cumsum([0] + [len(crop) for crop in crops])
+            result = self.cache.save(self.__measure_key(frame.cache_key), frame.cache_measure)
+            if result is not None:
+                frame.cache_results.append(result)
+            frame.cache_measure = None
+            frame.cache_crops = []
+        return frame
+
+    def run_stage(self, stage, frame):
+        """Runs the given stage on the frame and records the time spent in it
+
+        Exceptions are stored in the frame, the following stages are then skipped.
+        """
+        if frame.error is not None or (frame.restored and stage in RESTORED_STAGES):
+            return frame
+        start = time.monotonic()
+        try:
+            frame = getattr(self, stage)(frame)
+        except Exception as e:
+            logger.exception(f"The {stage} stage failed for {frame.name}")
+            frame.error = e
+        frame.timings[stage] = frame.timings.get(stage, 0) + time.monotonic() - start
+        return frame
+
+    def segment(self, frame):
+        """Runs all the stages on the given frame, one after the other
+
+        Args:
+            frame (Frame): frame to segment
+
+        Returns:
+            Frame: the segmented frame, with its objects metadata
+        """
+        for stage in STAGES:
+            frame = self.run_stage(stage, frame)
+        return frame
+
+
+def init_worker(segmenter):
+    """Initializer of the worker processes of the segmentation pool
+
+    Args:
+        segmenter (FrameSegmenter): segmenter to use in this worker, without its flat
+    """
+    global _worker_segmenter
+    _worker_segmenter = segmenter
+
+
+def segment_in_worker(flat_path, frame):
+    """Segments a frame in a worker process of the segmentation pool
+
+    The flat is shared with the control process through a file which is memory mapped, so that
+    it is only loaded once per worker and flat refresh instead of once per frame.
+
+    Args:
+        flat_path (string): path of the .npy file containing the flat to use
+        frame (Frame): frame to segment
+
+    Returns:
+        Frame: see FrameSegmenter.segment
+    """
+    global _worker_flat_path
+    if flat_path != _worker_flat_path:
+        _worker_segmenter.flat = np.load(flat_path, mmap_mode="r")
+        _worker_flat_path = flat_path
+    return _worker_segmenter.segment(frame)
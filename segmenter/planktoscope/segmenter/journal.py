@@ -0,0 +1,147 @@
+# Copyright (C) 2021 Romain Bazile
+#
+# This file is part of the PlanktoScope software.
+#
+# PlanktoScope is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# PlanktoScope is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with PlanktoScope.  If not, see <http://www.gnu.org/licenses/>.
+
+import hashlib
+import json
+import os
+
+# Logger library compatible with multiprocessing
+from loguru import logger
+
+JOURNAL_FILENAME = "segmenter_journal.jsonl"
+
+# version of the journal format, journals of other versions are not resumed
+JOURNAL_VERSION = 1
+
+# frames segmented between two states of the journal, each state adds a chunk to the objects file
+CHECKPOINT_FRAMES = 20
+# memory of the objects metadata after which a state is recorded before CHECKPOINT_FRAMES, in bytes
+CHECKPOINT_MEMORY = 2**20
+
+
+def journal_key(filepaths, settings):
+    """Returns the key of a segmentation, it can only be resumed with the same key
+
+    Args:
+        filepaths (list): paths of the frames of the folder, in order
+        settings (dict): settings changing the output of the segmentation
+
+    Returns:
+        str: hexadecimal digest of the frames and the settings
+    """
+    digest = hashlib.sha256()
+    digest.update(json.dumps([JOURNAL_VERSION, settings], sort_keys=True).encode())
+    for filepath in filepaths:
+        stat = os.stat(filepath)
+        digest.update(f"{os.path.basename(filepath)}:{stat.st_size}:{stat.st_mtime_ns}\n".encode())
+    return digest.hexdigest()
+
+
+class Journal:
+    """Records the progress of the segmentation of a folder, one line per checkpoint
+
+    The first line identifies the segmentation, see journal_key, the next ones are the states of
+    the segmentation after some frames, see CHECKPOINT_FRAMES. A state is only written once the
+    files it refers to reached the disk, so the segmentation can be resumed from the last state
+    after a crash or a power loss, the frames after it are segmented again.
+    """
+
+    def __init__(self, path):
+        """Initialize the journal
+
+        Args:
+            path (str): folder being segmented, the journal is kept in it
+        """
+        self.filepath = os.path.join(path, JOURNAL_FILENAME)
+        self.__file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def load(self, key):
+        """Reads the journal of an interrupted segmentation
+
+        The lines written partially when the segmentation was interrupted are dropped.
+
+        Args:
+            key (str): key of the segmentation, see journal_key
+
+        Returns:
+            tuple: the first line and the last state of the segmentation, or None if there is no
+                journal for this key
+        """
+        if not os.path.exists(self.filepath):
+            return None
+        header = None
+        state = None
+        size = 0
+        with open(self.filepath, "rb") as journal_file:
+            for line in journal_file:
+                if not line.endswith(b"\n"):
+                    break
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    break
+                if header is None:
+                    header = entry
+                else:
+                    state = entry
+                size += len(line)
+        if header is None or header.get("key") != key:
+            logger.info(f"The journal {self.filepath} is for another segmentation, ignoring it")
+            return None
+        self.__file = open(self.filepath, "r+b")
+        self.__file.truncate(size)
+        self.__file.seek(size)
+        return header, state
+
+    def start(self, header):
+        """Starts a new journal
+
+        Args:
+            header (dict): first line of the journal, with the key of the segmentation
+        """
+        self.__file = open(self.filepath, "wb")
+        self.__write(header)
+
+    def commit(self, state):
+        """Records the state of the segmentation after some frames
+
+        Args:
+            state (dict): state of the segmentation, the files it refers to must be on the disk
+        """
+        self.__write(state)
+
+    def __write(self, entry):
+        self.__file.write(json.dumps(entry).encode() + b"\n")
+        self.__file.flush()
+        os.fsync(self.__file.fileno())
+
+    def close(self):
+        if self.__file is not None:
+            self.__file.close()
+            self.__file = None
+
+    def remove(self):
+        """Removes the journal, once the segmentation is done"""
+        self.close()
+        if os.path.exists(self.filepath):
+            os.remove(self.filepath)
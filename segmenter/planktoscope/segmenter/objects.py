@@ -0,0 +1,250 @@
+# Copyright (C) 2021 Romain Bazile
+#
+# This file is part of the PlanktoScope software.
+#
+# PlanktoScope is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# PlanktoScope is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with PlanktoScope.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import tempfile
+
+import numpy as np
+
+# Logger library compatible with multiprocessing
+from loguru import logger
+
+# memory used by the metadata of the objects before they are spilled to disk, in bytes
+OBJECTS_MEMORY = 64 * 2**20
+
+# name of the file of the objects of a segmentation, kept in the objects folder until it is done
+OBJECTS_FILENAME = "segmenter_objects.npy"
+
+
+class ObjectStore:
+    """Keeps the metadata of the objects of an acquisition as columns
+
+    Each feature is kept as one array per frame. The names of the objects are not kept, they are
+    made of the name of their frame and their index in it, so only the index of the frame is kept
+    for each object.
+
+    Once the columns take more than max_memory bytes, they are written to a file, which is
+    deleted when the store is closed. The objects are read back in the order they were added.
+
+    Each chunk of the file starts with the names of its new frames and the names of the features,
+    so that a store can be restored from its file after an interruption, see checkpoint.
+    """
+
+    def __init__(self, path, max_memory=OBJECTS_MEMORY, filename=None):
+        """Initialize the store
+
+        Args:
+            path (str): folder of the file
+            max_memory (int, optional): memory used by the columns before they are written to
+                disk, in bytes. Defaults to OBJECTS_MEMORY.
+            filename (str, optional): name of the file, it is kept until the store is closed.
+                Defaults to an anonymous temporary file.
+        """
+        self.path = path
+        self.max_memory = max_memory
+        self.filename = filename
+        # names of the frames, the objects refer to them by index
+        self.frames = []
+        # names of the features, the same for all the objects
+        self.columns = None
+        self.__chunks = []
+        self.__memory = 0
+        self.__spilled = 0
+        # number of frames whose names are in the file
+        self.__spilled_frames = 0
+        self.__file = None
+        self.__count = 0
+
+    @classmethod
+    def restore(cls, path, filename, size, max_memory=OBJECTS_MEMORY):
+        """Restores a store from its file, as it was at a checkpoint
+
+        Args:
+            path (str): folder of the file
+            filename (str): name of the file
+            size (int): size of the file at the checkpoint, see checkpoint
+            max_memory (int, optional): see ObjectStore. Defaults to OBJECTS_MEMORY.
+
+        Returns:
+            ObjectStore: the store, with the objects added before the checkpoint
+        """
+        store = cls(path, max_memory, filename)
+        if not size:
+            return store
+        store.__file = open(os.path.join(path, filename), "r+b")
+        # the objects added after the checkpoint are dropped
+        store.__file.truncate(size)
+        while store.__file.tell() < size:
+            frames = np.load(store.__file, allow_pickle=False)
+            store.columns = np.load(store.__file, allow_pickle=False).tolist()
+            store.frames.extend(frames.tolist())
+            store.__count += len(np.load(store.__file, allow_pickle=False))
+            for _ in store.columns:
+                np.load(store.__file, allow_pickle=False)
+            store.__spilled += 1
+        store.__spilled_frames = len(store.frames)
+        return store
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __len__(self):
+        return self.__count
+
+    @property
+    def memory(self):
+        """Memory used by the columns not written to the file yet, in bytes"""
+        return self.__memory
+
+    def append(self, frame_name, objects):
+        """Adds the objects of a frame
+
+        Args:
+            frame_name (str): name of the frame
+            objects (list): metadata of the objects of the frame, as made by FrameSegmenter, the
+                object i of the frame is named {frame_name}_{i}
+
+        Raises:
+            ValueError: the objects are not named after the frame, or don't have the features of
+                the previous objects
+        """
+        if not objects:
+            return
+        for i, object_metadata in enumerate(objects):
+            if object_metadata["name"] != f"{frame_name}_{i}":
+                raise ValueError(
+                    f"The object {object_metadata['name']} is not the object {i} of {frame_name}"
+                )
+        columns = list(objects[0]["metadata"])
+        if self.columns is None:
+            self.columns = columns
+        elif columns != self.columns:
+            raise ValueError(f"The objects of {frame_name} don't have the same features")
+
+        frame = np.full(len(objects), len(self.frames), dtype=np.int32)
+        self.frames.append(frame_name)
+        chunk = [frame] + [
+            np.asarray([object_metadata["metadata"][column] for object_metadata in objects])
+            for column in self.columns
+        ]
+        self.__chunks.append(chunk)
+        self.__count += len(objects)
+        self.__memory += sum(array.nbytes for array in chunk)
+        if self.__memory >= self.max_memory:
+            self.__spill()
+
+    def __spill(self):
+        """Writes the columns in memory at the end of the file, as one chunk"""
+        if self.__file is None:
+            if self.filename is None:
+                self.__file = tempfile.TemporaryFile(
+                    dir=self.path, prefix="objects_", suffix=".npy"
+                )
+            else:
+                self.__file = open(os.path.join(self.path, self.filename), "w+b")
+        np.save(self.__file, np.array(self.frames[self.__spilled_frames :], dtype=str))
+        np.save(self.__file, np.array(self.columns, dtype=str))
+        for arrays in zip(*self.__chunks):
+            np.save(self.__file, np.concatenate(arrays), allow_pickle=False)
+        logger.debug(f"{self.__memory} bytes of objects metadata written to disk")
+        self.__spilled += 1
+        self.__spilled_frames = len(self.frames)
+        self.__chunks = []
+        self.__memory = 0
+
+    def checkpoint(self):
+        """Writes the columns in memory to the file, and makes sure they reached the disk
+
+        Returns:
+            int: size of the file, to restore the store as it is now, see restore
+        """
+        if self.__chunks:
+            self.__spill()
+        if self.__file is None:
+            return 0
+        self.__file.flush()
+        os.fsync(self.__file.fileno())
+        return self.__file.tell()
+
+    def __iter_chunks(self):
+        if self.__file is not None:
+            self.__file.seek(0)
+            for _ in range(self.__spilled):
+                # the names of the frames and of the features are known already
+                np.load(self.__file, allow_pickle=False)
+                np.load(self.__file, allow_pickle=False)
+                yield [
+                    np.load(self.__file, allow_pickle=False) for _ in range(len(self.columns) + 1)
+                ]
+            self.__file.seek(0, 2)
+        yield from self.__chunks
+
+    def __iter__(self):
+        """Yields the objects in the order they were added, as made by FrameSegmenter"""
+        # the objects of a frame are numbered from 0
+        previous_frame = None
+        index = 0
+        for frames, *values in self.__iter_chunks():
+            for frame, row in zip(frames, zip(*values)):
+                index = index + 1 if frame == previous_frame else 0
+                previous_frame = frame
+                yield {
+                    "name": f"{self.frames[frame]}_{index}",
+                    "metadata": dict(zip(self.columns, row)),
+                }
+
+    def by_frame(self):
+        """Yields the name of each frame with objects and its objects, see __iter__"""
+        frame_name = None
+        objects = []
+        for object_metadata in self:
+            # the objects are named {frame_name}_{i}
+            name = object_metadata["name"].rsplit("_", 1)[0]
+            if objects and name != frame_name:
+                yield frame_name, objects
+                objects = []
+            frame_name = name
+            objects.append(object_metadata)
+        if objects:
+            yield frame_name, objects
+
+    def close(self, remove=True):
+        """Deletes the file and the columns
+
+        Args:
+            remove (bool, optional): delete the file, a file kept can be restored, see
+                checkpoint. Defaults to True.
+        """
+        if self.__file is not None:
+            self.__file.close()
+            self.__file = None
+        if (
+            remove
+            and self.filename is not None
+            and os.path.exists(os.path.join(self.path, self.filename))
+        ):
+            os.remove(os.path.join(self.path, self.filename))
+        self.frames = []
+        self.columns = None
+        self.__chunks = []
+        self.__memory = 0
+        self.__spilled = 0
+        self.__spilled_frames = 0
+        self.__count = 0
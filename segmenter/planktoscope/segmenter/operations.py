@@ -17,6 +17,7 @@
 
 # Logger library compatible with multiprocessing
 import cv2
+import numpy as np
 from loguru import logger
 
 __mask_to_remove = None
@@ -56,11 +57,13 @@ def adaptative_threshold(img):
     return mask
 
 
-def simple_threshold(img):
+def simple_threshold(img, threshold=None):
     """Apply a threshold to a color image to get a mask from it
 
     Args:
         img (cv2 img): Image to extract the mask from
+        threshold (int, optional): grey level above which the pixels are the background.
+            Defaults to None, the level found by the triangle method.
 
     Returns:
         cv2 img: binary mask
@@ -71,7 +74,10 @@ def simple_threshold(img):
     logger.debug("Simple threshold calc")
     # img_hsv = cv2.cvtColor(img, cv2.COLOR_BGR2HSV)
     img_gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
-    ret, mask = cv2.threshold(img_gray, 127, 255, cv2.THRESH_BINARY_INV + cv2.THRESH_TRIANGLE)
+    if threshold is None:
+        ret, mask = cv2.threshold(img_gray, 127, 255, cv2.THRESH_BINARY_INV + cv2.THRESH_TRIANGLE)
+    else:
+        ret, mask = cv2.threshold(img_gray, threshold, 255, cv2.THRESH_BINARY_INV)
 
     # logger.debug(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
     # logger.debug(time.monotonic() - start)
@@ -80,11 +86,64 @@ def simple_threshold(img):
     return mask
 
 
-def erode(mask):
-    """Erode the given mask with a rectangular kernel of 2x2
+def gray_histogram(gray):
+    """Returns the number of pixels of each of the 256 grey levels of a grey image"""
+    histogram = np.zeros(256, dtype=np.int64)
+    # calcHist counts in float32, which is exact up to 2**24 pixels
+    rows = max(1, 2**24 // gray.shape[1])
+    for start in range(0, len(gray), rows):
+        counts = cv2.calcHist([gray[start : start + rows]], [0], None, [256], [0, 256])
+        histogram += counts[:, 0].astype(np.int64)
+    return histogram
+
+
+def triangle_threshold(histogram):
+    """Returns the threshold of the triangle method for the given histogram
+
+    This is the threshold cv2.threshold uses with THRESH_TRIANGLE, so that it can be found from the
+    histogram of a frame accumulated band by band.
+
+    Args:
+        histogram (array): number of pixels of each of the 256 grey levels
+
+    Returns:
+        float: threshold, the pixels above it are the background
+    """
+    histogram = np.asarray(histogram, dtype=np.int64)
+    levels = len(histogram)
+    used = np.flatnonzero(histogram)
+    # the bounds are the levels next to the first and the last levels used, as in OpenCV
+    left_bound = max(int(used[0]) - 1, 0) if len(used) else 0
+    right_bound = int(used[-1]) if len(used) else 0
+    right_bound = min(right_bound + 1, levels - 1)
+    max_index = int(np.argmax(histogram))
+    flipped = max_index - left_bound < right_bound - max_index
+    if flipped:
+        histogram = histogram[::-1]
+        left_bound = levels - 1 - right_bound
+        max_index = levels - 1 - max_index
+    threshold = left_bound
+    # the distance to the line from the peak to the bound, up to a constant factor
+    levels_range = np.arange(left_bound + 1, max_index + 1)
+    if len(levels_range):
+        distances = histogram[max_index] * levels_range.astype(np.float64) + (
+            left_bound - max_index
+        ) * histogram[levels_range].astype(np.float64)
+        best = int(np.argmax(distances))
+        if distances[best] > 0:
+            threshold = int(levels_range[best])
+    threshold -= 1
+    if flipped:
+        threshold = levels - 1 - threshold
+    return float(threshold)
+
+
+def erode(mask, kernel_size=2):
+    """Erode the given mask with a rectangular kernel, 2x2 by default
 
     Args:
         mask (cv2 img): mask to erode
+        kernel_size (int, optional): width and height of the kernel. Defaults to 2.
 
     Returns:
         cv2 img: binary mask after transformation
@@ -93,7 +152,7 @@ def erode(mask):
     # start = time.monotonic()
     # logger.debug(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
 
-    kernel = cv2.getStructuringElement(cv2.MORPH_RECT, (2, 2))
+    kernel = cv2.getStructuringElement(cv2.MORPH_RECT, (kernel_size, kernel_size))
     mask_erode = cv2.erode(mask, kernel)
 
     # logger.debug(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
@@ -102,11 +161,12 @@ def erode(mask):
     return mask_erode
 
 
-def dilate(mask):
-    """Apply a dilate operation to the given mask, with an elliptic kernel of 8x8
+def dilate(mask, kernel_size=8):
+    """Apply a dilate operation to the given mask, with an elliptic kernel, 8x8 by default
 
     Args:
         mask (cv2 img): mask to apply the operation on
+        kernel_size (int, optional): width and height of the kernel. Defaults to 8.
 
     Returns:
         cv2 img: mask after the transformation
@@ -115,7 +175,7 @@ def dilate(mask):
     # start = time.monotonic()
     # logger.debug(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
 
-    kernel = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (8, 8))
+    kernel = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (kernel_size, kernel_size))
     mask_dilate = cv2.dilate(mask, kernel)
 
     # logger.debug(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
@@ -124,11 +184,12 @@ def dilate(mask):
     return mask_dilate
 
 
-def close(mask):
-    """Apply a close operation to the given mask, with an elliptic kernel of 8x8
+def close(mask, kernel_size=8):
+    """Apply a close operation to the given mask, with an elliptic kernel, 8x8 by default
 
     Args:
         mask (cv2 img): mask to apply the operation on
+        kernel_size (int, optional): width and height of the kernel. Defaults to 8.
 
     Returns:
         cv2 img: mask after the transformation
@@ -137,7 +198,7 @@ def close(mask):
     # start = time.monotonic()
     # logger.debug(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
 
-    kernel = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (8, 8))
+    kernel = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (kernel_size, kernel_size))
     mask_close = cv2.morphologyEx(mask, cv2.MORPH_CLOSE, kernel)
 
     # logger.debug(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
@@ -146,11 +207,12 @@ def close(mask):
     return mask_close
 
 
-def erode2(mask):
-    """Apply an erode operation to the given mask, with an elliptic kernel of 8x8
+def erode2(mask, kernel_size=8):
+    """Apply an erode operation to the given mask, with an elliptic kernel, 8x8 by default
 
     Args:
         mask (cv2 img): mask to apply the operation on
+        kernel_size (int, optional): width and height of the kernel. Defaults to 8.
 
     Returns:
         cv2 img: mask after the transformation
@@ -159,7 +221,7 @@ def erode2(mask):
     # start = time.monotonic()
     # logger.debug(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
 
-    kernel = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (8, 8))
+    kernel = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (kernel_size, kernel_size))
     mask_erode_2 = cv2.erode(mask, kernel)
 
     # logger.debug(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
@@ -0,0 +1,454 @@
+# Copyright (C) 2021 Romain Bazile
+#
+# This file is part of the PlanktoScope software.
+#
+# PlanktoScope is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# PlanktoScope is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with PlanktoScope.  If not, see <http://www.gnu.org/licenses/>.
+
+import collections
+import concurrent.futures
+import copy
+
+# Library for starting processes
+import multiprocessing
+import os
+import queue
+import shutil
+import tempfile
+import threading
+import time
+
+import cv2
+import numpy as np
+
+# Logger library compatible with multiprocessing
+from loguru import logger
+
+import planktoscope.segmenter.debug
+import planktoscope.segmenter.frame
+
+
+def _remove_objects(frame):
+    """Removes the objects images written for a frame dropped after a flat refresh
+
+    The frame is segmented again with the new flat, it may have fewer objects.
+    """
+    for object_metadata in frame.objects:
+        object_fn = os.path.join(frame.objects_path, f"{object_metadata['name']}.jpg")
+        if os.path.exists(object_fn):
+            os.remove(object_fn)
+
+
+class StageStats:
+    """Time spent, throughput and queue depth of a segmentation stage"""
+
+    def __init__(self, name):
+        self.name = name
+        self.frames = 0
+        # time spent working on frames, in seconds
+        self.busy = 0.0
+        self.__depth_total = 0
+        self.__depth_samples = 0
+        self.depth_max = 0
+
+    def add(self, duration):
+        self.frames += 1
+        self.busy += duration
+
+    def sample_depth(self, depth):
+        """Records the number of frames waiting for this stage"""
+        self.__depth_total += depth
+        self.__depth_samples += 1
+        self.depth_max = max(self.depth_max, depth)
+
+    @property
+    def depth_mean(self):
+        if not self.__depth_samples:
+            return 0
+        return self.__depth_total / self.__depth_samples
+
+    @property
+    def throughput(self):
+        """Frames per second this stage can handle, when it is not waiting for other stages"""
+        if not self.busy:
+            return 0
+        return self.frames / self.busy
+
+    def report(self):
+        return {
+            "stage": self.name,
+            "frames": self.frames,
+            "busy": self.busy,
+            "throughput": self.throughput,
+            "queue_depth_mean": self.depth_mean,
+            "queue_depth_max": self.depth_max,
+        }
+
+
+class PipelineStats:
+    """Statistics of all the stages of a segmentation run"""
+
+    def __init__(self, stages):
+        self.stages = {stage: StageStats(stage) for stage in stages}
+        # cost of the debug images, by tier
+        self.debug = {}
+        self.__start = time.monotonic()
+
+    def add_frame(self, frame):
+        """Records the time spent by a frame in each stage"""
+        for stage, duration in frame.timings.items():
+            self.stages[stage].add(duration)
+        if frame.debug_cost is not None:
+            tier = frame.debug_cost.tier
+            if tier not in self.debug:
+                self.debug[tier] = planktoscope.segmenter.debug.DebugCost(tier)
+            self.debug[tier].merge(frame.debug_cost)
+
+    def add_stage(self, stats):
+        """Adds the statistics of a stage running outside of the pipeline"""
+        self.stages[stats.name] = stats
+
+    def report(self):
+        return [stats.report() for stats in self.stages.values()]
+
+    def log(self):
+        elapsed = time.monotonic() - self.__start
+        logger.info(f"Pipeline statistics after {elapsed:.1f}s:")
+        for stats in self.stages.values():
+            logger.info(
+                f"{stats.name}: {stats.frames} frames, {stats.busy:.1f}s busy, "
+                f"{stats.throughput:.2f} frames/s, queue depth {stats.depth_mean:.1f} "
+                f"(max {stats.depth_max})"
+            )
+        bottleneck = min(
+            (stats for stats in self.stages.values() if stats.frames),
+            key=lambda stats: stats.throughput,
+            default=None,
+        )
+        if bottleneck is not None:
+            logger.info(f"The slowest stage is {bottleneck.name}")
+        for cost in self.debug.values():
+            logger.info(
+                f"{cost.tier} debug images: {cost.images} images of {cost.frames} frames, "
+                f"{cost.size / 2**20:.1f} MB, {cost.busy:.1f}s busy"
+            )
+
+
+class FrameReader:
+    """Decodes the frames ahead of the pipeline in a thread
+
+    Each frame is decoded once and kept until it is released, so that the frames dropped from
+    the pipeline after a flat refresh and the median of the flat don't decode it again.
+    A frame needed after it was released is decoded again. The frames beyond the lookahead, for
+    the window of a flat, are decoded when they are asked for, and also kept until released.
+
+    Frames can be added while the frames are decoded, to follow an acquisition in progress.
+    """
+
+    def __init__(self, filepaths, lookahead, start=0, skip=None):
+        """Starts decoding the frames
+
+        Args:
+            filepaths (list): paths of the frames, in order
+            lookahead (int): number of frames decoded ahead of the oldest frame not released
+            start (int, optional): index of the first frame to decode, the previous ones are
+                released. Defaults to 0.
+            skip (callable, optional): called with the index of a frame before it is decoded
+                ahead, the frame is only decoded when it is asked for if it returns True.
+                Defaults to None.
+        """
+        self.__filepaths = list(filepaths)
+        self.__lookahead = lookahead
+        self.__skip = skip
+        # decoded frames and decoding durations, by index
+        self.__frames = {}
+        # frames not decoded ahead
+        self.__skipped = set()
+        # frames beyond the lookahead being decoded by get
+        self.__fetching = set()
+        # index of the oldest frame not released
+        self.__oldest = start
+        self.__closed = False
+        self.__condition = threading.Condition()
+        self.__thread = threading.Thread(target=self.__run, name="segmenter-reader", daemon=True)
+        self.__thread.start()
+
+    def __run(self):
+        index = self.__oldest
+        while True:
+            with self.__condition:
+                self.__condition.wait_for(
+                    lambda: self.__closed
+                    or (
+                        max(index, self.__oldest) < len(self.__filepaths)
+                        and index < self.__oldest + self.__lookahead
+                    )
+                )
+                if self.__closed:
+                    return
+                # the frames released before they are decoded are skipped
+                index = max(index, self.__oldest)
+                if index in self.__frames or index in self.__fetching:
+                    # asked for when it was beyond the lookahead, see get
+                    index += 1
+                    continue
+                filepath = self.__filepaths[index]
+            if self.__skip is not None and self.__skip(index):
+                with self.__condition:
+                    self.__skipped.add(index)
+                    self.__condition.notify_all()
+                index += 1
+                continue
+            start = time.monotonic()
+            image = cv2.imread(filepath)
+            duration = time.monotonic() - start
+            with self.__condition:
+                # unless it was released while it was decoded
+                if index >= self.__oldest:
+                    self.__frames[index] = (image, duration)
+                self.__condition.notify_all()
+            index += 1
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def extend(self, filepaths):
+        """Adds frames after the last one"""
+        with self.__condition:
+            self.__filepaths.extend(filepaths)
+            self.__condition.notify_all()
+
+    def get(self, index):
+        """Returns the decoded frame and the time spent decoding it, waiting for it if needed"""
+        keep = False
+        with self.__condition:
+            if index in self.__frames:
+                return self.__frames[index]
+            if index >= self.__oldest + self.__lookahead and index not in self.__fetching:
+                # the thread doesn't decode this far ahead, the frame is kept once decoded here
+                self.__fetching.add(index)
+                keep = True
+            elif index >= self.__oldest:
+                self.__condition.wait_for(
+                    lambda: index in self.__frames
+                    or index in self.__skipped
+                    or index < self.__oldest
+                )
+                if index in self.__frames:
+                    return self.__frames[index]
+            filepath = self.__filepaths[index]
+        # this frame was released already, it wasn't decoded ahead, or it is beyond the lookahead
+        start = time.monotonic()
+        image = cv2.imread(filepath)
+        duration = time.monotonic() - start
+        if keep:
+            with self.__condition:
+                self.__fetching.discard(index)
+                # unless it was released while it was decoded
+                if index >= self.__oldest:
+                    self.__frames[index] = (image, duration)
+                self.__condition.notify_all()
+        return image, duration
+
+    def release(self, index):
+        """Releases the frames before the given index, they won't be needed anymore"""
+        with self.__condition:
+            for released in range(self.__oldest, index):
+                self.__frames.pop(released, None)
+                self.__skipped.discard(released)
+            self.__oldest = max(self.__oldest, index)
+            self.__condition.notify_all()
+
+    def close(self):
+        with self.__condition:
+            self.__closed = True
+            self.__frames.clear()
+            self.__condition.notify_all()
+        self.__thread.join()
+
+
+class Pipeline:
+    """Runs the stages of a FrameSegmenter in threads linked by bounded queues
+
+    Each stage processes the frames in order, so disk I/O and computations of consecutive frames
+    overlap while the frames come out in the order they were submitted. Most of the work is done
+    by OpenCV and numpy, which release the GIL.
+
+    The caller is responsible for keeping at most max_frames frames in flight, which bounds the
+    memory used by the pipeline.
+    """
+
+    def __init__(self, segmenter, max_frames=3):
+        """Starts the stages threads
+
+        Args:
+            segmenter (FrameSegmenter): segmenter providing the stages
+            max_frames (int, optional): number of frames in flight. Defaults to 3.
+        """
+        self.max_frames = max_frames
+        self.stats = PipelineStats(planktoscope.segmenter.frame.STAGES + ["publish"])
+        # generation of the flat, frames of a previous generation are skipped
+        self.generation = 0
+        self.__segmenter = segmenter
+        self.__in_flight = 0
+        stages = planktoscope.segmenter.frame.STAGES
+        self.__queues = [queue.Queue(maxsize=max_frames) for _ in range(len(stages) + 1)]
+        self.__threads = [
+            threading.Thread(
+                target=self.__run_stage,
+                args=(stage, self.__queues[i], self.__queues[i + 1]),
+                name=f"segmenter-{stage}",
+                daemon=True,
+            )
+            for i, stage in enumerate(stages)
+        ]
+        for thread in self.__threads:
+            thread.start()
+
+    def __run_stage(self, stage, inbox, outbox):
+        stats = self.stats.stages[stage]
+        while True:
+            frame = inbox.get()
+            if frame is None:
+                # propagate the end of the pipeline
+                outbox.put(None)
+                return
+            stats.sample_depth(inbox.qsize())
+            if frame.generation == self.generation:
+                frame = self.__segmenter.run_stage(stage, frame)
+            outbox.put(frame)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def submit(self, frame):
+        frame.generation = self.generation
+        self.__in_flight += 1
+        self.__queues[0].put(frame)
+
+    def get(self):
+        """Returns the oldest frame in flight, once all its stages are done"""
+        while True:
+            frame = self.__queues[-1].get()
+            self.__in_flight -= 1
+            if frame.generation == self.generation:
+                break
+        self.stats.add_frame(frame)
+        if frame.error is not None:
+            raise frame.error
+        return frame
+
+    def set_flat(self, flat):
+        """Uses a new flat, the frames in flight are dropped and must be submitted again"""
+        self.generation += 1
+        # the stages skip the dropped frames, this is quick
+        while self.__in_flight:
+            frame = self.__queues[-1].get()
+            self.__in_flight -= 1
+            # the images of this frame will be written again, they must not be written twice at
+            # the same time
+            concurrent.futures.wait([write for _, write in frame.writes])
+            _remove_objects(frame)
+        self.__segmenter.flat = flat
+
+    def close(self):
+        self.generation += 1
+        self.__queues[0].put(None)
+        # drain the frames in flight, so that no stage is blocked on a full queue
+        while self.__queues[-1].get() is not None:
+            pass
+        for thread in self.__threads:
+            thread.join()
+
+
+class PoolPipeline:
+    """Runs all the stages of each frame in a pool of worker processes
+
+    Several frames are segmented at the same time, they come out in the order they were
+    submitted. The flat is shared with the workers through a memory mapped file.
+    """
+
+    def __init__(self, segmenter, workers, max_frames):
+        """Starts the worker processes
+
+        Args:
+            segmenter (FrameSegmenter): segmenter to use in the workers
+            workers (int): number of worker processes
+            max_frames (int): number of frames in flight
+        """
+        self.max_frames = max_frames
+        self.stats = PipelineStats(planktoscope.segmenter.frame.STAGES + ["publish"])
+        # the queue depth is the number of frames submitted to the pool
+        self.__queue_stats = self.stats.stages[planktoscope.segmenter.frame.STAGES[0]]
+        # the flat is not sent with the segmenter, see set_flat
+        worker_segmenter = copy.copy(segmenter)
+        worker_segmenter.flat = None
+        # the workers write their images themselves
+        worker_segmenter.writer = None
+        # spawn instead of fork, the MQTT client thread must not be forked
+        self.__pool = concurrent.futures.ProcessPoolExecutor(
+            max_workers=workers,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=planktoscope.segmenter.frame.init_worker,
+            initargs=(worker_segmenter,),
+        )
+        self.__flat_dir = tempfile.mkdtemp(prefix="planktoscope-flat-")
+        self.__flat_version = 0
+        self.__flat_path = None
+        self.__pending = collections.deque()
+        self.set_flat(segmenter.flat)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def submit(self, frame):
+        self.__queue_stats.sample_depth(len(self.__pending))
+        self.__pending.append(
+            self.__pool.submit(
+                planktoscope.segmenter.frame.segment_in_worker, self.__flat_path, frame
+            )
+        )
+
+    def get(self):
+        """Returns the oldest frame in flight, once all its stages are done"""
+        frame = self.__pending.popleft().result()
+        self.stats.add_frame(frame)
+        if frame.error is not None:
+            raise frame.error
+        return frame
+
+    def set_flat(self, flat):
+        """Uses a new flat, the frames in flight are dropped and must be submitted again"""
+        for future in self.__pending:
+            if future.cancel() or future.exception() is not None:
+                continue
+            # this frame was already segmented, remove its objects before it is redone
+            _remove_objects(future.result())
+        self.__pending.clear()
+
+        self.__flat_version += 1
+        self.__flat_path = os.path.join(self.__flat_dir, f"flat_{self.__flat_version}.npy")
+        np.save(self.__flat_path, flat)
+
+    def close(self):
+        self.__pool.shutdown(cancel_futures=True)
+        shutil.rmtree(self.__flat_dir, ignore_errors=True)
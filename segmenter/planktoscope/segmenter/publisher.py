@@ -0,0 +1,149 @@
+# Copyright (C) 2021 Romain Bazile
+#
+# This file is part of the PlanktoScope software.
+#
+# PlanktoScope is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# PlanktoScope is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with PlanktoScope.  If not, see <http://www.gnu.org/licenses/>.
+
+import collections
+import json
+import time
+
+import paho.mqtt.client as mqtt
+
+# Logger library compatible with multiprocessing
+from loguru import logger
+
+import planktoscope.segmenter.encoder
+
+
+class Publisher:
+    """Publishes the progress and the objects metrics of the segmentation without flooding MQTT
+
+    The progress updates are coalesced, only the last one of each interval is published. The
+    metrics of the objects are published in batches on status/segmenter/metrics. When the broker
+    falls behind, the metrics are dropped instead of being queued, and the next batch tells how
+    many objects were dropped.
+
+    In the per-object debug mode, every object is published on status/segmenter/object_id and
+    status/segmenter/metric instead of the batches.
+    """
+
+    def __init__(
+        self,
+        client,
+        progress_interval=1.0,
+        metrics_interval=1.0,
+        max_batch=1000,
+        max_pending=2,
+        per_object=False,
+    ):
+        """Initialize the publisher
+
+        Args:
+            client (paho.mqtt.client.Client): client to publish with
+            progress_interval (float, optional): minimum time between two progress updates, in
+                seconds. Defaults to 1.
+            metrics_interval (float, optional): time during which the metrics are batched, in
+                seconds. Defaults to 1.
+            max_batch (int, optional): maximum number of objects in a batch. Defaults to 1000.
+            max_pending (int, optional): number of batches that can wait to be sent before the
+                metrics are dropped. Defaults to 2.
+            per_object (bool, optional): publish every object on its own. Defaults to False.
+        """
+        self.client = client
+        self.progress_interval = progress_interval
+        self.metrics_interval = metrics_interval
+        self.max_batch = max_batch
+        self.max_pending = max_pending
+        self.per_object = per_object
+        self.__progress = None
+        self.__progress_time = None
+        self.__batch = []
+        self.__batch_time = None
+        self.__dropped = 0
+        # batches published but not sent yet
+        self.__pending = collections.deque()
+
+    def progress(self, payload):
+        """Publishes a progress update on status/segmenter, or keeps it for later"""
+        self.__progress = payload
+        now = time.monotonic()
+        if self.__progress_time is None or now - self.__progress_time >= self.progress_interval:
+            self.__publish_progress(now)
+
+    def __publish_progress(self, now):
+        self.client.publish("status/segmenter", self.__progress)
+        self.__progress = None
+        self.__progress_time = now
+
+    def objects(self, objects):
+        """Publishes the metrics of the given objects, or batches them for later"""
+        if self.per_object:
+            for object_metadata in objects:
+                # Publish the object_id to via MQTT to Node-RED
+                self.client.publish(
+                    "status/segmenter/object_id",
+                    f'{{"object_id":"{object_metadata["metadata"]["label"]}"}}',
+                )
+
+                # publish metrics about the found object
+                self.client.publish(
+                    "status/segmenter/metric",
+                    json.dumps(object_metadata, cls=planktoscope.segmenter.encoder.NpEncoder),
+                )
+            return
+
+        now = time.monotonic()
+        if self.__batch_time is None:
+            self.__batch_time = now
+        self.__batch.extend(objects)
+        if len(self.__batch) >= self.max_batch or now - self.__batch_time >= self.metrics_interval:
+            self.__publish_batch()
+
+    def __behind(self):
+        """Whether the broker is not keeping up with the batches already published"""
+        while self.__pending and self.__pending[0].is_published():
+            self.__pending.popleft()
+        return len(self.__pending) >= self.max_pending
+
+    def __publish_batch(self):
+        batch = self.__batch
+        self.__batch = []
+        self.__batch_time = None
+        if not batch:
+            return
+        if self.__behind():
+            logger.warning(
+                f"MQTT is falling behind, the metrics of {len(batch)} objects are dropped"
+            )
+            self.__dropped += len(batch)
+            return
+        message = self.client.publish(
+            "status/segmenter/metrics",
+            json.dumps(
+                {"objects": batch, "dropped": self.__dropped},
+                cls=planktoscope.segmenter.encoder.NpEncoder,
+            ),
+        )
+        if message.rc == mqtt.MQTT_ERR_SUCCESS:
+            self.__dropped = 0
+            self.__pending.append(message)
+        else:
+            self.__dropped += len(batch)
+
+    def flush(self):
+        """Publishes the last progress update and the batched metrics"""
+        if self.__progress is not None:
+            self.__publish_progress(time.monotonic())
+        self.__publish_batch()
@@ -0,0 +1,195 @@
+# Copyright (C) 2021 Romain Bazile
+#
+# This file is part of the PlanktoScope software.
+#
+# PlanktoScope is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# PlanktoScope is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with PlanktoScope.  If not, see <http://www.gnu.org/licenses/>.
+
+import collections
+import time
+
+import numpy as np
+
+import planktoscope.segmenter.features
+import planktoscope.segmenter.operations
+
+# parameters of a variant, with the values of the segmentation
+DEFAULTS = {
+    # grey level of the threshold, None for the triangle method
+    "threshold": None,
+    # sizes of the kernels of the transformations of the mask
+    "erode": 2,
+    "dilate": 8,
+    "close": 8,
+    "erode2": 8,
+    # minimum equivalent spherical diameter of the objects, in pixels
+    "process_min_ESD": 20,
+}
+
+# steps of the mask, in order, named after their parameter
+MASK_STEPS = ["threshold", "erode", "dilate", "close", "erode2"]
+
+
+def parse_variants(variants):
+    """Returns the parameters of the variants, completed with the values of the segmentation
+
+    Args:
+        variants (list): parameters of each variant, see DEFAULTS
+
+    Raises:
+        ValueError: there are no variants, or a variant has an unknown parameter
+
+    Returns:
+        list: the parameters of each variant, with all the parameters of DEFAULTS
+    """
+    if not variants:
+        raise ValueError("The sweep needs at least one variant")
+    parsed = []
+    for variant in variants:
+        unknown = set(variant) - set(DEFAULTS)
+        if unknown:
+            raise ValueError(
+                f"The parameters {sorted(unknown)} are unknown, they must be in {list(DEFAULTS)}"
+            )
+        parameters = dict(DEFAULTS, **variant)
+        for step in MASK_STEPS[1:]:
+            parameters[step] = int(parameters[step])
+        if parameters["threshold"] is not None:
+            parameters["threshold"] = int(parameters["threshold"])
+        parameters["process_min_ESD"] = float(parameters["process_min_ESD"])
+        parsed.append(parameters)
+    return parsed
+
+
+def _mask_values(parameters):
+    """Returns the values of the steps of the mask of a variant, in order"""
+    return tuple(parameters[step] for step in MASK_STEPS)
+
+
+def _run_step(step, value, previous):
+    if step == "threshold":
+        return planktoscope.segmenter.operations.simple_threshold(previous, value)
+    return getattr(planktoscope.segmenter.operations, step)(previous, value)
+
+
+class VariantResult:
+    """Objects found with a variant, with their size spectrum and the time spent"""
+
+    def __init__(self, parameters):
+        self.parameters = parameters
+        self.frames = 0
+        self.objects = 0
+        # number of objects by octave of their diameter, in pixels
+        self.spectrum = collections.Counter()
+        # time the steps of the mask and the labelling would take without the other variants,
+        # in seconds
+        self.mask = 0.0
+        self.label = 0.0
+
+    def add(self, diameters, mask_duration, label_duration):
+        """Adds the objects of a frame
+
+        Args:
+            diameters (array): equivalent spherical diameters of the objects kept, in pixels
+            mask_duration (float): time spent making the mask of the frame, in seconds
+            label_duration (float): time spent labelling it, in seconds
+        """
+        self.frames += 1
+        self.objects += len(diameters)
+        for octave, count in zip(*np.unique(np.floor(np.log2(diameters)), return_counts=True)):
+            self.spectrum[int(octave)] += int(count)
+        self.mask += mask_duration
+        self.label += label_duration
+
+    def report(self):
+        frames = max(1, self.frames)
+        return {
+            "parameters": self.parameters,
+            "objects": self.objects,
+            "objects_per_image": self.objects / frames,
+            # the objects whose diameter is between esd and twice esd
+            "spectrum": [
+                {"esd": 2**octave, "objects": self.spectrum[octave]}
+                for octave in sorted(self.spectrum)
+            ],
+            "mask_time": self.mask / frames,
+            "label_time": self.label / frames,
+        }
+
+
+class Sweep:
+    """Segments each frame with several variants of the parameters, to compare them
+
+    The frames are decoded and corrected once by the caller, and each variant only makes the
+    steps of the mask it doesn't share with the previous one. The variants are run in the order
+    of the values of their steps, so the variants sharing their first steps follow each other and
+    only the masks of the steps of the last variant are kept in memory. The objects are counted
+    on their areas, as features.label_objects filters them, without measuring them.
+    """
+
+    def __init__(self, variants):
+        """Initialize the sweep
+
+        Args:
+            variants (list): parameters of each variant, see parse_variants
+        """
+        self.variants = parse_variants(variants)
+        self.results = [VariantResult(parameters) for parameters in self.variants]
+        # the triangle method comes before the fixed thresholds
+        self.__order = sorted(
+            range(len(self.variants)),
+            key=lambda i: tuple(
+                (value is not None, value or 0) for value in _mask_values(self.variants[i])
+            ),
+        )
+        # time spent on the steps of the masks and the labelling of all the variants
+        self.busy = 0.0
+
+    def add(self, image):
+        """Segments a corrected frame with all the variants
+
+        Args:
+            image (array): BGR frame, corrected with the flat
+        """
+        start = time.monotonic()
+        # the values of the steps of the last variant, their masks and the time spent making
+        # each mask from the image
+        steps = []
+        # areas of the labels of the last mask, shared by the variants only changing the ESD
+        labelled = None
+        for i in self.__order:
+            values = _mask_values(self.variants[i])
+            shared = 0
+            while shared < len(steps) and steps[shared][0] == values[shared]:
+                shared += 1
+            del steps[shared:]
+            for depth in range(shared, len(MASK_STEPS)):
+                previous = steps[-1][1] if steps else image
+                step_start = time.monotonic()
+                mask = _run_step(MASK_STEPS[depth], values[depth], previous)
+                duration = time.monotonic() - step_start
+                steps.append((values[depth], mask, duration + (steps[-1][2] if steps else 0)))
+
+            if labelled is None or labelled[0] != values:
+                label_start = time.monotonic()
+                _, area = planktoscope.segmenter.features.label_components(steps[-1][1])
+                labelled = (values, area[1:], time.monotonic() - label_start)
+            # the same diameter as features.label_objects
+            diameters = (4 * labelled[1] / np.pi) ** (1 / 2)
+            diameters = diameters[diameters >= self.variants[i]["process_min_ESD"]]
+            self.results[i].add(diameters, steps[-1][2], labelled[2])
+        self.busy += time.monotonic() - start
+
+    def report(self):
+        """Returns the results of the variants, in the order they were given"""
+        return [result.report() for result in self.results]
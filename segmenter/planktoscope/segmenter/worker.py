@@ -0,0 +1,315 @@
+# Copyright (C) 2021 Romain Bazile
+#
+# This file is part of the PlanktoScope software.
+#
+# PlanktoScope is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# PlanktoScope is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with PlanktoScope.  If not, see <http://www.gnu.org/licenses/>.
+
+import json
+import os
+import threading
+import uuid
+
+# Logger library compatible with multiprocessing
+from loguru import logger
+
+# states of a job
+QUEUED = "queued"
+RUNNING = "running"
+PAUSED = "paused"
+CANCELLING = "cancelling"
+DONE = "done"
+
+# name of the file of the jobs queue, in the data path
+QUEUE_FILENAME = "segmenter_queue.json"
+
+# number of times a job is started before it is dropped, when the segmenter dies while it runs
+MAX_ATTEMPTS = 3
+
+
+class Cancelled(Exception):
+    """Raised in a job by Job.checkpoint once it is cancelled"""
+
+
+class Job:
+    """A segmentation run by a Worker
+
+    A job is made of the segment message asking for it, so that it can be saved. A job is
+    queued, then running, then done. A running job can be paused and resumed, and a job can be
+    cancelled in any state: a queued job is done at once, a running or paused one is cancelling
+    until it stops. The job calls checkpoint between two frames, this is where it waits while it
+    is paused and where it stops once it is cancelled.
+    """
+
+    def __init__(self, message, priority=0, job_id=None, attempts=0):
+        """Initialize the job
+
+        Args:
+            message (dict): payload of the segment message
+            priority (int, optional): the jobs with the highest priority run first, in the order
+                they were submitted. Defaults to 0.
+            job_id (str, optional): id of the job. Defaults to a new uuid.
+            attempts (int, optional): number of times the job was started. Defaults to 0.
+        """
+        self.message = message
+        self.priority = priority
+        self.id = job_id if job_id is not None else str(uuid.uuid4())
+        self.name = f"{self.id} ({message.get('path', 'all')})"
+        self.attempts = attempts
+        self.state = QUEUED
+        # the job stopped because it was cancelled
+        self.cancelled = False
+        self.__condition = threading.Condition()
+
+    def __transition(self, states, state):
+        with self.__condition:
+            if self.state not in states:
+                return False
+            logger.debug(f"The job {self.name} is now {state}, it was {self.state}")
+            self.state = state
+            self.__condition.notify_all()
+            return True
+
+    def start(self):
+        """Marks the job as running, unless it was cancelled while it was queued"""
+        with self.__condition:
+            if self.__transition((QUEUED,), RUNNING):
+                self.attempts += 1
+                return True
+            return False
+
+    def pause(self):
+        """Pauses the job at its next checkpoint
+
+        Returns:
+            bool: the job was running
+        """
+        return self.__transition((RUNNING,), PAUSED)
+
+    def resume(self):
+        """Resumes a paused job
+
+        Returns:
+            bool: the job was paused
+        """
+        return self.__transition((PAUSED,), RUNNING)
+
+    def cancel(self):
+        """Stops the job at its next checkpoint, or before it starts
+
+        Returns:
+            bool: the job was not done already
+        """
+        with self.__condition:
+            if self.state == QUEUED:
+                self.cancelled = True
+                return self.__transition((QUEUED,), DONE)
+            return self.__transition((RUNNING, PAUSED), CANCELLING)
+
+    def finish(self):
+        """Marks the job as done, once its target returned"""
+        with self.__condition:
+            self.cancelled = self.cancelled or self.state == CANCELLING
+            self.__transition((RUNNING, PAUSED, CANCELLING), DONE)
+
+    def checkpoint(self):
+        """Called by the job between two frames
+
+        Raises:
+            Cancelled: the job was cancelled, it must stop
+        """
+        with self.__condition:
+            self.__condition.wait_for(lambda: self.state != PAUSED)
+            if self.state == CANCELLING:
+                raise Cancelled(f"The job {self.name} has been cancelled")
+
+    def wait(self, timeout=None):
+        """Waits until the job is done
+
+        Returns:
+            bool: the job is done
+        """
+        with self.__condition:
+            return self.__condition.wait_for(lambda: self.state == DONE, timeout)
+
+    def summary(self):
+        """Returns the job as published on status/segmenter/jobs"""
+        return {
+            "id": self.id,
+            "action": self.message.get("action", "segment"),
+            "path": self.message.get("path"),
+            "priority": self.priority,
+            "state": self.state,
+        }
+
+
+class Worker:
+    """Runs the jobs one after the other in a thread
+
+    The thread submitting the jobs, which reads the MQTT messages, is never blocked by a job, so
+    the jobs can be paused or cancelled while they run.
+
+    The queue is saved each time it changes, with the job running first, so the jobs are run
+    again after a restart. An interrupted segmentation is then resumed from its journal.
+    """
+
+    def __init__(self, target, filepath=None):
+        """Starts the worker thread, with the jobs saved in the queue file
+
+        Args:
+            target (callable): function running a job, it is called with the job and must call
+                its checkpoint regularly
+            filepath (str, optional): file of the queue. Defaults to a queue that isn't saved.
+        """
+        self.target = target
+        self.filepath = filepath
+        # job running, None when the worker is idle
+        self.current = None
+        # jobs queued, by decreasing priority
+        self.__jobs = []
+        self.__closed = False
+        self.__condition = threading.Condition()
+        for job in self.__load():
+            self.__queue(job)
+        self.__thread = threading.Thread(target=self.__run, name="segmenter-worker")
+        self.__thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __load(self):
+        if self.filepath is None or not os.path.exists(self.filepath):
+            return []
+        try:
+            with open(self.filepath, "r") as queue_file:
+                entries = json.load(queue_file)
+        except ValueError:
+            logger.exception(f"The queue {self.filepath} can't be read, it is dropped")
+            return []
+        jobs = []
+        for entry in entries:
+            if entry["attempts"] >= MAX_ATTEMPTS:
+                logger.error(
+                    f"The job {entry['id']} was started {entry['attempts']} times, it is dropped"
+                )
+                continue
+            jobs.append(Job(entry["message"], entry["priority"], entry["id"], entry["attempts"]))
+        logger.info(f"{len(jobs)} jobs restored from {self.filepath}")
+        return jobs
+
+    def __save(self):
+        """Writes the job running and the jobs queued to the queue file"""
+        if self.filepath is None:
+            return
+        jobs = ([self.current] if self.current is not None else []) + self.__jobs
+        entries = [
+            {
+                "id": job.id,
+                "priority": job.priority,
+                "attempts": job.attempts,
+                "message": job.message,
+            }
+            for job in jobs
+        ]
+        # write to a temporary file first, so that an interrupted write is never loaded
+        temporary_path = f"{self.filepath}.tmp"
+        with open(temporary_path, "w") as queue_file:
+            json.dump(entries, queue_file)
+            queue_file.flush()
+            os.fsync(queue_file.fileno())
+        os.replace(temporary_path, self.filepath)
+
+    def __queue(self, job):
+        self.__jobs.append(job)
+        # the sort is stable, the jobs of the same priority stay in the order they came
+        self.__jobs.sort(key=lambda queued: -queued.priority)
+
+    def __run(self):
+        while True:
+            with self.__condition:
+                self.__condition.wait_for(lambda: self.__closed or self.__jobs)
+                if self.__closed:
+                    return
+                job = self.__jobs.pop(0)
+                if not job.start():
+                    # cancelled while it was queued
+                    continue
+                self.current = job
+                # the job is saved with its attempt
+                self.__save()
+            logger.info(f"Starting the job {job.name}")
+            try:
+                self.target(job)
+            except Cancelled:
+                logger.info(f"The job {job.name} has been cancelled")
+            except Exception:
+                logger.exception(f"The job {job.name} failed")
+            finally:
+                with self.__condition:
+                    if self.__closed and job.state == CANCELLING:
+                        # stopped by close, it runs again after a restart and this attempt
+                        # doesn't count
+                        job.attempts -= 1
+                        self.__jobs.insert(0, job)
+                    self.current = None
+                    self.__save()
+                job.finish()
+
+    @property
+    def busy(self):
+        """Whether a job is running or queued"""
+        with self.__condition:
+            return self.current is not None or bool(self.__jobs)
+
+    def submit(self, job):
+        """Queues a job, it starts after the jobs of the same or higher priority"""
+        with self.__condition:
+            if self.__closed:
+                raise RuntimeError("The worker is closed")
+            self.__queue(job)
+            self.__save()
+            self.__condition.notify_all()
+
+    def jobs(self):
+        """Returns the job running, if any, then the jobs queued in the order they will run"""
+        with self.__condition:
+            return ([self.current] if self.current is not None else []) + list(self.__jobs)
+
+    def cancel(self, job_id=None):
+        """Cancels a job, or the job running and all the jobs queued
+
+        Args:
+            job_id (str, optional): id of the job to cancel. Defaults to all the jobs.
+
+        Returns:
+            list: the jobs cancelled
+        """
+        with self.__condition:
+            jobs = [job for job in self.jobs() if job_id is None or job.id == job_id]
+            self.__jobs = [job for job in self.__jobs if job not in jobs]
+            cancelled = [job for job in jobs if job.cancel()]
+            self.__save()
+        return cancelled
+
+    def close(self):
+        """Stops the job running and the worker, the queue is kept for the next start"""
+        with self.__condition:
+            self.__closed = True
+            current = self.current
+            self.__condition.notify_all()
+        if current is not None:
+            current.cancel()
+        self.__thread.join()
@@ -0,0 +1,285 @@
+# Copyright (C) 2021 Romain Bazile
+#
+# This file is part of the PlanktoScope software.
+#
+# PlanktoScope is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# PlanktoScope is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with PlanktoScope.  If not, see <http://www.gnu.org/licenses/>.
+
+import json
+import os
+import shutil
+import time
+import uuid
+
+import numpy as np
+
+# Logger library compatible with multiprocessing
+from loguru import logger
+
+# folders of the queue, a unit is in one of them
+PENDING = "pending"
+CLAIMED = "claimed"
+DONE = "done"
+FAILED = "failed"
+# folder of the flats of the acquisitions, shared by their units
+FLATS = "flats"
+
+# written by the coordinator once all the acquisitions are merged, the workers stop then
+FINISHED_FILENAME = "finished"
+
+# files of the result of a unit, in its folder in DONE
+RESULT_FILENAME = "result.json"
+# the metadata of the objects, see objects.ObjectStore
+RESULT_OBJECTS_FILENAME = "objects.npy"
+# the objects images of the EcoTaxa archive
+RESULT_ARCHIVE_FILENAME = "objects.zip"
+# the claimed unit, moved with its result so that a unit queued again or cancelled is dropped
+RESULT_UNIT_FILENAME = "unit.json"
+
+# time without a heartbeat after which a claimed unit is queued again, in seconds
+LEASE = float(os.getenv("SEGMENTER_QUEUE_LEASE", "300"))
+# time between two heartbeats of a worker, in seconds
+HEARTBEAT = LEASE / 10
+
+
+def _write_json(filepath, data):
+    # write to a temporary file first, so that an interrupted write is never read
+    temporary_path = f"{filepath}.{uuid.uuid4().hex}.tmp"
+    with open(temporary_path, "w") as json_file:
+        json.dump(data, json_file)
+        json_file.flush()
+        os.fsync(json_file.fileno())
+    os.replace(temporary_path, filepath)
+
+
+class WorkQueue:
+    """Work units of a distributed segmentation, in a folder shared by the machines
+
+    Every change of the queue is a rename, which is atomic on a filesystem, so the coordinator
+    and any number of workers share it without locks. A unit is a JSON file, it is pending until
+    a worker claims it by moving it to claimed, and done once the worker moved the folder of its
+    result to done. A worker touches the file of its unit while it segments it, the units whose
+    worker stopped doing so are pending again, see requeue_stale. A worker commits its result or
+    its failure by taking the file of its unit out of claimed, so the result of a worker which
+    lost its unit, queued again or cancelled meanwhile, is dropped. Once a unit queued again is
+    claimed by another worker, the first of the two workers to commit keeps its result, both
+    segmented the same images with the same settings.
+    """
+
+    def __init__(self, root):
+        """Opens the queue, and creates it if needed
+
+        Args:
+            root (str): folder of the queue
+        """
+        self.root = root
+        for folder in (PENDING, CLAIMED, DONE, FAILED, FLATS):
+            os.makedirs(os.path.join(self.root, folder), exist_ok=True)
+
+    def __path(self, folder, unit_id):
+        return os.path.join(self.root, folder, f"{unit_id}.json")
+
+    def state(self, unit_id):
+        """Returns the folder of the unit, or None if it isn't in the queue"""
+        if os.path.exists(self.result_path(unit_id)):
+            return DONE
+        for folder in (FAILED, CLAIMED, PENDING):
+            if os.path.exists(self.__path(folder, unit_id)):
+                return folder
+        return None
+
+    def put(self, unit):
+        """Queues a unit, unless it is in the queue already, a failed unit is queued again
+
+        Args:
+            unit (dict): the unit, with its id
+
+        Returns:
+            bool: the unit was queued
+        """
+        state = self.state(unit["id"])
+        if state == FAILED:
+            os.remove(self.__path(FAILED, unit["id"]))
+        elif state is not None:
+            return False
+        _write_json(self.__path(PENDING, unit["id"]), unit)
+        return True
+
+    def claim(self):
+        """Claims the first pending unit
+
+        Returns:
+            dict: the unit, or None if there is no pending unit
+        """
+        for filename in sorted(os.listdir(os.path.join(self.root, PENDING))):
+            if not filename.endswith(".json"):
+                continue
+            claimed_path = os.path.join(self.root, CLAIMED, filename)
+            try:
+                os.rename(os.path.join(self.root, PENDING, filename), claimed_path)
+            except FileNotFoundError:
+                # claimed by another worker
+                continue
+            # the lease starts now, not when the unit was queued
+            os.utime(claimed_path)
+            with open(claimed_path, "r") as unit_file:
+                return json.load(unit_file)
+        return None
+
+    def heartbeat(self, unit_id):
+        """Extends the lease of a claimed unit
+
+        Returns:
+            bool: the unit is still claimed
+        """
+        try:
+            os.utime(self.__path(CLAIMED, unit_id))
+        except FileNotFoundError:
+            return False
+        return True
+
+    def requeue_stale(self, lease=LEASE):
+        """Queues again the claimed units without a heartbeat for lease seconds
+
+        Returns:
+            int: the number of units queued again
+        """
+        requeued = 0
+        deadline = time.time() - lease
+        for filename in os.listdir(os.path.join(self.root, CLAIMED)):
+            claimed_path = os.path.join(self.root, CLAIMED, filename)
+            try:
+                if os.stat(claimed_path).st_mtime >= deadline:
+                    continue
+                os.rename(claimed_path, os.path.join(self.root, PENDING, filename))
+            except FileNotFoundError:
+                # done in the meantime
+                continue
+            logger.warning(f"The worker of {filename} stopped, it is queued again")
+            requeued += 1
+        return requeued
+
+    def result_path(self, unit_id):
+        """Returns the folder of the result of a unit, once it is done"""
+        return os.path.join(self.root, DONE, unit_id)
+
+    def start_result(self, unit_id):
+        """Returns a new folder where the result of a claimed unit is written, see commit"""
+        result_path = os.path.join(self.root, DONE, f".{unit_id}.{uuid.uuid4().hex}")
+        os.makedirs(result_path)
+        return result_path
+
+    def commit(self, unit_id, result_path, result):
+        """Moves the result of a unit to done, the unit is then done
+
+        Args:
+            unit_id (str): id of the unit
+            result_path (str): folder of the result, see start_result
+            result (dict): result of the unit, saved with its files
+
+        Returns:
+            bool: the result was kept, the unit was still claimed by this worker
+        """
+        _write_json(os.path.join(result_path, RESULT_FILENAME), result)
+        try:
+            os.rename(
+                self.__path(CLAIMED, unit_id), os.path.join(result_path, RESULT_UNIT_FILENAME)
+            )
+        except FileNotFoundError:
+            logger.warning(f"{unit_id} was queued again or cancelled, this result is dropped")
+            shutil.rmtree(result_path, ignore_errors=True)
+            return False
+        try:
+            # a folder is not renamed over a folder that isn't empty
+            os.rename(result_path, self.result_path(unit_id))
+        except OSError:
+            logger.warning(f"{unit_id} was done by another worker, this result is dropped")
+            shutil.rmtree(result_path, ignore_errors=True)
+            return False
+        return True
+
+    def fail(self, unit_id, unit, error):
+        """Moves a claimed unit to failed, with the error that stopped it
+
+        Returns:
+            bool: the unit was still claimed by this worker, it is failed
+        """
+        try:
+            os.remove(self.__path(CLAIMED, unit_id))
+        except FileNotFoundError:
+            logger.warning(f"{unit_id} was queued again or cancelled, this failure is dropped")
+            return False
+        _write_json(self.__path(FAILED, unit_id), dict(unit, error=error))
+        return True
+
+    def cancel(self, unit_id):
+        """Removes a unit which is pending, claimed or done, a failed unit is kept with its error
+
+        The worker of a claimed unit drops its result, see commit.
+        """
+        for folder in (PENDING, CLAIMED):
+            try:
+                os.remove(self.__path(folder, unit_id))
+            except FileNotFoundError:
+                pass
+        # the results being written are left to their worker
+        shutil.rmtree(self.result_path(unit_id), ignore_errors=True)
+
+    def result(self, unit_id):
+        """Returns the result of a done unit, see commit"""
+        with open(os.path.join(self.result_path(unit_id), RESULT_FILENAME), "r") as result_file:
+            return json.load(result_file)
+
+    def error(self, unit_id):
+        """Returns the error of a failed unit"""
+        with open(self.__path(FAILED, unit_id), "r") as unit_file:
+            return json.load(unit_file)["error"]
+
+    def remove(self, unit_id):
+        """Removes the result of a done unit once it is merged, with the ones of stopped workers"""
+        shutil.rmtree(self.result_path(unit_id), ignore_errors=True)
+        for entry in os.scandir(os.path.join(self.root, DONE)):
+            if entry.name.startswith(f".{unit_id}."):
+                shutil.rmtree(entry.path, ignore_errors=True)
+
+    def flat_path(self, name):
+        return os.path.join(self.root, FLATS, name)
+
+    def save_flat(self, name, flat):
+        """Saves the flat of an acquisition for its units, unless it is saved already"""
+        flat_path = self.flat_path(name)
+        if os.path.exists(flat_path):
+            return
+        temporary_path = f"{flat_path}.{uuid.uuid4().hex}.tmp"
+        with open(temporary_path, "wb") as flat_file:
+            np.save(flat_file, flat)
+        os.replace(temporary_path, flat_path)
+
+    def load_flat(self, name):
+        return np.load(self.flat_path(name))
+
+    @property
+    def finished(self):
+        """Whether the coordinator is done, the workers stop then"""
+        return os.path.exists(os.path.join(self.root, FINISHED_FILENAME))
+
+    def finish(self):
+        with open(os.path.join(self.root, FINISHED_FILENAME), "w"):
+            pass
+
+    def reopen(self):
+        """Marks the queue as used by a coordinator again"""
+        try:
+            os.remove(os.path.join(self.root, FINISHED_FILENAME))
+        except FileNotFoundError:
+            pass
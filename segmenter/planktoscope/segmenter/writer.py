@@ -0,0 +1,157 @@
+# Copyright (C) 2021 Romain Bazile
+#
+# This file is part of the PlanktoScope software.
+#
+# PlanktoScope is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# PlanktoScope is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with PlanktoScope.  If not, see <http://www.gnu.org/licenses/>.
+
+import concurrent.futures
+import io
+import threading
+import time
+
+import numpy as np
+import PIL.Image
+
+import planktoscope.segmenter.pipeline
+
+
+def encode_jpeg(image, is_bgr=True):
+    """Encodes the image in JPEG
+
+    BGR images are read as such by PIL, without converting them to RGB first.
+
+    Args:
+        image (array): image to encode, it can be a view of a bigger image
+        is_bgr (bool, optional): the image is a BGR colour image. Defaults to True.
+
+    Returns:
+        bytes: the JPEG file
+    """
+    if is_bgr:
+        image = np.ascontiguousarray(image)
+        pil_image = PIL.Image.frombuffer(
+            "RGB", (image.shape[1], image.shape[0]), image, "raw", "BGR", 0, 1
+        )
+    else:
+        pil_image = PIL.Image.fromarray(image)
+    buffer = io.BytesIO()
+    pil_image.save(buffer, format="JPEG")
+    return buffer.getvalue()
+
+
+def encode_png(image):
+    """Encodes the single channel image in PNG, 16 bits images are kept on 16 bits
+
+    Args:
+        image (array): image to encode
+
+    Returns:
+        bytes: the PNG file
+    """
+    buffer = io.BytesIO()
+    # the debug images are mostly empty, they don't need a strong compression
+    PIL.Image.fromarray(image).save(buffer, format="PNG", compress_level=1)
+    return buffer.getvalue()
+
+
+def encode_image(path, image, is_bgr=True):
+    """Encodes the image in PNG for the .png paths, and in JPEG otherwise"""
+    if path is not None and path.endswith(".png"):
+        return encode_png(image)
+    return encode_jpeg(image, is_bgr)
+
+
+def write_jpeg(path, image, is_bgr=True):
+    """Encodes the image in JPEG and writes it to the given path"""
+    data = encode_jpeg(image, is_bgr)
+    with open(path, "wb") as image_file:
+        image_file.write(data)
+
+
+class ImageWriter:
+    """Encodes and writes images in a pool of threads
+
+    The images can be views of a frame, the frame is kept until they are written. PIL releases
+    the GIL while encoding, so the images are encoded in parallel and the thread submitting them
+    doesn't wait for the encoding.
+    """
+
+    def __init__(self, workers=2):
+        """Starts the writer threads
+
+        Args:
+            workers (int, optional): number of images encoded at the same time. Defaults to 2.
+        """
+        self.stats = planktoscope.segmenter.pipeline.StageStats("write")
+        self.__pool = concurrent.futures.ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix="segmenter-writer"
+        )
+        self.__lock = threading.Lock()
+        self.__pending = set()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __write(self, path, image, is_bgr, cost):
+        start = time.monotonic()
+        data = encode_image(path, image, is_bgr)
+        if path is not None:
+            with open(path, "wb") as image_file:
+                image_file.write(data)
+        with self.__lock:
+            self.stats.add(time.monotonic() - start)
+            if cost is not None:
+                cost.add(time.monotonic() - start, len(data), 1)
+        return data
+
+    def __done(self, future):
+        with self.__lock:
+            self.__pending.discard(future)
+
+    def write(self, path, image, is_bgr=True, cost=None):
+        """Encodes and writes the image in the background
+
+        Args:
+            path (str): path of the image file, None to only encode the image, see encode_image
+            image (array): image to encode
+            is_bgr (bool, optional): the image is a BGR colour image. Defaults to True.
+            cost (debug.DebugCost, optional): cost the writing of the image is added to, for the
+                debug images. Defaults to None.
+
+        Returns:
+            concurrent.futures.Future: done once the image is written, its result is the file
+        """
+        future = self.__pool.submit(self.__write, path, image, is_bgr, cost)
+        with self.__lock:
+            self.stats.sample_depth(len(self.__pending))
+            self.__pending.add(future)
+        future.add_done_callback(self.__done)
+        return future
+
+    def flush(self):
+        """Waits until all the images submitted so far are written
+
+        Raises:
+            Exception: the first error raised while writing these images
+        """
+        with self.__lock:
+            pending = list(self.__pending)
+        for future in pending:
+            future.result()
+
+    def close(self):
+        self.__pool.shutdown(wait=True)
@@ -0,0 +1,121 @@
+# Copyright (C) 2021 Romain Bazile
+#
+# This file is part of the PlanktoScope software.
+#
+# PlanktoScope is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# PlanktoScope is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with PlanktoScope.  If not, see <http://www.gnu.org/licenses/>.
+
+import cv2
+import numpy as np
+import pytest
+
+import planktoscope.segmenter.bands
+import planktoscope.segmenter.features
+import planktoscope.segmenter.operations
+from benchmarks.features import crowded_mask
+
+MIN_ESD = 10
+
+# the morphology of the mask stage, after the threshold
+TRANSFORMATIONS = ["erode", "dilate", "close", "erode2"]
+
+# bands of a few rows, most objects cross them, of about the height of the objects, and a
+# single band
+ROWS = [7, 37, 116, 1000]
+
+
+@pytest.fixture(scope="module")
+def mask():
+    mask = crowded_mask(150, 800, shape=(600, 800))
+    # objects across many bands, with holes
+    cv2.ellipse(mask, (200, 300), (20, 250), 0, 0, 360, 255, -1)
+    cv2.ellipse(mask, (600, 300), (40, 200), 30, 0, 360, 255, 6)
+    return mask
+
+
+@pytest.fixture(scope="module")
+def image(mask):
+    rng = np.random.default_rng(0)
+    # dark objects on a bright background, as after the flat correction
+    gray = np.where(mask > 0, 80, 200).astype(np.int16)
+    noise = rng.integers(-30, 30, (*mask.shape, 3))
+    return np.clip(gray[..., None] + noise, 0, 255).astype(np.uint8)
+
+
+@pytest.mark.parametrize("rows", ROWS)
+def test_mask_in_bands_is_whole_mask(image, rows):
+    operations = planktoscope.segmenter.operations
+    expected = operations.simple_threshold(image)
+    mask = planktoscope.segmenter.bands.threshold(image, rows)
+    np.testing.assert_array_equal(mask, expected)
+
+    final, steps = planktoscope.segmenter.bands.morphology(mask, rows, TRANSFORMATIONS, True)
+    for transformation, step in zip(TRANSFORMATIONS, steps):
+        expected = getattr(operations, transformation)(expected)
+        np.testing.assert_array_equal(step, expected, err_msg=transformation)
+    np.testing.assert_array_equal(final, expected)
+
+
+def assert_regions_equal(regions, expected):
+    assert list(regions) == list(expected)
+    for name, column in expected.items():
+        assert len(regions[name]) == len(column), name
+        if name == "slice":
+            assert list(regions[name]) == list(column)
+        elif column.dtype == object:
+            for value, expected_value in zip(regions[name], column):
+                np.testing.assert_array_equal(value, expected_value, err_msg=name)
+        else:
+            np.testing.assert_array_equal(regions[name], column, err_msg=name)
+
+
+@pytest.mark.parametrize("rows", ROWS)
+def test_band_objects_are_whole_frame_objects(image, mask, rows):
+    features = planktoscope.segmenter.features
+    labels, nlabels = features.label_objects(mask, MIN_ESD)
+    expected = features.regions_table(labels)
+    expected_pixels = features.object_pixels(image, labels)
+
+    objects = planktoscope.segmenter.bands.BandObjects(mask, MIN_ESD, rows)
+    regions, pixels = objects.regions(image)
+    assert objects.nlabels == nlabels
+    assert len(expected["area"]) > 50
+    assert_regions_equal(regions, expected)
+    for array, expected_array in zip(pixels, expected_pixels):
+        np.testing.assert_array_equal(array, expected_array)
+    # the features derived from the properties are the same too
+    table = features.features_table(regions)
+    for name, column in features.features_table(expected).items():
+        np.testing.assert_array_equal(table[name], column, err_msg=name)
+
+
+def test_band_objects_without_objects(image):
+    mask = np.zeros(image.shape[:2], dtype=np.uint8)
+    objects = planktoscope.segmenter.bands.BandObjects(mask, MIN_ESD, 37)
+    regions, (colors, indices) = objects.regions(image)
+    assert objects.nlabels == 0
+    assert len(regions["area"]) == 0
+    assert len(colors) == len(indices) == 0
+
+
+def test_band_rows():
+    shape = (3040, 4056, 3)
+    frame_bytes = planktoscope.segmenter.bands.FRAME_BYTES_PER_PIXEL * shape[0] * shape[1]
+    assert planktoscope.segmenter.bands.band_rows(shape, 0) is None
+    assert planktoscope.segmenter.bands.band_rows(shape, 2**40) is None
+    budget = frame_bytes + planktoscope.segmenter.bands.BAND_BYTES_PER_PIXEL * shape[1] * 500
+    assert planktoscope.segmenter.bands.band_rows(shape, budget) == 500
+    assert (
+        planktoscope.segmenter.bands.band_rows(shape, frame_bytes)
+        == planktoscope.segmenter.bands.MINIMUM_BAND_ROWS
+    )
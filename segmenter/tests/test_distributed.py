@@ -0,0 +1,75 @@
+# Copyright (C) 2021 Romain Bazile
+#
+# This file is part of the PlanktoScope software.
+#
+# PlanktoScope is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# PlanktoScope is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with PlanktoScope.  If not, see <http://www.gnu.org/licenses/>.
+
+import json
+import os
+
+import cv2
+import numpy as np
+import pytest
+
+import planktoscope.segmenter.distributed
+import planktoscope.segmenter.flat
+from planktoscope.segmenter.workqueue import WorkQueue
+
+IMAGES = 23
+
+
+@pytest.fixture
+def acquisition(tmp_path):
+    path = tmp_path / "data" / "img" / "2026-01-01" / "S1" / "A1"
+    path.mkdir(parents=True)
+    rng = np.random.default_rng(0)
+    for i in range(IMAGES):
+        image = rng.integers(0, 256, (16, 24, 3), dtype=np.uint8)
+        cv2.imwrite(str(path / f"01_00_{i:02d}_000000.jpg"), image)
+    with open(path / "metadata.json", "w") as metadata_file:
+        json.dump({"acq_id": "A1"}, metadata_file)
+    return str(tmp_path / "data"), str(path)
+
+
+def test_split(tmp_path, acquisition):
+    data_path, path = acquisition
+    queue = WorkQueue(str(tmp_path / "queue"))
+    unit_ids = planktoscope.segmenter.distributed.split(queue, data_path, path, {}, 10)
+    assert len(unit_ids) == 3
+    # the units of a previous coordinator are kept
+    assert planktoscope.segmenter.distributed.split(queue, data_path, path, {}, 10) == unit_ids
+
+    images = sorted(filename for filename in os.listdir(path) if filename.endswith(".jpg"))
+    images_paths = [os.path.join(path, filename) for filename in images]
+    window = planktoscope.segmenter.flat.FLAT_WINDOW
+    units = [queue.claim() for _ in unit_ids]
+    for unit, first, previous in zip(units, (0, 10, 20), (None, images[9], images[19])):
+        assert unit["first"] == first
+        assert unit["images"] == images[first : first + 10]
+        assert unit["previous"] == previous
+        # the median of the images from the first one of the unit, or of the last ones
+        flat_first = min(first, IMAGES - window)
+        expected = planktoscope.segmenter.flat.median(
+            [cv2.imread(filepath) for filepath in images_paths[flat_first : flat_first + window]]
+        )
+        np.testing.assert_array_equal(queue.load_flat(unit["flat"]), expected)
+    assert len({unit["flat"] for unit in units}) == 3
+
+
+def test_split_without_images(tmp_path):
+    path = tmp_path / "data" / "img" / "empty"
+    path.mkdir(parents=True)
+    queue = WorkQueue(str(tmp_path / "queue"))
+    with pytest.raises(FileNotFoundError):
+        planktoscope.segmenter.distributed.split(queue, str(tmp_path / "data"), str(path), {}, 10)
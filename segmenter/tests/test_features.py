@@ -0,0 +1,134 @@
+# Copyright (C) 2021 Romain Bazile
+#
+# This file is part of the PlanktoScope software.
+#
+# PlanktoScope is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# PlanktoScope is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with PlanktoScope.  If not, see <http://www.gnu.org/licenses/>.
+
+import cv2
+import numpy as np
+import pytest
+import skimage.measure
+
+import planktoscope.segmenter.features
+from benchmarks.features import crowded_mask, measure_per_object
+
+MIN_ESD = 10
+
+
+@pytest.fixture(scope="module")
+def mask():
+    mask = crowded_mask(150, 800, shape=(600, 800))
+    # rings, whose holes are in the colour statistics of the filled objects
+    for center in ((100, 100), (400, 300), (700, 500)):
+        cv2.circle(mask, center, 30, 255, 6)
+    return mask
+
+
+@pytest.fixture(scope="module")
+def image(mask):
+    return np.random.default_rng(0).integers(0, 256, (*mask.shape, 3), dtype=np.uint8)
+
+
+def colors_per_object(image, mask, extended):
+    """The colour statistics of one object at a time, on the pixels of the filled object"""
+    labels, _ = planktoscope.segmenter.features.label_objects(mask, MIN_ESD)
+    objects = []
+    for region in skimage.measure.regionprops(labels):
+        crop = image[region.slice]
+        channels = dict(
+            zip(
+                planktoscope.segmenter.features.COLOR_CHANNELS,
+                cv2.split(cv2.cvtColor(crop, cv2.COLOR_BGR2HSV)),
+            )
+        )
+        if extended:
+            channels.update(
+                zip(planktoscope.segmenter.features.EXTENDED_COLOR_CHANNELS, cv2.split(crop)[::-1])
+            )
+        statistics = {}
+        for name, channel in channels.items():
+            values = channel[region.image_filled].astype(np.float64)
+            statistics[f"Mean{name}"] = np.mean(values)
+            statistics[f"Std{name}"] = np.std(values)
+            if extended:
+                for prefix, quantile in planktoscope.segmenter.features.QUANTILES.items():
+                    statistics[f"{prefix}{name}"] = np.quantile(values, quantile)
+                deviations = values - values.mean()
+                variance = np.mean(deviations**2)
+                statistics[f"Skew{name}"] = np.mean(deviations**3) / variance**1.5
+                statistics[f"Kurt{name}"] = np.mean(deviations**4) / variance**2 - 3
+        objects.append(statistics)
+    return objects
+
+
+def test_label_objects_is_skimage_label(mask):
+    labels, nlabels = planktoscope.segmenter.features.label_objects(mask, 0)
+    expected = skimage.measure.label(mask)
+    assert nlabels == expected.max()
+    np.testing.assert_array_equal(labels, expected)
+
+
+def test_features_table_is_regionprops(mask):
+    features = planktoscope.segmenter.features
+    labels, _ = features.label_objects(mask, MIN_ESD)
+    measured = features.records(features.features_table(features.regions_table(labels)))
+    expected = measure_per_object(mask, MIN_ESD)
+    assert len(measured) > 50
+    assert len(measured) == len(expected)
+    for measured_object, expected_object in zip(measured, expected):
+        assert list(measured_object) == list(expected_object)
+        np.testing.assert_array_equal(
+            list(measured_object.values()), list(expected_object.values())
+        )
+
+
+def test_features_table_without_objects():
+    features = planktoscope.segmenter.features
+    labels, nlabels = features.label_objects(np.zeros((10, 10), dtype=np.uint8), MIN_ESD)
+    assert nlabels == 0
+    table = features.features_table(features.regions_table(labels))
+    assert list(table) == features.FEATURES
+    assert features.records(table) == []
+
+
+@pytest.mark.parametrize("extended", [False, True])
+def test_color_table_is_per_object(image, mask, extended):
+    features = planktoscope.segmenter.features
+    labels, _ = features.label_objects(mask, MIN_ESD)
+    regions = features.regions_table(labels)
+    pixels = features.object_pixels(image, labels)
+    measured = features.records(features.color_table(image, pixels, regions, extended))
+    expected = colors_per_object(image, mask, extended)
+    # some of the objects have holes
+    assert any(
+        (region_image != filled_image).any()
+        for region_image, filled_image in zip(regions["image"], regions["image_filled"])
+    )
+    assert len(measured) == len(expected)
+    for measured_object, expected_object in zip(measured, expected):
+        assert list(measured_object) == features.color_names(extended)
+        assert set(measured_object) == set(expected_object)
+        for name, value in measured_object.items():
+            if name.startswith(("Mean", *features.QUANTILES)):
+                # the sums of the values and the quantiles are exact
+                assert value == expected_object[name], name
+            else:
+                assert value == pytest.approx(expected_object[name], rel=1e-9), name
+
+
+def test_color_table_without_objects(image):
+    features = planktoscope.segmenter.features
+    labels = np.zeros(image.shape[:2], dtype=np.int32)
+    regions = features.regions_table(labels)
+    assert features.color_table(image, features.object_pixels(image, labels), regions) == {}
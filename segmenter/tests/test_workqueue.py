@@ -0,0 +1,175 @@
+# Copyright (C) 2021 Romain Bazile
+#
+# This file is part of the PlanktoScope software.
+#
+# PlanktoScope is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# PlanktoScope is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with PlanktoScope.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import time
+
+import numpy as np
+import pytest
+
+from planktoscope.segmenter.workqueue import (
+    CLAIMED,
+    DONE,
+    FAILED,
+    PENDING,
+    RESULT_UNIT_FILENAME,
+    WorkQueue,
+)
+
+
+@pytest.fixture
+def queue(tmp_path):
+    return WorkQueue(str(tmp_path / "queue"))
+
+
+def unit(first):
+    return {"id": f"acquisition-{first:06d}", "first": first}
+
+
+def segment(queue, claimed, objects=1):
+    """Writes a result for a claimed unit, as a worker does"""
+    result_path = queue.start_result(claimed["id"])
+    with open(os.path.join(result_path, "objects.npy"), "wb") as objects_file:
+        np.save(objects_file, np.arange(objects))
+    return result_path
+
+
+def expire(queue, unit_id):
+    """Makes the lease of a claimed unit run out, as if its worker stopped"""
+    claimed_path = os.path.join(queue.root, CLAIMED, f"{unit_id}.json")
+    past = time.time() - 1000
+    os.utime(claimed_path, (past, past))
+
+
+def test_claim_commit(queue):
+    assert queue.put(unit(0))
+    assert queue.put(unit(100))
+    # a unit is queued once
+    assert not queue.put(unit(0))
+    assert queue.state(unit(0)["id"]) == PENDING
+
+    claimed = queue.claim()
+    assert claimed == unit(0)
+    assert queue.state(claimed["id"]) == CLAIMED
+    assert queue.heartbeat(claimed["id"])
+
+    result_path = segment(queue, claimed, 3)
+    assert queue.commit(claimed["id"], result_path, {"objects": 3})
+    assert queue.state(claimed["id"]) == DONE
+    assert queue.result(claimed["id"]) == {"objects": 3}
+    result_path = queue.result_path(claimed["id"])
+    assert np.load(os.path.join(result_path, "objects.npy")).tolist() == [0, 1, 2]
+    # the claimed unit is kept with its result
+    assert os.path.exists(os.path.join(result_path, RESULT_UNIT_FILENAME))
+    # a unit done is not queued again
+    assert not queue.put(unit(0))
+
+    assert queue.claim() == unit(100)
+    assert queue.claim() is None
+
+    queue.remove(claimed["id"])
+    assert queue.state(claimed["id"]) is None
+
+
+def test_requeue_stale(queue):
+    queue.put(unit(0))
+    claimed = queue.claim()
+    # the lease is extended by the heartbeats
+    assert queue.requeue_stale() == 0
+    assert queue.state(claimed["id"]) == CLAIMED
+
+    expire(queue, claimed["id"])
+    assert queue.requeue_stale() == 1
+    assert queue.state(claimed["id"]) == PENDING
+    # the stopped worker finds out it lost its unit, its result is dropped
+    assert not queue.heartbeat(claimed["id"])
+    stale_result_path = segment(queue, claimed)
+    assert not queue.commit(claimed["id"], stale_result_path, {"objects": 1})
+    assert not os.path.exists(stale_result_path)
+    assert queue.state(claimed["id"]) == PENDING
+
+
+def test_commit_once(queue):
+    queue.put(unit(0))
+    claimed = queue.claim()
+    expire(queue, claimed["id"])
+    queue.requeue_stale()
+    # another worker claims the unit again, the first worker to commit keeps its result
+    other_result_path = segment(queue, queue.claim(), 2)
+    first_result_path = segment(queue, claimed)
+    assert queue.commit(claimed["id"], first_result_path, {"objects": 1})
+    assert not queue.commit(claimed["id"], other_result_path, {"objects": 2})
+    assert not os.path.exists(other_result_path)
+    assert queue.result(claimed["id"]) == {"objects": 1}
+    assert not queue.fail(claimed["id"], claimed, "stopped")
+    assert queue.state(claimed["id"]) == DONE
+
+
+def test_fail_and_requeue(queue):
+    queue.put(unit(0))
+    claimed = queue.claim()
+    assert queue.fail(claimed["id"], claimed, "broken image")
+    assert queue.state(claimed["id"]) == FAILED
+    assert queue.error(claimed["id"]) == "broken image"
+    assert queue.claim() is None
+
+    # the next coordinator queues the failed unit again
+    assert queue.put(unit(0))
+    assert queue.state(claimed["id"]) == PENDING
+    assert queue.claim() == unit(0)
+
+
+def test_fail_of_a_lost_unit(queue):
+    queue.put(unit(0))
+    claimed = queue.claim()
+    expire(queue, claimed["id"])
+    queue.requeue_stale()
+    assert not queue.fail(claimed["id"], claimed, "stopped")
+    assert queue.state(claimed["id"]) == PENDING
+
+
+def test_cancel(queue):
+    for first in (0, 100, 200):
+        queue.put(unit(first))
+    done = queue.claim()
+    queue.commit(done["id"], segment(queue, done), {"objects": 1})
+    claimed = queue.claim()
+    result_path = segment(queue, claimed)
+
+    for first in (0, 100, 200):
+        queue.cancel(unit(first)["id"])
+        assert queue.state(unit(first)["id"]) is None
+    # the worker of the cancelled unit drops its result
+    assert not queue.commit(claimed["id"], result_path, {"objects": 1})
+    assert queue.state(claimed["id"]) is None
+    assert queue.claim() is None
+
+
+def test_flats(queue):
+    flat = np.arange(24, dtype=np.uint8).reshape(2, 4, 3)
+    queue.save_flat("acquisition-000000.npy", flat)
+    # a flat is saved once, by the first coordinator
+    queue.save_flat("acquisition-000000.npy", np.zeros_like(flat))
+    np.testing.assert_array_equal(queue.load_flat("acquisition-000000.npy"), flat)
+
+
+def test_finish(queue):
+    assert not queue.finished
+    queue.finish()
+    assert queue.finished
+    queue.reopen()
+    assert not queue.finished